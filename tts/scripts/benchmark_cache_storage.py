@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Compares the per-file cache layout with the pack file layout.
+
+Usage::
+
+    $ rosrun tts benchmark_cache_storage.py -n 20000 -s 8000
+
+For each layout it times inserting the clips, hitting a random sample of them, evicting half of them and listing
+the cache directory, and reports how many files the cache left on disk.
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+from tts.db import DB, PackedDB
+
+
+def run(db_class, num_clips, clip_size, num_hits):
+    work_dir = tempfile.mkdtemp(prefix='tts_benchmark_')
+    try:
+        kwargs = {'db_location': os.path.join(work_dir, 'polly.db')}
+        if db_class is PackedDB:
+            kwargs['pack_location'] = os.path.join(work_dir, 'polly.pack')
+        db = db_class(**kwargs)
+        data = os.urandom(clip_size)
+        files = [os.path.join(work_dir, 'voice_{}'.format(i)) for i in range(num_clips)]
+
+        results = {}
+        start = time.time()
+        for i, fn in enumerate(files):
+            with open(fn, 'wb') as f:
+                f.write(data)
+            db.add_file(str(i), fn, 'audio/ogg', i, clip_size)
+        results['insert'] = time.time() - start
+
+        start = time.time()
+        for i in random.sample(range(num_clips), min(num_hits, num_clips)):
+            if not db.ensure_file(str(i), files[i]):
+                raise RuntimeError('lost {}'.format(files[i]))
+        results['hit'] = time.time() - start
+
+        start = time.time()
+        for fn in files[:num_clips // 2]:
+            db.remove_file(fn)
+        results['evict'] = time.time() - start
+
+        start = time.time()
+        results['files'] = len(os.listdir(work_dir))
+        results['listdir'] = time.time() - start
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option("-n", "--num-clips", dest="num_clips", type="int", default=10000,
+                      help="number of clips to cache", metavar="NUM_CLIPS")
+    parser.add_option("-s", "--clip-size", dest="clip_size", type="int", default=10000,
+                      help="size of each clip in bytes", metavar="CLIP_SIZE")
+    parser.add_option("-t", "--num-hits", dest="num_hits", type="int", default=1000,
+                      help="number of random cache hits", metavar="NUM_HITS")
+    (options, args) = parser.parse_args()
+
+    print('{:<8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('layout', 'insert s', 'hit ms', 'evict s', 'listdir ms',
+                                                           'files'))
+    for name, db_class in (('file', DB), ('pack', PackedDB)):
+        r = run(db_class, options.num_clips, options.clip_size, options.num_hits)
+        print('{:<8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>8}'.format(
+            name, r['insert'], 1000.0 * r['hit'] / options.num_hits, r['evict'], 1000.0 * r['listdir'], r['files']))
+
+
+if __name__ == '__main__':
+    main()
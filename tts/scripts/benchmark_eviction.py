@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Compares the eviction policies of the synthesizer cache on a synthetic trace.
+
+Usage::
+
+    $ rosrun tts benchmark_eviction.py -r 20000 -u 2000
+
+The trace has Zipf distributed popularity over a mix of short prompts and long paragraphs. For several cache sizes,
+given as a fraction of the total size of all utterances, every policy reports its hit ratio, the bytes it served
+from the cache and the synthesis time it saved.
+"""
+
+from __future__ import print_function
+
+from optparse import OptionParser
+
+from tts.cachesim import replay, synthetic_trace
+from tts.eviction import POLICIES
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option("-r", "--num-requests", dest="num_requests", type="int", default=10000,
+                      help="number of requests in the trace", metavar="NUM_REQUESTS")
+    parser.add_option("-u", "--num-utterances", dest="num_utterances", type="int", default=1000,
+                      help="number of distinct utterances", metavar="NUM_UTTERANCES")
+    parser.add_option("-a", "--zipf-alpha", dest="zipf_alpha", type="float", default=0.8,
+                      help="skew of the popularity distribution", metavar="ALPHA")
+    (options, args) = parser.parse_args()
+
+    trace = synthetic_trace(options.num_requests, options.num_utterances, options.zipf_alpha)
+    total_bytes = sum(dict((r.key, r.size) for r in trace).values())
+
+    print('{:>8} {:>6} {:>10} {:>14} {:>16}'.format('cache', 'policy', 'hit ratio', 'bytes saved', 'synth s saved'))
+    for fraction in (0.01, 0.05, 0.1, 0.25):
+        max_cache_bytes = int(total_bytes * fraction)
+        for name in sorted(POLICIES.keys()):
+            r = replay(trace, max_cache_bytes, name)
+            print('{:>7.0f}% {:>6} {:>10.3f} {:>14} {:>16.1f}'.format(
+                100 * fraction, name, r['hit_ratio'], r['bytes_hit'], r['latency_saved']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Measures what the two ROS service hops of a request cost compared to the direct calls of the combined node.
+
+Usage::
+
+    $ roscore &
+    $ rosrun tts benchmark_single_process.py -n 1000
+
+The synthesizer hop is timed with a cached utterance of a synthesizer with the dummy engine, and the polly hop with
+the dummy engine behind a polly service. Each hop is timed as a direct call, as the combined node makes it, and as a
+service call through a new proxy for every request, as the separate nodes make it. The difference is the overhead
+per request that the combined node removes: the synthesizer hop on every request, the polly hop on cache misses.
+"""
+
+from __future__ import print_function
+
+import json
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+import rospy
+from tts.srv import Polly, PollyResponse, Synthesizer, SynthesizerRequest
+from tts.synthesizer import SpeechSynthesizer
+
+
+def mean_ms(call, num_requests):
+    start = time.time()
+    for _ in range(num_requests):
+        call()
+    return 1000.0 * (time.time() - start) / num_requests
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option("-n", "--num-requests", dest="num_requests", type="int", default=500,
+                      help="number of requests per measurement", metavar="NUM_REQUESTS")
+    (options, args) = parser.parse_args()
+
+    rospy.init_node('benchmark_single_process')
+    cache_dir = tempfile.mkdtemp(prefix='tts_benchmark_')
+    try:
+        synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+        rospy.Service('benchmark_synthesizer', Synthesizer, synthesizer._node_request_handler)
+        request = SynthesizerRequest(text='Benchmark', metadata='')
+        synthesizer._node_request_handler(request)  # cache it
+
+        dummy = SpeechSynthesizer.DummyEngine()
+        fields = ('text', 'text_type', 'voice_id', 'output_format', 'output_path', 'sample_rate')
+        rospy.Service('benchmark_polly', Polly,
+                      lambda req: PollyResponse(dummy(**dict((f, getattr(req, f)) for f in fields)).result))
+        polly_kw = {'text': 'Benchmark', 'text_type': 'text', 'voice_id': 'Joanna', 'output_format': 'ogg_vorbis',
+                    'output_path': '{}/benchmark'.format(cache_dir), 'sample_rate': '22050'}
+        via_node = SpeechSynthesizer.PollyViaNode('benchmark_polly')
+
+        def synthesizer_via_service():
+            rospy.wait_for_service('benchmark_synthesizer')
+            res = rospy.ServiceProxy('benchmark_synthesizer', Synthesizer)(request.text, request.metadata)
+            json.loads(res.result)
+
+        hops = (
+            ('synthesizer', lambda: json.loads(synthesizer._node_request_handler(request).result),
+             synthesizer_via_service),
+            ('polly', lambda: json.loads(dummy(**polly_kw).result), lambda: json.loads(via_node(**polly_kw).result)),
+        )
+        print('{:<12} {:>10} {:>10} {:>12}'.format('hop', 'direct ms', 'service ms', 'overhead ms'))
+        for name, direct, via_service in hops:
+            direct_ms = mean_ms(direct, options.num_requests)
+            service_ms = mean_ms(via_service, options.num_requests)
+            print('{:<12} {:>10.3f} {:>10.3f} {:>12.3f}'.format(name, direct_ms, service_ms, service_ms - direct_ms))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
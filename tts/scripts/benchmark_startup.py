@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Measures how long the polly and synthesizer nodes take to start.
+
+Usage::
+
+    $ roscore &
+    $ rosrun tts benchmark_startup.py -n 5
+
+Every run starts a node under a name of its own, then reports the seconds until its service is advertised and until
+it has returned the audio of a first request. The text of every request is new, so the synthesizer can't answer it
+from its cache. The synthesizer runs with the POLLY_LIBRARY engine, so it doesn't need a polly node. Valid AWS
+credentials are needed for the first audio.
+"""
+
+from __future__ import print_function
+
+import json
+import subprocess
+import time
+from optparse import OptionParser
+
+import rospy
+from tts.srv import Polly, Synthesizer
+
+
+def call_polly(service_name, text):
+    return rospy.ServiceProxy(service_name, Polly)(polly_action='SynthesizeSpeech', text=text,
+                                                   output_path='/tmp/benchmark_startup').result
+
+
+def call_synthesizer(service_name, text):
+    return rospy.ServiceProxy(service_name, Synthesizer)(text, '').result
+
+
+NODES = {
+    'polly': (['polly_node.py'], call_polly),
+    'synthesizer': (['synthesizer_node.py', '-e', 'POLLY_LIBRARY'], call_synthesizer),
+}
+
+
+def run(node, run_id, timeout):
+    """Start a node, call it once and stop it.
+
+    :return: the seconds until its service was advertised and until the first audio was returned
+    """
+    args, call = NODES[node]
+    name = 'benchmark_startup_{}_{}'.format(node, run_id)
+    start = time.time()
+    process = subprocess.Popen(['rosrun', 'tts'] + args + ['-n', name, '-s', name])
+    try:
+        rospy.wait_for_service(name, timeout=timeout)
+        ready = time.time() - start
+        result = json.loads(call(name, 'Benchmark run {} started at {}.'.format(run_id, start)))
+        if 'Exception' in result or not result.get('Audio File'):
+            raise RuntimeError('{} failed: {}'.format(node, result.get('Exception')))
+        first_audio = time.time() - start
+        return ready, first_audio
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option("-n", "--num-runs", dest="num_runs", type="int", default=3,
+                      help="number of times each node is started", metavar="NUM_RUNS")
+    parser.add_option("-N", "--nodes", dest="nodes", default='polly,synthesizer',
+                      help="comma separated nodes to start, polly and/or synthesizer", metavar="NODES")
+    parser.add_option("-t", "--timeout", dest="timeout", type="float", default=60.0,
+                      help="seconds to wait for a service", metavar="TIMEOUT")
+    (options, args) = parser.parse_args()
+
+    print('{:<12} {:>4} {:>10} {:>14}'.format('node', 'run', 'ready s', 'first audio s'))
+    for node in options.nodes.split(','):
+        times = []
+        for i in range(options.num_runs):
+            ready, first_audio = run(node, i, options.timeout)
+            times.append((ready, first_audio))
+            print('{:<12} {:>4} {:>10.3f} {:>14.3f}'.format(node, i, ready, first_audio))
+        median = len(times) // 2
+        print('{:<12} {:>4} {:>10.3f} {:>14.3f}'.format(node, 'med', sorted(t[0] for t in times)[median],
+                                                        sorted(t[1] for t in times)[median]))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,20 +14,31 @@
 # permissions and limitations under the License.
 
 import json
+import math
 import os
 import sys
 import wave
+import threading
 import traceback
-import requests
-from boto3 import Session
-from botocore.credentials import CredentialProvider, RefreshableCredentials
-from botocore.session import get_session
-from botocore.exceptions import UnknownServiceError
 from contextlib import closing
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
 from optparse import OptionParser
 
 import rospy
 from tts.srv import Polly, PollyRequest, PollyResponse
+from tts.audio import publishing
+from tts.deadline import DeadlineExceeded, check, remaining, split_timeouts
+from tts.voices import VoiceCatalog
+from tts.lexicons import INDEX_FILE_NAME, LexiconIndex, lexicon_version
+from tts.profiling import RequestProfiler
+from tts.endpoints import EndpointSelector, is_endpoint_error, parse_endpoints
+
+# boto3 and botocore take seconds to import on a small computer, so they are only imported when the first client is
+# built, which the node does in the background once its service is advertised
+Session = None
 
 
 def get_ros_param(param, default=None):
@@ -39,60 +50,6 @@ def get_ros_param(param, default=None):
         return default
 
 
-class AwsIotCredentialProvider(CredentialProvider):
-    METHOD = 'aws-iot'
-    CANONICAL_NAME = 'customIoTwithCertificate'
-
-    DEFAULT_AUTH_CONNECT_TIMEOUT_MS = 5000
-    DEFAULT_AUTH_TOTAL_TIMEOUT_MS = 10000
-
-    def __init__(self):
-        super(AwsIotCredentialProvider, self).__init__()
-        self.ros_param_prefix = 'iot/'
-
-    def get_param(self, param, default=None):
-        return get_ros_param(self.ros_param_prefix + param, default)
-
-    def retrieve_credentials(self):
-        try:
-            cert_file = self.get_param('certfile')
-            key_file = self.get_param('keyfile')
-            endpoint = self.get_param('endpoint')
-            role_alias = self.get_param('role')
-            connect_timeout = self.get_param('connect_timeout_ms', self.DEFAULT_AUTH_CONNECT_TIMEOUT_MS)
-            total_timeout = self.get_param('total_timeout_ms', self.DEFAULT_AUTH_TOTAL_TIMEOUT_MS)
-            thing_name = self.get_param('thing_name', '')
-
-            if any(v is None for v in (cert_file, key_file, endpoint, role_alias, thing_name)):
-                return None
-
-            headers = {'x-amzn-iot-thingname': thing_name} if len(thing_name) > 0 else None
-            url = 'https://{}/role-aliases/{}/credentials'.format(endpoint, role_alias)
-            timeout = (connect_timeout, total_timeout - connect_timeout)  # see also: urllib3/util/timeout.py
-
-            response = requests.get(url, cert=(cert_file, key_file), headers=headers, timeout=timeout)
-            d = response.json()['credentials']
-
-            rospy.loginfo('Credentials expiry time: {}'.format(d['expiration']))
-
-            return {
-                'access_key': d['accessKeyId'],
-                'secret_key': d['secretAccessKey'],
-                'token': d['sessionToken'],
-                'expiry_time': d['expiration'],
-            }
-        except Exception as e:
-            rospy.logwarn('Failed to fetch credentials from AWS IoT: {}'.format(e))
-            return None
-
-    def load(self):
-        return RefreshableCredentials.create_from_metadata(
-            self.retrieve_credentials(),
-            self.retrieve_credentials,
-            'aws-iot-with-certificate'
-        )
-
-
 class AmazonPolly:
     """A TTS engine that can be used in two different ways.
 
@@ -107,7 +64,7 @@ class AmazonPolly:
 
     Call the service from command line::
 
-        $ rosservice call /polly SynthesizeSpeech 'hello polly' '' '' '' '' '' '' '' '' [] [] 0 '' '' '' '' '' '' false
+        $ rosservice call /polly "{polly_action: SynthesizeSpeech, text: 'hello polly'}"
 
     Call the service programmatically::
 
@@ -146,30 +103,52 @@ class AmazonPolly:
 
     Among the parameters defined in Polly.srv, the following are supported while others are reserved for future.
 
-    * polly_action : currently only ``SynthesizeSpeech`` is supported
+    * polly_action : ``SynthesizeSpeech``, ``DescribeVoices``, ``PutLexicon``, ``GetLexicon``, ``ListLexicons``,
+      ``DeleteLexicon``, ``StartSpeechSynthesisTask`` or ``GetSpeechSynthesisTask``
     * text : the text to speak
     * text_type : can be either ``text`` (default) or ``ssml``
     * voice_id : any voice id supported by Amazon Polly, default is Joanna
     * output_format : ogg (default), mp3 or pcm
     * output_path : where the audio file is saved
     * sample_rate : default is 16000 for pcm or 22050 for mp3 and ogg
+    * language_code : the language of a bilingual voice, or the language to describe the voices of. Note that it is
+      rarely needed for synthesis (this may seem counter-intuitive).
+    * include_additional_language_codes : whether DescribeVoices also returns bilingual voices speaking the language
+    * lexicon_name : the lexicon to put, get or delete
+    * lexicon_content : the PLS document of the lexicon to put
+    * lexicon_names : the lexicons to apply when synthesizing
+    * output_s3_bucket_name, output_s3_key_prefix, sns_topic_arn : where StartSpeechSynthesisTask saves the audio
+      and whom it notifies
+    * task_id : the synthesis task for GetSpeechSynthesisTask
+    * deadline : the time, in seconds since the epoch, by which the request must be done, 0 for none. A request is
+      refused once its deadline has passed, and Amazon Polly is called without retries and with connect and read
+      timeouts that add up to the time left. A SynthesizeSpeech whose audio arrives after the deadline fails as well,
+      see ``tts.deadline``.
+    * stream : publish pcm on the ``audio_topic`` as ``audio_common_msgs/AudioData`` while it arrives from Amazon
+      Polly, so that a player subscribed to it can start before the whole audio is saved. The result then has
+      ``"Streamed": true``. It is ignored for other formats.
+
+    With several regions or endpoints in ``aws_client_configuration/endpoints``, SynthesizeSpeech goes to the one
+    with the lowest moving average latency and fails over to the others, see ``tts.endpoints``. Requests with
+    lexicons and the other actions always go to ``aws_client_configuration/region``, where the lexicons are.
+
+    DescribeVoices returns ``{"Voices": [...]}`` from a catalogue of voices that is fetched from Amazon Polly at most
+    once a day and saved in ``polly_voices.json`` of the cache directory, see ``tts.voices``.
+
+    The lexicons are mirrored in ``polly_lexicons.json`` of the cache directory, see ``tts.lexicons``. PutLexicon
+    doesn't upload a lexicon whose content is unchanged and still in Amazon Polly, and GetLexicon answers from the
+    mirror. ListLexicons refreshes the mirror with the lexicons that were changed by other means.
+
+    StartSpeechSynthesisTask synthesizes texts that are too long for SynthesizeSpeech to a file in Amazon S3 and
+    returns ``{"SynthesisTask": {"TaskId": ..., "TaskStatus": ...}}`` right away. GetSpeechSynthesisTask returns the
+    same for a task_id. Once the task is completed and if an output_path is given, it also downloads the audio.
+
+    The following are the reserved ones. See official Amazon Polly documentation for details (link can be found below).
 
-    The following are the reserved ones. Note that ``language_code`` is rarely needed (this may seem counter-intuitive).
-    See official Amazon Polly documentation for details (link can be found below).
-
-    * language_code
-    * lexicon_content
-    * lexicon_name
-    * lexicon_names
     * speech_mark_types
     * max_results
     * next_token
-    * sns_topic_arn
-    * task_id
     * task_status
-    * output_s3_bucket_name
-    * output_s3_key_prefix
-    * include_additional_language_codes
 
 
     Links
@@ -179,22 +158,93 @@ class AmazonPolly:
 
     """
 
-    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None, region_name=None):
+    # how much of a synthesis task's audio is downloaded at a time
+    DOWNLOAD_CHUNK_SIZE = 65536
+
+    # with more seconds left before a deadline, a request uses the default client and its timeouts of 60 seconds
+    DEADLINE_MAX_TIMEOUT = 60
+    # with fewer seconds left before a deadline, Amazon Polly is not called at all
+    DEADLINE_MIN_TIMEOUT = 0.1
+
+    # bytes of pcm in every message published when streaming, 100 ms at 16000 Hz
+    STREAM_FRAME_BYTES = 3200
+
+    def __init__(self, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None, region_name=None,
+                 endpoint_url=None, defer_client=False, endpoints=None, cache_dir='/tmp'):
+        """
+        :param defer_client: build the Amazon Polly client when it is first used, or by ``warm_up``, instead of now
+        :param endpoints: the regions or endpoints to choose from for SynthesizeSpeech, see ``tts.endpoints``
+        :param cache_dir: the directory of the voice catalogue and the lexicon index, shared with the synthesizer
+        """
         if region_name is None:
             region_name = get_ros_param('aws_client_configuration/region', default='us-west-2')
-
-        self.polly = self._get_polly_client(aws_access_key_id, aws_secret_access_key, aws_session_token, region_name)
+        if endpoint_url is None:
+            endpoint_url = get_ros_param('aws_client_configuration/endpoint_url', default=None)
+        if endpoints is None:
+            endpoints = get_ros_param('aws_client_configuration/endpoints', default=None)
+
+        # a custom endpoint is used for Amazon Polly and Amazon S3, e.g. a local stub in tests
+        self.endpoint_url = endpoint_url
+        self.session = None
+        self._s3 = None
+        self._deadline_clients = {}
+        self.endpoint_selector = None
+        if endpoints:
+            self.endpoint_selector = EndpointSelector(parse_endpoints(endpoints), probe_interval=get_ros_param(
+                'aws_client_configuration/probe_interval', default=60.0))
+        self._polly = None
+        self._client_args = (aws_access_key_id, aws_secret_access_key, aws_session_token, region_name)
+        self._client_lock = threading.Lock()
+        self._audio_publisher = None
+        if not defer_client:
+            self.warm_up()
         self.default_text_type = 'text'
         self.default_voice_id = 'Joanna'
         self.default_output_format = 'ogg_vorbis'
         self.default_output_folder = '.'
         self.default_output_file_basename = 'output'
+        self.voice_catalog = VoiceCatalog(self._fetch_voices, cache_file=os.path.join(cache_dir, 'polly_voices.json'))
+        self.lexicon_index = LexiconIndex(os.path.join(cache_dir, INDEX_FILE_NAME))
+        self.profiler = RequestProfiler('polly')
+
+    @property
+    def polly(self):
+        """The Amazon Polly client, built by the first caller while the others wait for it."""
+        with self._client_lock:
+            if self._polly is None:
+                self._polly = self._get_polly_client(*self._client_args)
+            return self._polly
+
+    def warm_up(self):
+        """Build the Amazon Polly client now, so that the first request doesn't have to."""
+        return self.polly
+
+    def warm_up_in_background(self):
+        """Build the Amazon Polly client in a background thread, errors are logged and the first request retries."""
+        def warm_up():
+            try:
+                self.warm_up()
+                rospy.loginfo('Amazon Polly client is ready')
+            except Exception as e:
+                rospy.logwarn('failed to build the Amazon Polly client: {}'.format(e))
+
+        thread = threading.Thread(target=warm_up, name='polly_warm_up')
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def _get_polly_client(self, aws_access_key_id=None, aws_secret_access_key=None, aws_session_token=None,
                           region_name=None, with_service_model_patch=False):
         """Note we get a new botocore session each time this function is called.
         This is to avoid potential problems caused by inner state of the session.
         """
+        global Session
+        if Session is None:
+            from boto3 import Session
+        from botocore.session import get_session
+        from botocore.exceptions import UnknownServiceError
+        from tts.iotcredentials import AwsIotCredentialProvider
+
         botocore_session = get_session()
 
         if with_service_model_patch:
@@ -213,8 +263,10 @@ class AmazonPolly:
                           aws_session_token=aws_session_token, region_name=region_name,
                           botocore_session=botocore_session)
 
+        self.session = session
+        client_kwargs = {'endpoint_url': self.endpoint_url} if self.endpoint_url else {}
         try:
-            return session.client("polly")
+            return session.client("polly", **client_kwargs)
         except UnknownServiceError:
             # the first time we reach here, we try to fix the problem
             if not with_service_model_patch:
@@ -225,6 +277,77 @@ class AmazonPolly:
                 rospy.logerr('Amazon Polly is not available. Please install the latest boto3.')
                 raise
 
+    def _client_for(self, deadline, endpoint=None):
+        """Return the Amazon Polly client for a request that has to be done by deadline.
+
+        Without a deadline, or with more time left than ``DEADLINE_MAX_TIMEOUT``, this is the default client.
+        Otherwise it is a client that doesn't retry and whose connect and read timeouts add up to the seconds left,
+        rounded down to tenths below a second and to whole seconds above, see ``tts.deadline.split_timeouts``. These
+        clients are kept by their timeouts, so there are at most ``DEADLINE_MAX_TIMEOUT`` + 9 of them. With less
+        than ``DEADLINE_MIN_TIMEOUT`` left, the request is given up right away.
+
+        The client of an endpoint doesn't retry either, a request fails over to another endpoint instead.
+
+        :param deadline: the deadline of the request, 0 if it has none
+        :param endpoint: the Endpoint to call, None for the default region
+        :return: a botocore client
+        """
+        check(deadline, 'call Amazon Polly')
+        default_client = self.polly
+        left = remaining(deadline)
+        timeout = None
+        if left is not None and left < self.DEADLINE_MAX_TIMEOUT:
+            if left < self.DEADLINE_MIN_TIMEOUT:
+                raise DeadlineExceeded('only {:.3f} seconds are left before the deadline, not going to call Amazon '
+                                       'Polly'.format(left))
+            timeout = math.floor(left * 10) / 10.0 if left < 1 else float(math.floor(left))
+        if timeout is None and endpoint is None:
+            return default_client
+        key = (endpoint.name if endpoint else None, timeout)
+        client = self._deadline_clients.get(key)
+        if client is None:
+            from botocore.config import Config
+            if endpoint is None:
+                client_kwargs = {'endpoint_url': self.endpoint_url} if self.endpoint_url else {}
+            else:
+                client_kwargs = {'region_name': endpoint.region_name}
+                if endpoint.endpoint_url:
+                    client_kwargs['endpoint_url'] = endpoint.endpoint_url
+            config_kwargs = {}
+            if timeout:
+                connect_timeout, read_timeout = split_timeouts(timeout, self.DEADLINE_MAX_TIMEOUT,
+                                                               self.DEADLINE_MAX_TIMEOUT)
+                config_kwargs = {'connect_timeout': connect_timeout, 'read_timeout': read_timeout}
+            config = Config(retries={'max_attempts': 0}, **config_kwargs)
+            client = self._deadline_clients[key] = self.session.client('polly', config=config, **client_kwargs)
+        return client
+
+    def _synthesize_speech(self, kws, deadline):
+        """Call SynthesizeSpeech on the quickest endpoint, failing over to the others, or on the default client.
+
+        :param kws: the arguments of SynthesizeSpeech
+        :param deadline: the deadline of the request, 0 if it has none
+        :return: the response of Amazon Polly
+        """
+        if self.endpoint_selector is None or kws['LexiconNames']:
+            return self._client_for(deadline).synthesize_speech(**kws)
+        # an expired deadline is not the fault of the endpoints
+        check(deadline, 'call Amazon Polly')
+        endpoints = self.endpoint_selector.ranked()
+        for i, endpoint in enumerate(endpoints):
+            try:
+                return self.endpoint_selector.call(
+                    endpoint, lambda e: self._client_for(deadline, e).synthesize_speech(**kws))
+            except Exception as e:
+                if i == len(endpoints) - 1 or not is_endpoint_error(e):
+                    raise
+                rospy.logwarn('Amazon Polly at {} failed, trying {}: {}'.format(
+                    endpoint.name, endpoints[i + 1].name, e))
+
+    def _probe(self, endpoint):
+        """A cheap request to an endpoint to measure its latency."""
+        self._client_for(0, endpoint).describe_voices(LanguageCode='en-US')
+
     def _generate_user_agent_suffix(self):
         exec_env = get_ros_param('exec_env', 'AWS_RoboMaker').strip()
         if 'AWS_RoboMaker' in exec_env:
@@ -244,6 +367,40 @@ class AmazonPolly:
         wavf.writeframes(audio_data)
         wavf.close()
 
+    def _stream_pcm(self, stream, wav_filename, sample_rate):
+        """Publish pcm on the audio topic as it arrives from Amazon Polly, and save it as wav at the same time.
+
+        The pcm is published as ``audio_common_msgs/AudioData`` messages of ``STREAM_FRAME_BYTES``, the last one may
+        be shorter. The topic is the ROS param ``audio_topic``, ``audio`` by default.
+
+        :param stream: the AudioStream of the response
+        :param wav_filename: where to save the audio
+        :param sample_rate: the sample rate of the pcm
+        """
+        from audio_common_msgs.msg import AudioData
+        if self._audio_publisher is None:
+            self._audio_publisher = rospy.Publisher(get_ros_param('audio_topic', 'audio'), AudioData, queue_size=100)
+
+        wavf = wave.open(wav_filename, 'w')
+        try:
+            wavf.setframerate(int(sample_rate))
+            wavf.setnchannels(1)
+            wavf.setsampwidth(2)
+            pending = b''
+            while True:
+                chunk = stream.read(self.STREAM_FRAME_BYTES)
+                if not chunk:
+                    break
+                wavf.writeframes(chunk)
+                pending += chunk
+                while len(pending) >= self.STREAM_FRAME_BYTES:
+                    self._audio_publisher.publish(AudioData(data=pending[:self.STREAM_FRAME_BYTES]))
+                    pending = pending[self.STREAM_FRAME_BYTES:]
+            if pending:
+                self._audio_publisher.publish(AudioData(data=pending))
+        finally:
+            wavf.close()
+
     def _make_audio_file_fullpath(self, output_path, output_format):
         """Makes a full path for audio file based on given output path and format.
 
@@ -291,50 +448,263 @@ class AmazonPolly:
 
         if not kws['SampleRate']:
             kws['SampleRate'] = '16000' if kws['OutputFormat'].lower() == 'pcm' else '22050'
+        if request.language_code:
+            kws['LanguageCode'] = request.language_code
 
         rospy.loginfo('Amazon Polly Request: {}'.format(kws))
-        response = self.polly.synthesize_speech(**kws)
+        response = self._synthesize_speech(kws, request.deadline)
         rospy.loginfo('Amazon Polly Response: {}'.format(response))
 
         if "AudioStream" in response:
             audiofile = self._make_audio_file_fullpath(request.output_path, kws['OutputFormat'])
             rospy.loginfo('will save audio as {}'.format(audiofile))
 
-            with closing(response["AudioStream"]) as stream:
-                if kws['OutputFormat'].lower() == 'pcm':
-                    self._pcm2wav(stream.read(), audiofile, kws['SampleRate'])
+            streamed = request.stream and kws['OutputFormat'].lower() == 'pcm'
+            # the file is renamed into place once complete, so a reader never sees a partial file
+            with closing(response["AudioStream"]) as stream, publishing(audiofile) as tmp_audiofile:
+                if streamed:
+                    self._stream_pcm(stream, tmp_audiofile, kws['SampleRate'])
+                elif kws['OutputFormat'].lower() == 'pcm':
+                    self._pcm2wav(stream.read(), tmp_audiofile, kws['SampleRate'])
                 else:
-                    with open(audiofile, "wb") as f:
+                    with open(tmp_audiofile, "wb") as f:
                         f.write(stream.read())
+                if not streamed:
+                    # the read timeout bounds every read of the socket, not the whole response
+                    check(request.deadline, 'return the audio')
 
             audiotype = response['ContentType']
         else:
             audiofile = ''
             audiotype = 'N/A'
+            streamed = False
 
-        return json.dumps({
+        result = {
             'Audio File': audiofile,
             'Audio Type': audiotype,
             'Amazon Polly Response Metadata': str(response['ResponseMetadata'])
-        })
+        }
+        if streamed:
+            result['Streamed'] = True
+        return json.dumps(result)
+
+    def _fetch_voices(self, deadline=None):
+        """Calls DescribeVoices for all languages, following every page of the results, until deadline."""
+        voices = []
+        kws = {'IncludeAdditionalLanguageCodes': True}
+        while True:
+            response = self._client_for(deadline).describe_voices(**kws)
+            voices.extend(response['Voices'])
+            if not response.get('NextToken'):
+                return voices
+            kws['NextToken'] = response['NextToken']
+
+    def _describe_voices(self, request):
+        """Returns the voices for the language of the request from the voice catalogue.
+
+        :param request: an instance of PollyRequest
+        :return: a string in JSON form with the list of voices as "Voices"
+        """
+        return json.dumps({'Voices': self.describe_voices(request.language_code,
+                                                          request.include_additional_language_codes,
+                                                          request.deadline)})
+
+    def _put_lexicon(self, request):
+        """Uploads a lexicon unless Amazon Polly already has the same content.
+
+        The lexicon index may be out of date, e.g. when the lexicon was deleted by other means, so a lexicon is only
+        not uploaded if Amazon Polly still has it as it was last modified by this node. The time of the upload is
+        recorded, so that ListLexicons doesn't download the lexicon again.
+
+        :param request: an instance of PollyRequest
+        :return: a string in JSON form with the name and version of the lexicon and whether it was uploaded
+        """
+        name, content = request.lexicon_name, request.lexicon_content
+        version = lexicon_version(content)
+        client = self._client_for(request.deadline)
+        known = self.lexicon_index.get(name)
+        uploaded = (known is None or known['version'] != version or known['last_modified'] is None or
+                    self._lexicon_last_modified(client, name) != known['last_modified'])
+        if uploaded:
+            client.put_lexicon(Name=name, Content=content)
+            self.lexicon_index.record(name, content, self._lexicon_last_modified(client, name))
+        return json.dumps({'Name': name, 'Version': version, 'Uploaded': uploaded})
+
+    @staticmethod
+    def _lexicon_last_modified(client, name):
+        """Returns when Amazon Polly last modified a lexicon, as a string, or None if it doesn't have the lexicon."""
+        try:
+            response = client.get_lexicon(Name=name)
+        except Exception as e:
+            error_response = getattr(e, 'response', None)
+            code = error_response.get('Error', {}).get('Code') if isinstance(error_response, dict) else None
+            if code != 'LexiconNotFoundException':
+                raise
+            return None
+        return str(response['LexiconAttributes'].get('LastModified'))
+
+    def _get_lexicon(self, request):
+        """Returns the content of a lexicon, from the lexicon index if it is known.
+
+        :param request: an instance of PollyRequest
+        :return: a string in JSON form with the name, content and version of the lexicon
+        """
+        name = request.lexicon_name
+        known = self.lexicon_index.get(name)
+        if known is None:
+            response = self._client_for(request.deadline).get_lexicon(Name=name)
+            self.lexicon_index.record(name, response['Lexicon']['Content'],
+                                      str(response['LexiconAttributes'].get('LastModified')))
+            known = self.lexicon_index.get(name)
+        return json.dumps({'Name': name, 'Content': known['content'], 'Version': known['version']})
+
+    def _list_lexicons(self, request):
+        """Lists the lexicons stored in Amazon Polly and brings the lexicon index up to date.
+
+        Only the lexicons that were modified since they were last seen are downloaded.
+
+        :param request: an instance of PollyRequest
+        :return: a string in JSON form with a list of lexicons as "Lexicons", each with its name and attributes
+        """
+        lexicons = []
+        kws = {}
+        while True:
+            response = self._client_for(request.deadline).list_lexicons(**kws)
+            lexicons.extend(response['Lexicons'])
+            if not response.get('NextToken'):
+                break
+            kws['NextToken'] = response['NextToken']
+
+        listed = []
+        for lexicon in lexicons:
+            name = lexicon['Name']
+            attributes = dict((k, str(v) if k == 'LastModified' else v) for k, v in lexicon['Attributes'].items())
+            known = self.lexicon_index.get(name)
+            if known is None or known['last_modified'] != attributes.get('LastModified'):
+                content = self._client_for(request.deadline).get_lexicon(Name=name)['Lexicon']['Content']
+                self.lexicon_index.record(name, content, attributes.get('LastModified'))
+            listed.append({'Name': name, 'Attributes': attributes})
+
+        listed_names = set(l['Name'] for l in listed)
+        self.lexicon_index.remove(*[n for n in self.lexicon_index.names() if n not in listed_names])
+        return json.dumps({'Lexicons': listed})
+
+    def _delete_lexicon(self, request):
+        """Deletes a lexicon from Amazon Polly and the lexicon index.
+
+        :param request: an instance of PollyRequest
+        :return: a string in JSON form with the name of the deleted lexicon
+        """
+        self._client_for(request.deadline).delete_lexicon(Name=request.lexicon_name)
+        self.lexicon_index.remove(request.lexicon_name)
+        return json.dumps({'Name': request.lexicon_name})
+
+    @staticmethod
+    def _task_result(response):
+        """The SynthesisTask of a task API response, with times as strings so that it can be serialized."""
+        task = response['SynthesisTask']
+        return dict((k, str(v) if k == 'CreationTime' else v) for k, v in task.items())
+
+    def _start_speech_synthesis_task(self, request):
+        """Starts synthesizing a long text to a file in Amazon S3.
+
+        See https://docs.aws.amazon.com/polly/latest/dg/API_StartSpeechSynthesisTask.html.
+
+        :param request: an instance of PollyRequest, output_s3_bucket_name is required
+        :return: a string in JSON form with the task as "SynthesisTask", its id is "TaskId"
+        """
+        kws = {
+            'LexiconNames': request.lexicon_names if request.lexicon_names else [],
+            'OutputFormat': request.output_format if request.output_format else self.default_output_format,
+            'OutputS3BucketName': request.output_s3_bucket_name,
+            'Text': request.text,
+            'TextType': request.text_type if request.text_type else self.default_text_type,
+            'VoiceId': request.voice_id if request.voice_id else self.default_voice_id
+        }
+        optional = {
+            'SampleRate': request.sample_rate,
+            'OutputS3KeyPrefix': request.output_s3_key_prefix,
+            'SnsTopicArn': request.sns_topic_arn,
+            'LanguageCode': request.language_code,
+            'SpeechMarkTypes': request.speech_mark_types,
+        }
+        kws.update((k, v) for k, v in optional.items() if v)
+
+        rospy.loginfo('Amazon Polly Request: {}'.format(kws))
+        client = self._client_for(request.deadline)
+        return json.dumps({'SynthesisTask': self._task_result(client.start_speech_synthesis_task(**kws))})
+
+    def _get_speech_synthesis_task(self, request):
+        """Returns the state of a synthesis task, and downloads its audio once it is completed.
+
+        The audio is only downloaded if the request has an output path. It is streamed from Amazon S3 to the file.
+
+        :param request: an instance of PollyRequest with task_id
+        :return: a string in JSON form with the task as "SynthesisTask", and "Audio File" once it is downloaded
+        """
+        task = self._task_result(self._client_for(request.deadline).get_speech_synthesis_task(TaskId=request.task_id))
+        result = {'SynthesisTask': task}
+        if request.output_path and task['TaskStatus'] == 'completed':
+            output_format = task.get('OutputFormat', self.default_output_format)
+            audiofile = self._make_audio_file_fullpath(request.output_path, output_format)
+            self._download(task['OutputUri'], audiofile, output_format, task.get('SampleRate'))
+            result['Audio File'] = audiofile
+            result['Audio Type'] = {'pcm': 'audio/pcm', 'mp3': 'audio/mpeg'}.get(output_format, 'audio/ogg')
+        return json.dumps(result)
+
+    def _download(self, output_uri, audiofile, output_format, sample_rate):
+        """Streams the output of a synthesis task from Amazon S3 to a file.
+
+        :param output_uri: the path style URI of the output, i.e. ``https://<s3 endpoint>/<bucket>/<key>``
+        """
+        bucket, key = urlparse(output_uri).path.lstrip('/').split('/', 1)
+        if self._s3 is None:
+            client_kwargs = {'endpoint_url': self.endpoint_url} if self.endpoint_url else {}
+            self._s3 = self.session.client('s3', **client_kwargs)
+        rospy.loginfo('will download {} to {}'.format(output_uri, audiofile))
+        body = self._s3.get_object(Bucket=bucket, Key=key)['Body']
+        with closing(body), publishing(audiofile) as tmp_audiofile:
+            if output_format.lower() == 'pcm':
+                # the header of a wav file needs the number of frames, so pcm is written through the wave module
+                wavf = wave.open(tmp_audiofile, 'wb')
+                try:
+                    wavf.setframerate(int(sample_rate or 16000))
+                    wavf.setnchannels(1)
+                    wavf.setsampwidth(2)
+                    for chunk in iter(lambda: body.read(self.DOWNLOAD_CHUNK_SIZE), b''):
+                        wavf.writeframes(chunk)
+                finally:
+                    wavf.close()
+            else:
+                with open(tmp_audiofile, 'wb') as f:
+                    for chunk in iter(lambda: body.read(self.DOWNLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
 
     def _dispatch(self, request):
         """Amazon Polly supports a number of APIs. This will call the right one based on the content of request.
 
-        Currently "SynthesizeSpeech" is the only recognized action. Basically this method just delegates the work
-        to ``self._synthesize_speech_and_save`` and returns the result as is. It will simply raise if a different
-        action is passed in.
+        "SynthesizeSpeech", "DescribeVoices" and the lexicon actions are recognized. Basically this method just
+        delegates the work to ``self._synthesize_speech_and_save`` or the like and returns the result as is. It will
+        simply raise if a different action is passed in.
 
         :param request: an instance of PollyRequest
         :return: whatever returned by the delegate
         """
         actions = {
-            'SynthesizeSpeech': self._synthesize_speech_and_save
+            'SynthesizeSpeech': self._synthesize_speech_and_save,
+            'DescribeVoices': self._describe_voices,
+            'PutLexicon': self._put_lexicon,
+            'GetLexicon': self._get_lexicon,
+            'ListLexicons': self._list_lexicons,
+            'DeleteLexicon': self._delete_lexicon,
+            'StartSpeechSynthesisTask': self._start_speech_synthesis_task,
+            'GetSpeechSynthesisTask': self._get_speech_synthesis_task,
             # ... more actions could go in here ...
         }
 
         if request.polly_action not in actions:
             raise RuntimeError('bad or unsupported Amazon Polly action: "' + request.polly_action + '".')
+        check(request.deadline, 'call {}'.format(request.polly_action))
 
         return actions[request.polly_action](request)
 
@@ -348,33 +718,39 @@ class AmazonPolly:
         """
         rospy.loginfo('Amazon Polly Request: {}'.format(request))
 
-        try:
-            response = self._dispatch(request)
-            rospy.loginfo('will return {}'.format(response))
-            return PollyResponse(result=response)
-        except Exception as e:
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            exc_type = sys.exc_info()[0]
-
-            # not using `issubclass(exc_type, ConnectionError)` for the condition below because some versions
-            # of urllib3 raises exception when doing `from requests.exceptions import ConnectionError`
-            error_ogg_filename = 'connerror.ogg' if 'ConnectionError' in exc_type.__name__ else 'error.ogg'
-
-            error_details = {
-                'Audio File': os.path.join(current_dir, 'data', error_ogg_filename),
-                'Audio Type': 'ogg',
-                'Exception': {
-                    'Type': str(exc_type),
-                    'Module': exc_type.__module__,
-                    'Name': exc_type.__name__,
-                    'Value': str(e),
-                },
-                'Traceback': traceback.format_exc()
-            }
-
-            error_str = json.dumps(error_details)
-            rospy.logerr(error_str)
-            return PollyResponse(result=error_str)
+        with self.profiler.request():
+            try:
+                response = self._dispatch(request)
+                rospy.loginfo('will return {}'.format(response))
+                return PollyResponse(result=response)
+            except Exception as e:
+                current_dir = os.path.dirname(os.path.abspath(__file__))
+                exc_type = sys.exc_info()[0]
+
+                # not using `issubclass(exc_type, ConnectionError)` for the condition below because some versions
+                # of urllib3 raises exception when doing `from requests.exceptions import ConnectionError`
+                error_ogg_filename = 'connerror.ogg' if 'ConnectionError' in exc_type.__name__ else 'error.ogg'
+
+                error_details = {
+                    'Audio File': os.path.join(current_dir, 'data', error_ogg_filename),
+                    'Audio Type': 'ogg',
+                    'Exception': {
+                        'Type': str(exc_type),
+                        'Module': exc_type.__module__,
+                        'Name': exc_type.__name__,
+                        'Value': str(e),
+                    },
+                    'Traceback': traceback.format_exc()
+                }
+
+                # errors returned by the service, e.g. botocore's ClientError, carry an error code
+                error_response = getattr(e, 'response', None)
+                if isinstance(error_response, dict) and 'Error' in error_response:
+                    error_details['Exception']['Code'] = error_response['Error'].get('Code')
+
+                error_str = json.dumps(error_details)
+                rospy.logerr(error_str)
+                return PollyResponse(result=error_str)
 
     def synthesize(self, **kws):
         """Call this method if you want to use polly but don't want to start a node.
@@ -385,6 +761,16 @@ class AmazonPolly:
         req = PollyRequest(polly_action='SynthesizeSpeech', **kws)
         return self._node_request_handler(req)
 
+    def describe_voices(self, language_code='', include_additional_language_codes=False, deadline=None):
+        """Call this method to list the voices without starting a node.
+
+        :param language_code: e.g. en-US, all voices if empty
+        :param include_additional_language_codes: also return the bilingual voices that speak language_code
+        :param deadline: when fetching the voices from Amazon Polly has to be done by, see ``tts.deadline``
+        :return: a list of voices as returned by Amazon Polly
+        """
+        return self.voice_catalog.voices(language_code, include_additional_language_codes, deadline)
+
     def start(self, node_name='polly_node', service_name='polly'):
         """The entry point of a ROS service node.
 
@@ -395,12 +781,25 @@ class AmazonPolly:
         :return: it doesn't return
         """
         rospy.init_node(node_name)
+        self.advertise(service_name)
+        rospy.spin()
+
+    def advertise(self, service_name='polly'):
+        """Advertise the service in the node of this process, then build the client in the background if needed.
 
+        :param service_name:  name of ROS service
+        :return: the rospy.Service
+        """
         service = rospy.Service(service_name, Polly, self._node_request_handler)
 
         rospy.loginfo('polly running: {}'.format(service.uri))
+        self.profiler.advertise(service_name)
 
-        rospy.spin()
+        if self._polly is None:
+            self.warm_up_in_background()
+        if self.endpoint_selector:
+            self.endpoint_selector.start_probing(self._probe)
+        return service
 
 
 def main():
@@ -415,13 +814,16 @@ def main():
     parser.add_option("-s", "--service-name", dest="service_name", default='polly',
                       help="name of the ROS service",
                       metavar="SERVICE_NAME")
+    parser.add_option("-d", "--cache-dir", dest="cache_dir", default='/tmp',
+                      help="directory of the voice catalogue and the lexicon index, the same as the synthesizer's",
+                      metavar="CACHE_DIR")
 
     (options, args) = parser.parse_args()
 
     node_name = options.node_name
     service_name = options.service_name
 
-    AmazonPolly().start(node_name=node_name, service_name=service_name)
+    AmazonPolly(defer_client=True, cache_dir=options.cache_dir).start(node_name=node_name, service_name=service_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Helpers for the audio files handled by the synthesizer.
+
+Amazon Polly returns pcm as signed 16-bit, 1 channel (mono), little-endian samples, which the engines save as wav.
+"""
+
+import contextlib
+import os
+import threading
+import wave
+
+
+@contextlib.contextmanager
+def publishing(filename):
+    """Write a file under a temporary name and rename it into place when done.
+
+    Readers never see a partially written file. The temporary name ends with ``.tmp`` and is unique per thread::
+
+        with publishing('/tmp/voice_123.ogg') as tmp_filename:
+            with open(tmp_filename, 'wb') as f:
+                f.write(data)
+    """
+    tmp_filename = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.current_thread().ident)
+    try:
+        yield tmp_filename
+        os.rename(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def write_wav(wav_filename, frames, sample_rate, sample_width=2, channels=1):
+    """Write raw pcm frames to a wav file."""
+    wavf = wave.open(wav_filename, 'wb')
+    try:
+        wavf.setframerate(int(sample_rate))
+        wavf.setnchannels(channels)
+        wavf.setsampwidth(sample_width)
+        wavf.writeframes(frames)
+    finally:
+        wavf.close()
+
+
+def concatenate_wav(input_filenames, output_filename):
+    """Join wav files one after another into a new wav file.
+
+    All the inputs must have the same number of channels, sample width and frame rate.
+
+    :param input_filenames: the wav files to join, in order, as file names or file objects
+    :param output_filename: where the joined audio is written
+    :return: the number of frames written
+    """
+    if not input_filenames:
+        raise ValueError('nothing to concatenate')
+
+    params = None
+    nframes = 0
+    out = wave.open(output_filename, 'wb')
+    try:
+        for fn in input_filenames:
+            wavf = wave.open(fn, 'rb')
+            try:
+                fmt = (wavf.getnchannels(), wavf.getsampwidth(), wavf.getframerate())
+                if params is None:
+                    params = fmt
+                    out.setnchannels(fmt[0])
+                    out.setsampwidth(fmt[1])
+                    out.setframerate(fmt[2])
+                elif fmt != params:
+                    raise ValueError('cannot concatenate {} with format {}, expected {}'.format(fn, fmt, params))
+                nframes += wavf.getnframes()
+                out.writeframes(wavf.readframes(wavf.getnframes()))
+            finally:
+                wavf.close()
+    finally:
+        out.close()
+    return nframes
@@ -0,0 +1,207 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Exports the synthesizer cache to a bundle and imports it on another machine.
+
+A bundle is a gzipped tar file. Its first member is ``manifest.json`` with a row for every cached utterance, i.e.
+the columns of the cache table, the name of the audio file and the sha256 of the audio. The audio follows as one
+``audio/<name>`` member per utterance, so a bundle can be imported in a single pass::
+
+    $ rosrun tts cache_bundle.py export /tmp/warm_cache.tgz
+    $ rosrun tts cache_bundle.py import /tmp/warm_cache.tgz -d /tmp
+
+Importing checks every file against the manifest, writes it to the cache directory and then adds all the rows in one
+transaction. Utterances that are already cached are left alone.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+from optparse import OptionParser
+
+from tts.audio import publishing
+
+BUNDLE_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+CHUNK_SIZE = 65536
+
+
+class BadBundleError(ValueError):
+    pass
+
+
+def _add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export_bundle(db, bundle_path):
+    """Write every utterance of a cache to a bundle.
+
+    The audio is read without extracting it, so exporting a packed cache leaves its loose copies alone. Utterances
+    whose audio is lost, e.g. because they are evicted while exporting, are skipped.
+
+    :param db: the cache DB
+    :param bundle_path: where to write the bundle
+    :return: the number of utterances exported
+    """
+    entries = []
+    for row in db.ex('SELECT * FROM cache ORDER BY last_accessed').fetchall():
+        data = db.read_audio(row['hash'], row['file'])
+        if data is None:
+            continue
+        entries.append({
+            'hash': row['hash'],
+            'name': os.path.basename(row['file']),
+            'audio_type': row['audio_type'],
+            'size': len(data),
+            'access_count': row['access_count'],
+            'synth_latency': row['synth_latency'],
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'file': row['file'],
+        })
+
+    manifest = json.dumps({
+        'version': BUNDLE_VERSION,
+        'utterances': [dict((k, v) for k, v in e.items() if k != 'file') for e in entries],
+    }, indent=1).encode('utf-8')
+
+    with publishing(bundle_path) as tmp_path:
+        with tarfile.open(tmp_path, 'w:gz') as tar:
+            _add_member(tar, MANIFEST_NAME, manifest)
+            for e in entries:
+                data = db.read_audio(e['hash'], e['file'])
+                if data is None or hashlib.sha256(data).hexdigest() != e['sha256']:
+                    raise IOError('the audio of {} changed while exporting'.format(e['file']))
+                _add_member(tar, 'audio/' + e['name'], data)
+    return len(entries)
+
+
+def import_bundle(db, bundle_path, cache_dir='/tmp', eviction_policy=None):
+    """Add the utterances of a bundle to a cache.
+
+    The audio files are saved in cache_dir. Rows are only added once every file has been checked, so a corrupt
+    bundle adds nothing.
+
+    :param db: the cache DB
+    :param bundle_path: the bundle written by export_bundle
+    :param cache_dir: the directory of the cache
+    :param eviction_policy: the EvictionPolicy managing the cache, it sets the priority of the imported utterances.
+                            Without one the priority is the time of the import, as with LRU.
+    :return: the number of utterances imported
+    """
+    now = time.time()
+    known = set(r['hash'] for r in db.ex('SELECT hash FROM cache').fetchall())
+    rows = []
+    written = []
+    try:
+        with tarfile.open(bundle_path, 'r|gz') as tar:
+            member = tar.next()
+            if member is None or member.name != MANIFEST_NAME:
+                raise BadBundleError('{} has no manifest'.format(bundle_path))
+            manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+            if manifest.get('version') != BUNDLE_VERSION:
+                raise BadBundleError('unsupported bundle version {}'.format(manifest.get('version')))
+            entries = dict(('audio/' + e['name'], e) for e in manifest['utterances'])
+
+            member = tar.next()
+            while member is not None:
+                e = entries.pop(member.name, None)
+                if e is None or not member.isfile():
+                    raise BadBundleError('unexpected member {} in {}'.format(member.name, bundle_path))
+                name = os.path.basename(e['name'])
+                if e['hash'] in known or not name:
+                    member = tar.next()
+                    continue
+                filename = os.path.join(cache_dir, name)
+                sha = hashlib.sha256()
+                size = 0
+                src = tar.extractfile(member)
+                with publishing(filename) as tmp_filename:
+                    with open(tmp_filename, 'wb') as f:
+                        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                            sha.update(chunk)
+                            size += len(chunk)
+                            f.write(chunk)
+                    if sha.hexdigest() != e['sha256'] or size != e['size']:
+                        raise BadBundleError('checksum mismatch for {} in {}'.format(name, bundle_path))
+                written.append(filename)
+
+                priority = now
+                if eviction_policy is not None:
+                    priority = eviction_policy.priority(now, e['access_count'], size, e['synth_latency'])
+                rows.append({'hash': e['hash'], 'file': filename, 'audio_type': e['audio_type'],
+                             'last_accessed': now, 'size': size, 'access_count': e['access_count'],
+                             'synth_latency': e['synth_latency'], 'priority': priority})
+                member = tar.next()
+            if entries:
+                raise BadBundleError('{} is missing {} audio files'.format(bundle_path, len(entries)))
+
+        with db.eviction_lock():
+            db.add_files(rows)
+    except BaseException:
+        for filename in written:
+            if os.path.exists(filename):
+                os.remove(filename)
+        raise
+    return len(rows)
+
+
+def main():
+    from tts.synthesizer import SpeechSynthesizer
+    from tts.eviction import make_policy
+
+    usage = '''usage: %prog [options] export|import BUNDLE
+
+    Exports the synthesizer cache to a bundle, or imports a bundle into the cache.
+    '''
+
+    parser = OptionParser(usage)
+
+    parser.add_option("-d", "--cache-dir", dest="cache_dir", default='/tmp',
+                      help="directory of the cache and its database",
+                      metavar="CACHE_DIR")
+    parser.add_option("-c", "--cache-storage", dest="cache_storage", default='file',
+                      help="how the cache stores the audio: file or pack",
+                      metavar="CACHE_STORAGE")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 2 or args[0] not in ('export', 'import'):
+        parser.error('expecting export or import and a bundle')
+    if options.cache_storage not in SpeechSynthesizer.CACHE_STORAGES:
+        parser.error('bad cache storage {}'.format(options.cache_storage))
+
+    db_kwargs = {'db_location': os.path.join(options.cache_dir, 'polly.db')}
+    if options.cache_storage == 'pack':
+        db_kwargs['pack_location'] = os.path.join(options.cache_dir, 'polly.pack')
+    db = SpeechSynthesizer.CACHE_STORAGES[options.cache_storage](**db_kwargs)
+
+    command, bundle_path = args
+    if command == 'export':
+        print('exported {} utterances to {}'.format(export_bundle(db, bundle_path), bundle_path))
+    else:
+        policy = make_policy(db.get_setting('eviction_policy', 'lru'))
+        policy.attach(db)
+        print('imported {} utterances from {}'.format(
+            import_bundle(db, bundle_path, options.cache_dir, policy), bundle_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Records cache access traces and replays them through the synthesizer cache.
+
+A trace is a sequence of ``TraceRecord``. A synthesizer started with a trace file appends a record for every
+request to its cache with a ``TraceWriter``; the file is CSV with one ``timestamp,key,size,hit,latency`` line per
+request. The simulator replays such a file against different cache sizes and eviction policies::
+
+    $ rosrun tts cache_simulator.py /tmp/polly_trace.csv -b 1000000,10000000,100000000 -v lru,gds
+
+Replaying it runs every request through ``SpeechSynthesizer._call_engine`` with a ``ReplayEngine``, so lookups,
+insertions and evictions are done by the same code as in the node. The engine only writes sparse files of the
+recorded sizes and advances a virtual clock by the recorded synthesis latencies, so a long trace replays in a
+fraction of its duration.
+"""
+
+from __future__ import print_function
+
+import collections
+import csv
+import json
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from optparse import OptionParser
+
+from tts.srv import SynthesizerResponse
+
+TraceRecord = collections.namedtuple('TraceRecord', 'timestamp key size hit latency')
+
+
+class TraceWriter(object):
+    """Appends TraceRecord lines to a CSV file, safe to use from several threads."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', 1)  # line buffered
+
+    def record(self, timestamp, key, size, hit, latency):
+        line = '{:.6f},{},{},{},{:.6f}\n'.format(timestamp, key, size, int(hit), latency)
+        with self._lock:
+            self._file.write(line)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_trace(path):
+    """Yield the TraceRecord of a trace file written by TraceWriter."""
+    with open(path) as f:
+        for row in csv.reader(f):
+            if row:
+                yield TraceRecord(float(row[0]), row[1], int(row[2]), row[3] == '1', float(row[4]))
+
+
+class VirtualClock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class ReplayEngine(object):
+    """An engine that pretends to synthesize the utterances of a trace.
+
+    The text of a request is the key of a trace record. The engine creates a sparse file with the recorded size and
+    advances the clock by the recorded latency.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.utterances = {}
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        size, latency = self.utterances[kwargs['text']]
+        with open(kwargs['output_path'], 'wb') as f:
+            f.truncate(size)
+        self.clock.advance(latency)
+        self.calls += 1
+        return SynthesizerResponse(json.dumps({
+            'Audio File': kwargs['output_path'],
+            'Audio Type': 'audio/ogg',
+            'Amazon Polly Response Metadata': ''
+        }))
+
+
+def replay(trace, max_cache_bytes, eviction_policy='lru'):
+    """Replay a trace against an empty cache.
+
+    :param trace: an iterable of TraceRecord
+    :param max_cache_bytes: the size of the cache
+    :param eviction_policy: the name of the eviction policy
+    :return: a dict with the number of requests and hits, the bytes served from the cache, the synthesis latency
+             paid on misses and the synthesis latency saved by hits
+    """
+    from tts.synthesizer import SpeechSynthesizer
+
+    cache_dir = tempfile.mkdtemp(prefix='tts_replay_')
+    try:
+        clock = VirtualClock()
+        synthesizer = SpeechSynthesizer(engine='DUMMY', max_cache_bytes=max_cache_bytes,
+                                        eviction_policy=eviction_policy, cache_dir=cache_dir)
+        synthesizer.engine = ReplayEngine(clock)
+        synthesizer.clock = clock
+
+        results = {'requests': 0, 'hits': 0, 'bytes_requested': 0, 'bytes_hit': 0, 'latency': 0.0,
+                   'latency_saved': 0.0}
+        utterances = synthesizer.engine.utterances
+        for record in trace:
+            clock.now = max(clock.now, record.timestamp)
+            # a recorded hit has no synthesis latency, so keep what the last miss recorded
+            if not record.hit or record.key not in utterances:
+                utterances[record.key] = (record.size, record.latency)
+            size, latency = utterances[record.key]
+
+            calls = synthesizer.engine.calls
+            synthesizer._call_engine(text=record.key, text_type='text', voice_id='Joanna',
+                                     output_format='ogg_vorbis', sample_rate='22050')
+            results['requests'] += 1
+            results['bytes_requested'] += size
+            if synthesizer.engine.calls == calls:
+                results['hits'] += 1
+                results['bytes_hit'] += size
+                results['latency_saved'] += latency
+            else:
+                results['latency'] += latency
+
+        requests = max(results['requests'], 1)
+        results['hit_ratio'] = float(results['hits']) / requests
+        results['byte_hit_ratio'] = float(results['bytes_hit']) / max(results['bytes_requested'], 1)
+        return results
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def synthetic_trace(num_requests, num_utterances, zipf_alpha=0.8, seed=0):
+    """Generate a trace of requests to utterances with Zipf distributed popularity.
+
+    Most utterances are short prompts of a few KB. One in ten is a paragraph of hundreds of KB. The synthesis
+    latency grows with the size of the audio. The popularity rank is independent of the size.
+
+    :return: a list of TraceRecord with one request per second
+    """
+    rng = random.Random(seed)
+    utterances = []
+    for i in range(num_utterances):
+        if rng.random() < 0.1:
+            size = rng.randint(200000, 2000000)
+        else:
+            size = rng.randint(3000, 30000)
+        latency = 0.15 + size / 1000000.0 + rng.random() * 0.1
+        utterances.append(('utterance{}'.format(i), size, latency))
+    rng.shuffle(utterances)
+
+    weights = [1.0 / (rank + 1) ** zipf_alpha for rank in range(num_utterances)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+
+    trace = []
+    for t in range(num_requests):
+        r = rng.random()
+        lo, hi = 0, num_utterances - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        key, size, latency = utterances[lo]
+        trace.append(TraceRecord(float(t), key, size, False, latency))
+    return trace
+
+
+def main():
+    usage = '''usage: %prog [options] TRACE_FILE
+
+    Replays a trace for every combination of cache size and eviction policy and prints
+    one CSV line per combination, i.e. the hit ratio and latency curves over cache size.
+    '''
+
+    parser = OptionParser(usage)
+
+    parser.add_option("-b", "--cache-bytes", dest="cache_bytes", default='1000000,10000000,100000000',
+                      help="comma separated cache sizes in bytes",
+                      metavar="CACHE_BYTES")
+    parser.add_option("-v", "--eviction-policies", dest="eviction_policies", default='lru,lfu,gds,gdsf',
+                      help="comma separated eviction policies",
+                      metavar="EVICTION_POLICIES")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expecting exactly one trace file')
+
+    trace = list(read_trace(args[0]))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['eviction_policy', 'max_cache_bytes', 'requests', 'hit_ratio', 'byte_hit_ratio',
+                     'mean_synth_latency', 'latency_saved'])
+    for policy in options.eviction_policies.split(','):
+        for max_cache_bytes in sorted(int(b) for b in options.cache_bytes.split(',')):
+            r = replay(trace, max_cache_bytes, policy)
+            writer.writerow([policy, max_cache_bytes, r['requests'], '{:.4f}'.format(r['hit_ratio']),
+                             '{:.4f}'.format(r['byte_hit_ratio']),
+                             '{:.4f}'.format(r['latency'] / max(r['requests'], 1)),
+                             '{:.2f}'.format(r['latency_saved'])])
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,89 @@
 
 from __future__ import print_function
 import sqlite3
+import fcntl
 import json
 import os.path
+import threading
+import time
 from os import mkdir
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import rospy
+from tts.audio import publishing
+
+# fcntl locks are held by processes, so threads of the same process are
+# serialized with a thread lock per locked byte
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+# the databases whose schema this process has set up, by class and location
+_made_dbs = set()
+_made_dbs_guard = threading.Lock()
+
+
+class InterProcessLock(object):
+    """InterProcessLock locks one byte of a lock file
+
+    The lock excludes other processes and other threads of this process.
+    Several independent locks can share a lock file by using different
+    indices.
+    """
+
+    def __init__(self, path, index=0):
+        self.path = path
+        self.index = index
+        with _thread_locks_guard:
+            self._thread_lock = _thread_locks.setdefault((path, index), threading.Lock())
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self.index)
+        except Exception:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.index)
+            os.close(self._fd)
+        finally:
+            self._fd = None
+            self._thread_lock.release()
 
 
 class DB(object):
-    """DB a class to manage the database for tracking cached files"""
+    """DB a class to manage the database for tracking cached files
+
+    Several processes can share a database. It is opened in WAL mode so
+    readers do not block the writer, and a connection waits for up to
+    ``BUSY_TIMEOUT`` seconds for a lock held by another connection. Work
+    that must not interleave is done under an InterProcessLock on
+    ``<db_location>.lock``: byte 0 for eviction and schema changes, and
+    one of ``SYNTHESIS_LOCK_STRIPES`` bytes per cache key so that an
+    utterance is only synthesized by one process at a time. The schema is
+    only set up, under the eviction lock, by the first connection of a
+    process, so a connection per request just sets its PRAGMAs.
+
+    Pinned rows are never evicted. The ``cache_eviction`` index on
+    ``(pinned, priority)`` finds the next victim among the unpinned rows
+    without a scan. Summing the sizes still reads every row, so an
+    eviction sums them once and subtracts the size of each victim.
+    """
+
+    BUSY_TIMEOUT = 30.0
+    SYNTHESIS_LOCK_STRIPES = 256
 
     def __init__(self, db_location='/tmp/polly.db'):
         """Sets up and returns the database for tracking cached files
@@ -25,11 +100,12 @@ class DB(object):
         db_location = os.path.expanduser(db_location)
 
         dir_name = os.path.dirname(db_location)
-        if not os.path.exists(dir_name):
+        if dir_name and not os.path.exists(dir_name):
             mkdir(dir_name)
 
+        self.lock_location = db_location + '.lock'
         try:
-            self.conn = sqlite3.connect(db_location)
+            self.conn = sqlite3.connect(db_location, timeout=self.BUSY_TIMEOUT)
         except sqlite3.OperationalError as e:
             rospy.logerr(
                 "unable to connect to database at location: %s",
@@ -37,7 +113,29 @@ class DB(object):
             rospy.logerr("error: %s", format(e))
             raise
         self.conn.row_factory = sqlite3.Row
-        self.make_db()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # a database is opened for every request, the schema only needs to
+        # be checked the first time in a process. A database that was
+        # deleted since is new again and has no user_version.
+        key = (type(self), db_location)
+        with _made_dbs_guard:
+            if key not in _made_dbs or not self.conn.execute('PRAGMA user_version').fetchone()[0]:
+                with self.eviction_lock():
+                    self.make_db()
+                _made_dbs.add(key)
+
+    def eviction_lock(self):
+        """Return a lock to hold while evicting or changing the schema"""
+        return InterProcessLock(self.lock_location, 0)
+
+    def synthesis_lock(self, hash):
+        """Return a lock to hold while looking up and synthesizing an utterance
+
+        Args:
+            hash: the cache key of the utterance
+        """
+        return InterProcessLock(self.lock_location, 1 + int(hash[:8], 16) % self.SYNTHESIS_LOCK_STRIPES)
 
     def ex(self, command, *args):
         """ex execute the passed in command and save it to the
@@ -57,17 +155,137 @@ class DB(object):
                 to_return = self.conn.execute(command)
         return to_return
 
-    def get_size(self):
+    def get_size(self, pinned=None):
         """Return the sum size of the files in the database
 
         Note: the actual on disk size could be smaller if files have
         been deleted without notifying the database. This will self
-        resolve with time."""
-        return self.ex('SELECT COALESCE(SUM(size),0) FROM cache').fetchone()[0]
+        resolve with time, and quickly if a CacheReconciler is running.
+
+        Args:
+            pinned: True or False for the pinned or unpinned files only"""
+        if pinned is None:
+            return self.ex('SELECT COALESCE(SUM(size),0) FROM cache').fetchone()[0]
+        return self.ex('SELECT COALESCE(SUM(size),0) FROM cache WHERE pinned=?', int(pinned)).fetchone()[0]
+
+    def get_num_files(self, pinned=None):
+        """Return the number of files cached in the database
+
+        Args:
+            pinned: True or False for the pinned or unpinned files only"""
+        if pinned is None:
+            return self.ex('SELECT Count(*) FROM cache').fetchone()[0]
+        return self.ex('SELECT Count(*) FROM cache WHERE pinned=?', int(pinned)).fetchone()[0]
+
+    def add_file(self, hash, fn, audio_type, last_accessed, size, synth_latency=0.0, priority=None):
+        """Record a newly synthesized file in the database
+
+        Args:
+            hash: the cache key of the utterance
+            fn: the filename of the audio
+            audio_type: the type of the audio as reported by the engine
+            last_accessed: the time of the request
+            size: the size of the file in bytes
+            synth_latency: how many seconds the synthesis took
+            priority: the eviction priority, last_accessed if not given
+
+        A pinned utterance that is added again stays pinned.
+        """
+        if priority is None:
+            priority = last_accessed
+        # a row that is replaced stays pinned, UPSERT needs a newer sqlite than ROS ships with
+        self.ex('''insert or replace into cache(
+            hash, file, audio_type, last_accessed, size, access_count, synth_latency, priority, pinned)
+            values (?,?,?,?,?,1,?,?,COALESCE((SELECT pinned FROM cache WHERE hash=?),0))''',
+                hash, fn, audio_type, last_accessed, size, synth_latency, priority, hash)
 
-    def get_num_files(self):
-        """Return the number of files cached in the database"""
-        return self.ex('SELECT Count(*) FROM cache').fetchone()[0]
+    def add_files(self, rows):
+        """Record many files at once in a single transaction
+
+        Args:
+            rows: dicts with the columns of the cache table, hash, file,
+                audio_type, last_accessed, size, access_count,
+                synth_latency and priority
+        """
+        with self.conn:
+            self.conn.executemany('''insert or replace into cache(
+                hash, file, audio_type, last_accessed, size, access_count, synth_latency, priority, pinned)
+                values (:hash,:file,:audio_type,:last_accessed,:size,:access_count,:synth_latency,:priority,
+                COALESCE((SELECT pinned FROM cache WHERE hash=:hash),0))''', rows)
+
+    def touch(self, hash, last_accessed, priority):
+        """Record a cache hit
+
+        Args:
+            hash: the cache key of the utterance
+            last_accessed: the time of the request
+            priority: the new eviction priority
+        """
+        self.ex('UPDATE cache SET last_accessed=?, access_count=access_count+1, priority=? WHERE hash=?',
+                last_accessed, priority, hash)
+
+    def pin(self, hash, pinned=True):
+        """Pin an utterance so that it is never evicted, or unpin it
+
+        Args:
+            hash: the cache key of the utterance
+            pinned: False to unpin
+
+        Returns: whether the utterance is in the database
+        """
+        return self.ex('UPDATE cache SET pinned=? WHERE hash=?', int(pinned), hash).rowcount > 0
+
+    def get_setting(self, key, default=None):
+        """Return a value stored in the settings table"""
+        row = self.ex('SELECT value FROM settings WHERE key=?', key).fetchone()
+        return default if row is None else row['value']
+
+    def set_setting(self, key, value):
+        """Store a value in the settings table"""
+        self.ex('INSERT OR REPLACE INTO settings(key, value) VALUES (?,?)', key, value)
+
+    def ensure_file(self, hash, fn):
+        """Make sure the cached audio for an utterance can be played from fn
+
+        Args:
+            hash: the cache key of the utterance
+            fn: the filename recorded for the utterance
+
+        Returns: True if the file is there, False if the audio is lost
+        """
+        return os.path.exists(fn)
+
+    def read_audio(self, hash, fn):
+        """Return the cached audio of an utterance without extracting it
+
+        Args:
+            hash: the cache key of the utterance
+            fn: the filename recorded for the utterance
+
+        Returns: the audio as bytes, None if the audio is lost
+        """
+        try:
+            with open(fn, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def unextracted(self, hashes):
+        """Return the hashes of utterances that are stored without a loose file
+
+        Args:
+            hashes: the cache keys to look at
+        """
+        return set()
+
+    def forget_files(self, rows):
+        """Drop rows whose file has disappeared from the disk
+
+        Args:
+            rows: rows of the cache table with at least a hash column
+        """
+        with self.conn:
+            self.conn.executemany('DELETE FROM cache WHERE hash=?', [(r['hash'],) for r in rows])
 
     def remove_file(self, fn):
         """Remove a file from the database and delete the file
@@ -85,7 +303,17 @@ class DB(object):
         self.ex('delete from cache where file=?', fn)
 
     def __del__(self):
-        self.conn.close()
+        # the connection is missing if connecting failed
+        if hasattr(self, 'conn'):
+            self.conn.close()
+
+    # columns added after the first release, with what existing rows get
+    MIGRATED_COLUMNS = (
+        ('access_count', 'integer NOT NULL DEFAULT 1', None),
+        ('synth_latency', 'real NOT NULL DEFAULT 0', None),
+        ('priority', 'real NOT NULL DEFAULT 0', 'last_accessed'),
+        ('pinned', 'integer NOT NULL DEFAULT 0', None),
+    )
 
     def make_db(self):
         self.ex('''CREATE TABLE IF NOT EXISTS cache (
@@ -93,5 +321,461 @@ class DB(object):
             file text NOT NULL,
             audio_type text NOT NULL,
             last_accessed integer NOT NULL,
-            size integer NOT NULL
+            size integer NOT NULL,
+            access_count integer NOT NULL DEFAULT 1,
+            synth_latency real NOT NULL DEFAULT 0,
+            priority real NOT NULL DEFAULT 0,
+            pinned integer NOT NULL DEFAULT 0
+            );''')
+        columns = set(r['name'] for r in self.ex('PRAGMA table_info(cache)').fetchall())
+        for name, definition, initial in self.MIGRATED_COLUMNS:
+            if name not in columns:
+                self.ex('ALTER TABLE cache ADD COLUMN {} {}'.format(name, definition))
+                if initial:
+                    self.ex('UPDATE cache SET {}={}'.format(name, initial))
+        self.ex('CREATE INDEX IF NOT EXISTS cache_priority ON cache(priority)')
+        self.ex('CREATE INDEX IF NOT EXISTS cache_eviction ON cache(pinned, priority)')
+        self.ex('''CREATE TABLE IF NOT EXISTS settings (
+            key text PRIMARY KEY,
+            value text
+            );''')
+        self.ex('PRAGMA user_version=1')
+
+
+class PackedDB(DB):
+    """PackedDB keeps the cached audio inside a single append-only pack file
+
+    Writing one file per utterance costs an inode, a directory entry and a
+    stat on every hit. Here the audio of each utterance is appended to a
+    pack file and the ``pack`` table maps its hash to an offset and a
+    length. A loose copy of the file only exists while it is needed for
+    playback: at most ``max_extracted_files`` of the most recently used
+    utterances are kept on disk and the others are extracted again from
+    the pack on their next hit.
+
+    Removing an utterance only drops its index row. The space it took in
+    the pack is reclaimed by ``compact`` once more than
+    ``compact_ratio`` of the pack is garbage.
+    """
+
+    def __init__(self, db_location='/tmp/polly.db', pack_location='/tmp/polly.pack', max_extracted_files=32,
+                 compact_ratio=0.5):
+        self.pack_location = os.path.expanduser(pack_location)
+        self.max_extracted_files = max_extracted_files
+        self.compact_ratio = compact_ratio
+        super(PackedDB, self).__init__(db_location)
+
+    def pack_lock(self):
+        """Return the lock serializing appends, extractions and compactions
+
+        Offsets are only valid between an append and the next compaction.
+        """
+        return InterProcessLock(self.pack_location + '.lock')
+
+    def make_db(self):
+        super(PackedDB, self).make_db()
+        self.ex('''CREATE TABLE IF NOT EXISTS pack (
+            hash text PRIMARY KEY,
+            offset integer NOT NULL,
+            length integer NOT NULL,
+            extracted integer NOT NULL
             );''')
+
+    def add_file(self, hash, fn, audio_type, last_accessed, size, synth_latency=0.0, priority=None):
+        """Record a newly synthesized file and append its audio to the pack
+
+        The file itself is left in place as the first extracted copy.
+        """
+        super(PackedDB, self).add_file(hash, fn, audio_type, last_accessed, size, synth_latency, priority)
+        with open(fn, 'rb') as f:
+            data = f.read()
+        with self.pack_lock():
+            with open(self.pack_location, 'ab') as pack:
+                pack.seek(0, os.SEEK_END)
+                offset = pack.tell()
+                pack.write(data)
+            self.ex('INSERT OR REPLACE INTO pack(hash, offset, length, extracted) VALUES (?,?,?,1)',
+                    hash, offset, len(data))
+        self.trim_extracted(keep=hash)
+
+    def add_files(self, rows):
+        """Record many files at once and append all their audio to the pack
+
+        The loose files are deleted once they are in the pack, except for
+        the most recently used ones.
+        """
+        super(PackedDB, self).add_files(rows)
+        packed = []
+        with self.pack_lock():
+            with open(self.pack_location, 'ab') as pack:
+                pack.seek(0, os.SEEK_END)
+                for row in rows:
+                    with open(row['file'], 'rb') as f:
+                        data = f.read()
+                    packed.append((row['hash'], pack.tell(), len(data)))
+                    pack.write(data)
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO pack(hash, offset, length, extracted) VALUES (?,?,?,1)',
+                                      packed)
+        self.trim_extracted()
+
+    def ensure_file(self, hash, fn):
+        """Extract the audio from the pack if there is no loose copy of it
+
+        A loose copy that was deleted behind the cache's back, e.g. by a
+        cleaner of /tmp, is extracted again.
+        """
+        row = self.ex('SELECT offset, length, extracted FROM pack WHERE hash=?', hash).fetchone()
+        if row is None:
+            return super(PackedDB, self).ensure_file(hash, fn)
+        if row['extracted'] and os.path.exists(fn):
+            return True
+        with self.pack_lock():
+            # the offset may have been moved by a compaction in the meantime
+            row = self.ex('SELECT offset, length FROM pack WHERE hash=?', hash).fetchone()
+            if row is None:
+                return False
+            with open(self.pack_location, 'rb') as pack:
+                pack.seek(row['offset'])
+                data = pack.read(row['length'])
+        if len(data) != row['length']:
+            return False
+        with publishing(fn) as tmp_fn:
+            with open(tmp_fn, 'wb') as f:
+                f.write(data)
+        self.ex('UPDATE pack SET extracted=1 WHERE hash=?', hash)
+        self.trim_extracted(keep=hash)
+        return True
+
+    def read_audio(self, hash, fn):
+        """Read the audio from the pack, leaving the loose copies alone"""
+        with self.pack_lock():
+            row = self.ex('SELECT offset, length FROM pack WHERE hash=?', hash).fetchone()
+            if row is None:
+                return super(PackedDB, self).read_audio(hash, fn)
+            with open(self.pack_location, 'rb') as pack:
+                pack.seek(row['offset'])
+                data = pack.read(row['length'])
+        return data if len(data) == row['length'] else None
+
+    def trim_extracted(self, keep=None):
+        """Delete the loose copies of all but the most recently used utterances
+
+        Args:
+            keep: the hash of an utterance that is about to be played and must stay extracted
+        """
+        stale = self.ex('''SELECT cache.hash, cache.file FROM cache JOIN pack ON cache.hash = pack.hash
+            WHERE pack.extracted=1 AND cache.hash IS NOT ? ORDER BY cache.last_accessed DESC LIMIT -1 OFFSET ?''',
+                        keep, max(self.max_extracted_files - (keep is not None), 0)).fetchall()
+        for row in stale:
+            if os.path.exists(row['file']):
+                os.remove(row['file'])
+            self.ex('UPDATE pack SET extracted=0 WHERE hash=?', row['hash'])
+
+    def unextracted(self, hashes):
+        """Return the hashes of packed utterances that have no loose copy"""
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        return set(r['hash'] for r in self.ex(
+            'SELECT hash FROM pack WHERE extracted=0 AND hash IN ({})'.format(','.join('?' * len(hashes))),
+            *hashes).fetchall())
+
+    def forget_files(self, rows):
+        """Mark packed utterances as not extracted and drop the others"""
+        hashes = [r['hash'] for r in rows]
+        packed = set(r['hash'] for r in self.ex(
+            'SELECT hash FROM pack WHERE hash IN ({})'.format(','.join('?' * len(hashes))), *hashes).fetchall())
+        with self.conn:
+            self.conn.executemany('UPDATE pack SET extracted=0 WHERE hash=?',
+                                  [(r['hash'],) for r in rows if r['hash'] in packed])
+        super(PackedDB, self).forget_files([r for r in rows if r['hash'] not in packed])
+
+    def remove_file(self, fn):
+        """Remove a file from the database, the pack index and the disk"""
+        row = self.ex('SELECT hash FROM cache WHERE file=?', fn).fetchone()
+        if row is not None:
+            self.ex('DELETE FROM pack WHERE hash=?', row['hash'])
+        super(PackedDB, self).remove_file(fn)
+        if self.get_garbage_ratio() > self.compact_ratio:
+            self.compact()
+
+    def get_pack_size(self):
+        """Return the size of the pack file on disk"""
+        return os.path.getsize(self.pack_location) if os.path.exists(self.pack_location) else 0
+
+    def get_garbage_ratio(self):
+        """Return the fraction of the pack file not used by any utterance"""
+        pack_size = self.get_pack_size()
+        if not pack_size:
+            return 0.0
+        live = self.ex('SELECT COALESCE(SUM(length),0) FROM pack').fetchone()[0]
+        return float(pack_size - live) / pack_size
+
+    def compact(self):
+        """Rewrite the pack file with only the audio still in the index
+
+        The new pack is written next to the old one and renamed over it,
+        so a crash in the middle leaves the old pack intact.
+        """
+        with self.pack_lock():
+            rows = self.ex('SELECT hash, offset, length FROM pack ORDER BY offset').fetchall()
+            tmp_location = self.pack_location + '.compact'
+            new_offsets = []
+            with open(self.pack_location, 'rb') as old, open(tmp_location, 'wb') as new:
+                for row in rows:
+                    old.seek(row['offset'])
+                    new_offsets.append((new.tell(), row['hash']))
+                    new.write(old.read(row['length']))
+            with self.conn:
+                self.conn.executemany('UPDATE pack SET offset=? WHERE hash=?', new_offsets)
+                os.rename(tmp_location, self.pack_location)
+        rospy.loginfo('compacted %s, %i utterances kept', self.pack_location, len(rows))
+
+
+class CacheReconciler(object):
+    """CacheReconciler keeps the cache table in line with the cache directory
+
+    The size column is only written when a file is cached, so files that
+    are deleted or replaced behind the synthesizer's back make
+    ``DB.get_size`` wrong, and files that never made it into the table
+    are never evicted. The reconciler walks both sides a batch at a time
+    from a background thread:
+
+    * rows whose file is gone are dropped and rows whose file changed
+      size get the size of the file on disk. The inode and mtime of every
+      file seen are remembered so unchanged files are not written again.
+    * ``voice_*`` files in the cache directory that have no row and have
+      not been modified for ``grace_period`` seconds (they may still be
+      being synthesized) are deleted. The directory is only listed again
+      once its own inode or mtime has changed.
+
+    Packed utterances whose loose copy was trimmed are not missing, their
+    audio is still in the pack.
+
+    ``total_bytes`` holds the size of the cached audio as of the last
+    complete pass over the table, pinned or not. ``estimated_bytes`` adds
+    what this process cached since, so the synthesizer can tell that the
+    cache is within its limit without summing the table. Files cached by
+    other processes are only counted from the next pass on.
+    """
+
+    FILE_PREFIX = 'voice_'
+
+    def __init__(self, open_db, cache_dir='/tmp', batch_size=100, interval=1.0, grace_period=60.0):
+        """
+        Args:
+            open_db: a callable returning a new DB, called from the reconciler thread
+            cache_dir: the directory the cached files are written to
+            batch_size: how many rows or files are looked at in one step
+            interval: seconds to wait between steps
+            grace_period: how old an orphaned file has to be before it is deleted
+        """
+        self.open_db = open_db
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace_period = grace_period
+        self.total_bytes = None
+
+        self._added_bytes = 0
+        self._added_lock = threading.Lock()
+        self._seen = {}
+        self._pass_seen = {}
+        self._row_cursor = 0
+        self._pass_bytes = 0
+        self._dir_stamp = None
+        self._dir_entries = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start reconciling in a daemon thread"""
+        self._thread = threading.Thread(target=self._run, name='cache_reconciler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the reconciler thread and wait for it to finish its step"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def added(self, size):
+        """Count a file this process just cached until the next pass has seen it"""
+        with self._added_lock:
+            self._added_bytes += size
+
+    def estimated_bytes(self):
+        """Return the size of the cached audio now, None before the first complete pass"""
+        if self.total_bytes is None:
+            return None
+        with self._added_lock:
+            return self.total_bytes + self._added_bytes
+
+    def _run(self):
+        db = self.open_db()
+        while not self._stop.is_set():
+            try:
+                self.step(db)
+            except Exception as e:
+                rospy.logwarn('cache reconciliation failed: %s', e)
+            self._stop.wait(self.interval)
+
+    def step(self, db):
+        """Reconcile one batch of rows and one batch of directory entries
+
+        Returns: the number of rows dropped plus the number of files deleted
+        """
+        return self._reconcile_rows(db) + self._reconcile_dir(db)
+
+    def _reconcile_rows(self, db):
+        rows = db.ex('SELECT rowid, hash, file, size FROM cache WHERE rowid>? ORDER BY rowid LIMIT ?',
+                     self._row_cursor, self.batch_size).fetchall()
+        unextracted = db.unextracted(r['hash'] for r in rows)
+        dead = []
+        resized = []
+        for row in rows:
+            if row['hash'] in unextracted:
+                self._pass_bytes += row['size']
+                continue
+            try:
+                st = os.stat(row['file'])
+            except OSError:
+                dead.append(row)
+                continue
+            stamp = (st.st_ino, st.st_mtime, st.st_size)
+            if self._seen.get(row['file']) != stamp and st.st_size != row['size']:
+                resized.append((st.st_size, row['hash']))
+            self._pass_seen[row['file']] = stamp
+            self._pass_bytes += st.st_size
+
+        if dead:
+            db.forget_files(dead)
+            rospy.loginfo('reconciler forgot %i cached files missing from the disk', len(dead))
+        if resized:
+            with db.conn:
+                db.conn.executemany('UPDATE cache SET size=? WHERE hash=?', resized)
+            rospy.loginfo('reconciler corrected the size of %i cached files', len(resized))
+
+        if len(rows) < self.batch_size:
+            # a full pass over the table is done, forget about files that are not cached any more
+            with self._added_lock:
+                self.total_bytes = self._pass_bytes
+                self._added_bytes = 0
+            self._seen = self._pass_seen
+            self._pass_seen = {}
+            self._pass_bytes = 0
+            self._row_cursor = 0
+        else:
+            self._row_cursor = rows[-1]['rowid']
+        return len(dead)
+
+    def _reconcile_dir(self, db):
+        if not self._dir_entries:
+            st = os.stat(self.cache_dir)
+            stamp = (st.st_ino, st.st_mtime)
+            if stamp == self._dir_stamp:
+                return 0
+            self._dir_stamp = stamp
+            self._dir_entries = [os.path.join(self.cache_dir, fn) for fn in os.listdir(self.cache_dir)
+                                 if fn.startswith(self.FILE_PREFIX) and not fn.endswith('.tmp')]
+
+        batch = self._dir_entries[:self.batch_size]
+        del self._dir_entries[:self.batch_size]
+
+        known = set(r['file'] for r in db.ex(
+            'SELECT file FROM cache WHERE file IN ({})'.format(','.join('?' * len(batch))), *batch).fetchall())
+        now = time.time()
+        removed = 0
+        for fn in batch:
+            if fn in known:
+                continue
+            try:
+                if now - os.stat(fn).st_mtime < self.grace_period:
+                    # probably being synthesized right now, look at it again on the next listing
+                    self._dir_stamp = None
+                    continue
+                os.remove(fn)
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            rospy.loginfo('reconciler deleted %i orphaned files from %s', removed, self.cache_dir)
+        return removed
+
+
+class CacheWriter(object):
+    """CacheWriter does the bookkeeping of a cache from a background thread
+
+    Recording a new file, touching a hit and evicting are queued as tasks
+    taking the DB and run in order by a single writer thread, so a request
+    returns as soon as its audio is on disk. The queue is bounded: when
+    the writer falls behind, requests wait for room rather than losing
+    bookkeeping.
+
+    Until the task recording a new file has run, the row it will insert
+    is returned by ``pending``, so the utterance is a hit for this process
+    in the meantime. Other processes sharing the cache only see it once
+    it is written.
+    """
+
+    def __init__(self, open_db, max_pending=1000):
+        """
+        Args:
+            open_db: a callable returning a new DB, called from the writer thread
+            max_pending: how many tasks can be queued
+        """
+        self.open_db = open_db
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='cache_writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, task, hash=None, row=None):
+        """Queue a task
+
+        Args:
+            task: a callable taking the DB
+            hash: the cache key of the utterance the task inserts, if any
+            row: a dict with the columns of the row the task inserts
+        """
+        if row is not None:
+            with self._pending_lock:
+                self._pending[hash] = row
+        self._queue.put((task, hash, row))
+
+    def pending(self, hash):
+        """Return the row a queued task is about to insert for hash, or None"""
+        with self._pending_lock:
+            return self._pending.get(hash)
+
+    def flush(self):
+        """Block until every task queued so far has run"""
+        self._queue.join()
+
+    def stop(self):
+        """Run the queued tasks and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        db = self.open_db()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            task, hash, row = item
+            try:
+                task(db)
+            except Exception as e:
+                rospy.logwarn('cache bookkeeping failed: %s', e)
+            finally:
+                if row is not None:
+                    with self._pending_lock:
+                        if self._pending.get(hash) is row:
+                            del self._pending[hash]
+                self._queue.task_done()
@@ -0,0 +1,78 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Deadlines of requests going through the tts node, the synthesizer and the polly node.
+
+A deadline is a time in seconds since the epoch, as returned by ``time.time()``, by which a request must be done.
+It is given as ``deadline`` in the metadata of a request and passed on from stage to stage. A deadline of 0 or None
+means there is none. Every stage waits at most until the deadline and gives up with a ``DeadlineExceeded`` as soon
+as it is past.
+"""
+
+import time
+
+import rospy
+
+
+# the share of the seconds left before a deadline that a request may spend connecting, the rest is for reading
+CONNECT_SHARE = 1.0 / 3
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+def remaining(deadline):
+    """Return the seconds left until deadline, which may be negative, or None if there is no deadline."""
+    if not deadline:
+        return None
+    return deadline - time.time()
+
+
+def check(deadline, what):
+    """Raise a DeadlineExceeded if the deadline has passed.
+
+    :param deadline: the deadline of the request, may be None
+    :param what: what was about to be done, for the error message
+    """
+    left = remaining(deadline)
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('the deadline passed {:.3f} seconds ago, not going to {}'.format(-left, what))
+
+
+def split_timeouts(left, connect_timeout, read_timeout):
+    """Split the seconds left before a deadline between connecting and reading the response.
+
+    Together the timeouts don't go past the deadline, and neither is longer than without one. A read timeout bounds
+    each read of the socket rather than the whole response, so the deadline still has to be checked once the response
+    is read.
+
+    :param left: the seconds left, see ``remaining``
+    :param connect_timeout: the connect timeout without a deadline
+    :param read_timeout: the read timeout without a deadline
+    :return: a tuple of the connect and the read timeout
+    """
+    return min(connect_timeout, left * CONNECT_SHARE), min(read_timeout, left * (1 - CONNECT_SHARE))
+
+
+def wait_for_service(service_name, deadline):
+    """``rospy.wait_for_service`` that gives up at the deadline."""
+    check(deadline, 'wait for {}'.format(service_name))
+    left = remaining(deadline)
+    if left is None:
+        rospy.wait_for_service(service_name)
+        return
+    try:
+        rospy.wait_for_service(service_name, timeout=left)
+    except rospy.ROSException:
+        raise DeadlineExceeded('{} was not available before the deadline'.format(service_name))
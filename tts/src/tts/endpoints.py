@@ -0,0 +1,170 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Choosing the Amazon Polly region or endpoint with the lowest latency.
+
+The polly node can be given several regions or endpoints in the ROS param ``aws_client_configuration/endpoints``,
+each a region name or a dict with ``region`` and ``endpoint_url``::
+
+    aws_client_configuration:
+      region: us-west-2
+      endpoints: [us-west-2, us-east-1, {region: eu-west-1, endpoint_url: 'https://polly.eu-west-1.amazonaws.com'}]
+
+An ``EndpointSelector`` keeps an exponentially weighted moving average of the latency until the response of every
+endpoint, and of how often it failed. Each SynthesizeSpeech request goes to the endpoint that is expected to be the
+quickest, counting a failure as ``ERROR_PENALTY`` seconds, and fails over to the next one if the endpoint fails.
+Endpoints that were not called for ``probe_interval`` seconds are probed with a cheap request in the background, so
+that an endpoint that got faster is noticed.
+
+Errors caused by the request itself, see ``tts.errorcache.CLIENT_ERROR_CODES``, and deadlines that passed don't
+count against an endpoint.
+"""
+
+import threading
+import time
+
+import rospy
+from tts.deadline import DeadlineExceeded
+from tts.errorcache import CLIENT_ERROR_CODES
+
+# the seconds a failure adds to the expected latency of an endpoint
+ERROR_PENALTY = 10.0
+
+
+def is_endpoint_error(error):
+    """Return whether an exception of a call is the fault of the endpoint rather than of the request."""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and 'Error' in response:
+        return response['Error'].get('Code') not in CLIENT_ERROR_CODES
+    return True
+
+
+class Endpoint(object):
+    """A region or endpoint of Amazon Polly and its moving averages."""
+
+    def __init__(self, region_name, endpoint_url=None):
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.name = endpoint_url or region_name
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.last_called = None
+
+    def expected_latency(self):
+        """The latency to expect including failures, 0 until the endpoint was called so that it is tried."""
+        if self.latency is None and not self.calls:
+            return 0.0
+        return (self.latency or 0.0) + self.error_rate * ERROR_PENALTY
+
+    def snapshot(self):
+        return {'name': self.name, 'region': self.region_name, 'latency': self.latency,
+                'error_rate': self.error_rate, 'calls': self.calls}
+
+
+def parse_endpoints(config):
+    """Return Endpoints from the ROS param, a list of region names or dicts with region and endpoint_url."""
+    endpoints = []
+    for entry in config or []:
+        if isinstance(entry, dict):
+            endpoints.append(Endpoint(entry['region'], entry.get('endpoint_url')))
+        else:
+            endpoints.append(Endpoint(entry))
+    return endpoints
+
+
+class EndpointSelector(object):
+    """Ranks endpoints by their expected latency and probes the ones that are not called."""
+
+    def __init__(self, endpoints, alpha=0.2, probe_interval=60.0, clock=time.time):
+        """
+        :param endpoints: a list of Endpoint
+        :param alpha: the weight of the latest call in the moving averages
+        :param probe_interval: endpoints not called for this many seconds are probed, 0 to never probe
+        :param clock: the source of the time
+        """
+        if not endpoints:
+            raise ValueError('no endpoints to select from')
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ranked(self):
+        """Return the endpoints, the one expected to be quickest first."""
+        with self._lock:
+            return sorted(self.endpoints, key=Endpoint.expected_latency)
+
+    def record(self, endpoint, latency, failed=False):
+        """Record a call of an endpoint.
+
+        :param latency: the seconds until the response, or until the call failed
+        :param failed: whether the call failed because of the endpoint
+        """
+        with self._lock:
+            endpoint.calls += 1
+            endpoint.last_called = self.clock()
+            endpoint.error_rate += self.alpha * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            if not failed:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += self.alpha * (latency - endpoint.latency)
+
+    def call(self, endpoint, function):
+        """Call function with the endpoint and record how long it took and whether it failed."""
+        started = self.clock()
+        try:
+            result = function(endpoint)
+        except Exception as e:
+            self.record(endpoint, self.clock() - started, failed=is_endpoint_error(e))
+            raise
+        self.record(endpoint, self.clock() - started)
+        return result
+
+    def probe_stale(self, probe):
+        """Probe the endpoints that were not called for ``probe_interval`` seconds.
+
+        :param probe: a callable making a cheap request to the endpoint it is given
+        :return: the probed endpoints
+        """
+        now = self.clock()
+        stale = [e for e in self.endpoints if e.last_called is None or now - e.last_called >= self.probe_interval]
+        for endpoint in stale:
+            try:
+                self.call(endpoint, probe)
+            except Exception as e:
+                rospy.logwarn('probing Amazon Polly at {} failed: {}'.format(endpoint.name, e))
+        return stale
+
+    def start_probing(self, probe):
+        """Probe stale endpoints every ``probe_interval`` seconds from a background thread."""
+        if self._thread is not None or self.probe_interval <= 0:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.probe_interval)
+                self.probe_stale(probe)
+
+        self._thread = threading.Thread(target=run, name='polly_endpoint_probe')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def snapshot(self):
+        """Return the moving averages of the endpoints, quickest first."""
+        return [e.snapshot() for e in self.ranked()]
@@ -0,0 +1,107 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""A short lived cache of requests that Amazon Polly rejected.
+
+Some requests fail the same way every time they are sent, e.g. invalid SSML or a voice that doesn't exist. The
+synthesizer remembers the error response of such a request for ``ttl`` seconds and returns it again without calling
+the engine. Only errors whose code is in ``CLIENT_ERROR_CODES`` are remembered; throttling, service failures and
+connection errors are transient and always go to the engine.
+"""
+
+import collections
+import threading
+
+# error codes of Amazon Polly that only depend on the request
+CLIENT_ERROR_CODES = frozenset([
+    'EngineNotSupportedException',
+    'InvalidSampleRateException',
+    'InvalidSsmlException',
+    'LanguageNotSupportedException',
+    'LexiconNotFoundException',
+    'MarksNotSupportedForFormatException',
+    'SsmlMarksNotSupportedForTextTypeException',
+    'TextLengthExceededException',
+    'ValidationException',
+])
+
+
+def client_error_code(result):
+    """Return the error code of a failed synthesis if the error is deterministic, None otherwise.
+
+    :param result: the result of the engine as a dict
+    """
+    exception = result.get('Exception')
+    if not isinstance(exception, dict):
+        return None
+    code = exception.get('Code')
+    return code if code in CLIENT_ERROR_CODES else None
+
+
+class ErrorCache(object):
+    """Remembers error responses by cache key for a limited time."""
+
+    def __init__(self, ttl=60.0, max_entries=1000):
+        """
+        :param ttl: seconds an error response is returned again
+        :param max_entries: how many error responses are kept, the oldest one is dropped first
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.hits_by_code = collections.Counter()
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        """Return the error response remembered for key, or None, counting a hit."""
+        with self._lock:
+            entry = self._entry(key, now)
+            if entry is None:
+                return None
+            expires, code, response = entry
+            self.hits += 1
+            self.hits_by_code[code] += 1
+            return response
+
+    def contains(self, key, now):
+        """Return whether an error response is remembered for key, without counting a hit."""
+        with self._lock:
+            return self._entry(key, now) is not None
+
+    def _entry(self, key, now):
+        """Return the entry of key unless it has expired, must be called with the lock held."""
+        entry = self._entries.get(key)
+        if entry is not None and now >= entry[0]:
+            del self._entries[key]
+            return None
+        return entry
+
+    def put(self, key, code, response, now):
+        """Remember an error response.
+
+        :param key: the cache key of the request
+        :param code: the error code, see client_error_code
+        :param response: what to return for the request while it is remembered
+        :param now: the time of the request
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, code, response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return the number of remembered errors and of hits, in total and by error code."""
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'hits_by_code': dict(self.hits_by_code)}
@@ -0,0 +1,139 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Eviction policies for the synthesizer cache.
+
+Every row of the cache table carries a ``priority`` and the unpinned row with the lowest priority is evicted first,
+so whatever the policy, finding a victim is a lookup in the ``cache_eviction`` index. A policy decides what the
+priority of an utterance is when it is cached and every time it is hit, from the time of the request, the number
+of accesses, the size of the file and how long the engine took to synthesize it.
+
+The aging policies keep an inflation value ``L`` which is raised to the priority of every evicted utterance and
+added to the priority of every inserted or hit one. Utterances that used to be popular but are not requested any
+more are therefore eventually evicted. ``L`` is not stored: when a synthesizer starts it is recovered as the
+lowest priority in the cache.
+
+Usage::
+
+    policy = make_policy('gds')
+    SpeechSynthesizer(eviction_policy=policy)
+"""
+
+# a synthesis never costs nothing, not even for files that were cached without recording their latency
+MIN_COST = 0.001
+
+
+class EvictionPolicy(object):
+    """The base class of eviction policies.
+
+    ``PRIORITY_SQL`` computes the priority of all rows from scratch with ``L`` at 0. It is used when a cache
+    that was managed by another policy is taken over.
+    """
+
+    name = None
+    PRIORITY_SQL = None
+
+    def __init__(self):
+        self.inflation = 0.0
+
+    def priority(self, now, access_count, size, synth_latency):
+        """The priority of an utterance that is being cached or hit.
+
+        :param now: the time of the request
+        :param access_count: how many times the utterance has been requested, including this time
+        :param size: the size of the file in bytes
+        :param synth_latency: how many seconds it took to synthesize the utterance
+        :return: a float, utterances with lower priority are evicted first
+        """
+        raise NotImplementedError()
+
+    def attach(self, db):
+        """Prepare the cache in db to be managed by this policy."""
+        if db.get_setting('eviction_policy') != self.name:
+            db.ex('UPDATE cache SET priority={}'.format(self.PRIORITY_SQL))
+            db.set_setting('eviction_policy', self.name)
+        self.inflation = db.ex('SELECT COALESCE(MIN(priority),0) FROM cache WHERE pinned=0').fetchone()[0]
+
+    def victim(self, db, exclude=None):
+        """Return the unpinned row of the cache table to evict next, or None.
+
+        :param db: the cache DB
+        :param exclude: the hash of an utterance that must not be evicted, e.g. the one just cached
+        """
+        return db.ex('SELECT hash, file, size, priority FROM cache WHERE pinned=0 AND hash IS NOT ? '
+                     'ORDER BY priority LIMIT 1', exclude).fetchone()
+
+    def evicted(self, row):
+        """Called with the row returned by ``victim`` once it has been evicted."""
+        self.inflation = max(self.inflation, row['priority'])
+
+
+class LRUPolicy(EvictionPolicy):
+    """Least recently used, the priority is the time of the last access."""
+
+    name = 'lru'
+    PRIORITY_SQL = 'last_accessed'
+
+    def priority(self, now, access_count, size, synth_latency):
+        return now
+
+    def evicted(self, row):
+        pass
+
+
+class LFUPolicy(EvictionPolicy):
+    """Least frequently used with dynamic aging (LFU-DA), the priority is ``L + access count``."""
+
+    name = 'lfu'
+    PRIORITY_SQL = 'access_count'
+
+    def priority(self, now, access_count, size, synth_latency):
+        return self.inflation + access_count
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    """GreedyDual-Size, the priority is ``L + cost / size`` where the cost is the synthesis latency.
+
+    Small utterances that were slow to synthesize are kept longest, big ones that were fast to synthesize go first.
+    """
+
+    name = 'gds'
+    PRIORITY_SQL = 'MAX(synth_latency, {}) / MAX(size, 1)'.format(MIN_COST)
+
+    def priority(self, now, access_count, size, synth_latency):
+        return self.inflation + max(synth_latency, MIN_COST) / max(size, 1)
+
+
+class GreedyDualSizeFrequencyPolicy(EvictionPolicy):
+    """GreedyDual-Size with frequency, the priority is ``L + access count * cost / size``."""
+
+    name = 'gdsf'
+    PRIORITY_SQL = 'access_count * MAX(synth_latency, {}) / MAX(size, 1)'.format(MIN_COST)
+
+    def priority(self, now, access_count, size, synth_latency):
+        return self.inflation + access_count * max(synth_latency, MIN_COST) / max(size, 1)
+
+
+POLICIES = dict((p.name, p) for p in (LRUPolicy, LFUPolicy, GreedyDualSizePolicy, GreedyDualSizeFrequencyPolicy))
+
+
+class BadEvictionPolicyError(NameError):
+    pass
+
+
+def make_policy(name):
+    """Create the eviction policy called name."""
+    if name not in POLICIES:
+        raise BadEvictionPolicyError('bad eviction policy {} which is not one of {}'.format(
+            name, ', '.join(sorted(POLICIES.keys()))))
+    return POLICIES[name]()
@@ -0,0 +1,207 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Credentials for Amazon Polly from the AWS IoT credentials provider, using the certificate of the robot.
+
+The provider is configured with the ROS params ``iot/certfile``, ``iot/keyfile``, ``iot/endpoint``, ``iot/role`` and
+optionally ``iot/thing_name``, ``iot/connect_timeout_ms`` and ``iot/total_timeout_ms``, which are read once.
+
+botocore refreshes credentials on the thread of a request when they are about to expire. So that no request waits
+for AWS IoT, a background thread fetches new credentials ``REFRESH_AHEAD`` seconds before they expire, over a
+``requests.Session`` that keeps its connection, and botocore is handed those when it asks. With
+``iot/credentials_file`` set, the credentials are also saved there, readable by the user of the node only, so that
+a restarted node can use them right away.
+"""
+
+import calendar
+import json
+import os
+import threading
+import time
+
+import requests
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from botocore.utils import parse_timestamp
+
+import rospy
+from tts.amazonpolly import get_ros_param
+
+
+class AwsIotCredentialProvider(CredentialProvider):
+    METHOD = 'aws-iot'
+    CANONICAL_NAME = 'customIoTwithCertificate'
+
+    DEFAULT_AUTH_CONNECT_TIMEOUT_MS = 5000
+    DEFAULT_AUTH_TOTAL_TIMEOUT_MS = 10000
+
+    # botocore refreshes credentials that expire within 15 minutes, they are renewed in the background before that
+    REFRESH_AHEAD = 20 * 60
+    # credentials that expire sooner than this are fetched on the spot, botocore would ask again right away
+    MIN_REMAINING = 16 * 60
+    # seconds until a failed refresh is tried again
+    RETRY_INTERVAL = 30
+
+    def __init__(self):
+        super(AwsIotCredentialProvider, self).__init__()
+        self.ros_param_prefix = 'iot/'
+        self._config = None
+        self._session = None
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get_param(self, param, default=None):
+        return get_ros_param(self.ros_param_prefix + param, default)
+
+    def config(self):
+        """The settings of the provider, read from the parameter server the first time, None if incomplete."""
+        if self._config is None:
+            self._config = {
+                'cert_file': self.get_param('certfile'),
+                'key_file': self.get_param('keyfile'),
+                'endpoint': self.get_param('endpoint'),
+                'role_alias': self.get_param('role'),
+                'connect_timeout': self.get_param('connect_timeout_ms', self.DEFAULT_AUTH_CONNECT_TIMEOUT_MS),
+                'total_timeout': self.get_param('total_timeout_ms', self.DEFAULT_AUTH_TOTAL_TIMEOUT_MS),
+                'thing_name': self.get_param('thing_name', ''),
+                'credentials_file': self.get_param('credentials_file', ''),
+            }
+        config = self._config
+        required = ('cert_file', 'key_file', 'endpoint', 'role_alias', 'thing_name')
+        return None if any(config[k] is None for k in required) else config
+
+    def _fetch(self):
+        """Fetch credentials from AWS IoT, raise if it fails."""
+        config = self.config()
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.cert = (config['cert_file'], config['key_file'])
+            if config['thing_name']:
+                self._session.headers['x-amzn-iot-thingname'] = config['thing_name']
+        url = 'https://{}/role-aliases/{}/credentials'.format(config['endpoint'], config['role_alias'])
+        # see also: urllib3/util/timeout.py
+        timeout = (config['connect_timeout'] / 1000.0, (config['total_timeout'] - config['connect_timeout']) / 1000.0)
+
+        response = self._session.get(url, timeout=timeout)
+        response.raise_for_status()
+        d = response.json()['credentials']
+
+        rospy.loginfo('Credentials expiry time: {}'.format(d['expiration']))
+
+        return {
+            'access_key': d['accessKeyId'],
+            'secret_key': d['secretAccessKey'],
+            'token': d['sessionToken'],
+            'expiry_time': d['expiration'],
+        }
+
+    @staticmethod
+    def _remaining(credentials):
+        """The seconds until credentials expire, 0 if there are none."""
+        if not credentials:
+            return 0
+        return calendar.timegm(parse_timestamp(credentials['expiry_time']).utctimetuple()) - time.time()
+
+    def retrieve_credentials(self):
+        """Return credentials that are not about to expire, fetching them only if the refresher has none."""
+        try:
+            if self.config() is None:
+                return None
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = self._load_saved()
+                if self._remaining(self._credentials) < self.MIN_REMAINING:
+                    self._credentials = self._fetch()
+                    self._save(self._credentials)
+                credentials = self._credentials
+            self._start_refresher()
+            return credentials
+        except Exception as e:
+            rospy.logwarn('Failed to fetch credentials from AWS IoT: {}'.format(e))
+            return None
+
+    def refresh(self):
+        """Fetch new credentials now.
+
+        :return: the seconds until the next refresh is due
+        """
+        try:
+            credentials = self._fetch()
+        except Exception as e:
+            rospy.logwarn('Failed to refresh credentials from AWS IoT: {}'.format(e))
+            return self.RETRY_INTERVAL
+        with self._lock:
+            self._credentials = credentials
+        self._save(credentials)
+        return self._next_refresh(credentials)
+
+    def _next_refresh(self, credentials):
+        return max(self._remaining(credentials) - self.REFRESH_AHEAD, self.RETRY_INTERVAL)
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+
+            def run():
+                delay = self._next_refresh(self._credentials)
+                while True:
+                    time.sleep(delay)
+                    delay = self.refresh()
+
+            self._refresher = threading.Thread(target=run, name='aws_iot_credentials')
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def _load_saved(self):
+        """Return the credentials saved for the same endpoint and role, None if there are none or the file is unsafe."""
+        config = self.config()
+        path = config['credentials_file']
+        if not path or not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            rospy.logwarn('not using the credentials in {}, other users can access it'.format(path))
+            return None
+        with open(path) as f:
+            saved = json.load(f)
+        if (saved.get('endpoint'), saved.get('role_alias')) != (config['endpoint'], config['role_alias']):
+            return None
+        return saved['credentials']
+
+    def _save(self, credentials):
+        """Save credentials to the credentials file, if there is one, readable by this user only."""
+        config = self.config()
+        path = config['credentials_file']
+        if not path:
+            return
+        try:
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'endpoint': config['endpoint'], 'role_alias': config['role_alias'],
+                           'credentials': credentials}, f)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            rospy.logwarn('Failed to save the credentials to {}: {}'.format(path, e))
+
+    def load(self):
+        metadata = self.retrieve_credentials()
+        if metadata is None:
+            return None
+        return RefreshableCredentials.create_from_metadata(
+            metadata,
+            self.retrieve_credentials,
+            'aws-iot-with-certificate'
+        )
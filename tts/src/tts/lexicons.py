@@ -0,0 +1,107 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""A local index of the pronunciation lexicons stored in Amazon Polly.
+
+For every lexicon the index keeps its content, the sha256 of the content as its version, and the time Amazon Polly
+last modified it. The polly node updates the index whenever it puts, gets, lists or deletes a lexicon, which lets it
+skip uploading a lexicon that hasn't changed. The synthesizer reads the versions of the lexicons of a request from
+the same file and makes them part of the cache key, so changing a lexicon only invalidates the audio that was
+synthesized with it. Both find the file as ``INDEX_FILE_NAME`` in their cache directory, so they have to be given
+the same one.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import rospy
+from tts.audio import publishing
+
+# the name of the index in the cache directory of the polly node and the synthesizer
+INDEX_FILE_NAME = 'polly_lexicons.json'
+
+
+def lexicon_version(content):
+    """The version of a lexicon, the sha256 of its content."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class LexiconIndex(object):
+    """The lexicons known to this robot, saved in a JSON file shared by its nodes.
+
+    The file is read again whenever another process has changed it.
+    """
+
+    def __init__(self, index_file=os.path.join('/tmp', INDEX_FILE_NAME)):
+        self.index_file = index_file
+        self._lexicons = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        try:
+            st = os.stat(self.index_file)
+        except OSError:
+            self._lexicons, self._stamp = {}, None
+            return
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.index_file) as f:
+                self._lexicons = json.load(f)
+            self._stamp = stamp
+        except (IOError, OSError, ValueError) as e:
+            rospy.logwarn('failed to read the lexicon index %s: %s', self.index_file, e)
+
+    def _save(self):
+        with publishing(self.index_file) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                json.dump(self._lexicons, f)
+        st = os.stat(self.index_file)
+        self._stamp = (st.st_ino, st.st_mtime, st.st_size)
+
+    def get(self, name):
+        """Return the entry of a lexicon, a dict with its content, version and last_modified, or None."""
+        with self._lock:
+            self._reload()
+            return self._lexicons.get(name)
+
+    def names(self):
+        with self._lock:
+            self._reload()
+            return sorted(self._lexicons.keys())
+
+    def versions(self, names):
+        """Return the versions of lexicons in the given order, an empty string for an unknown lexicon."""
+        with self._lock:
+            self._reload()
+            return [self._lexicons.get(n, {}).get('version', '') for n in names]
+
+    def record(self, name, content, last_modified=None):
+        """Remember the content of a lexicon as it is stored in Amazon Polly."""
+        with self._lock:
+            self._reload()
+            self._lexicons[name] = {'content': content, 'version': lexicon_version(content),
+                                    'last_modified': last_modified}
+            self._save()
+
+    def remove(self, *names):
+        """Forget lexicons that are no longer stored in Amazon Polly."""
+        with self._lock:
+            self._reload()
+            removed = [self._lexicons.pop(name) for name in names if name in self._lexicons]
+            if removed:
+                self._save()
@@ -0,0 +1,167 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Synthesizing the utterances that are likely requested next before they are requested.
+
+Interactions are often scripted: after "Would you like to continue?" comes "Great" or "Okay, stopping". A
+``Prefetcher`` learns which request followed which in a first-order ``TransitionModel`` and, after every request,
+synthesizes the most probable next requests in the background, so that they are cache hits when they come.
+
+A request can also name what comes next in its metadata, as texts or as metadata of their own, which are
+prefetched with the voice and format of the request unless they say otherwise::
+
+    {"prefetch": ["Great", {"text": "Okay, stopping", "voice_id": "Matthew"}]}
+
+Prefetching calls the engine for utterances that may never be played, so it is limited to a budget of syntheses
+per hour. Utterances that are cached already don't count.
+"""
+
+import collections
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import rospy
+
+# fields of a request that don't change what is synthesized
+VOLATILE_FIELDS = ('deadline', 'stream', 'pin')
+
+
+def request_key(kw):
+    """The key of a request in the transition model, its fields without the volatile ones."""
+    return tuple(sorted((k, repr(v)) for k, v in kw.items() if k not in VOLATILE_FIELDS))
+
+
+class TransitionModel(object):
+    """Counts which request followed which, for the most recently seen requests."""
+
+    def __init__(self, max_keys=1000, max_successors=16):
+        self.max_keys = max_keys
+        self.max_successors = max_successors
+        self._transitions = collections.OrderedDict()
+        self._last = None
+
+    def observe(self, key):
+        """Record that key was requested after the previous request."""
+        if self._last is not None:
+            successors = self._transitions.pop(self._last, None) or collections.Counter()
+            successors[key] += 1
+            if len(successors) > self.max_successors:
+                del successors[min(successors, key=successors.get)]
+            self._transitions[self._last] = successors
+            while len(self._transitions) > self.max_keys:
+                self._transitions.popitem(last=False)
+        self._last = key
+
+    def predict(self, key, limit, min_probability=0.0):
+        """Return up to limit (successor, probability) of key, most probable first."""
+        successors = self._transitions.get(key)
+        if not successors:
+            return []
+        total = float(sum(successors.values()))
+        return [(k, n / total) for k, n in successors.most_common(limit) if n / total >= min_probability]
+
+
+class Prefetcher(object):
+    """Prefetches the hinted and the most probable next requests from a background thread."""
+
+    def __init__(self, prefetch, count=0, budget=100, min_probability=0.2, max_pending=20):
+        """
+        :param prefetch: a callable taking the fields of a request, synthesizes and caches it unless it is cached
+                         already and returns whether it called the engine
+        :param count: the number of predicted requests prefetched after every request, 0 to only prefetch hints
+        :param budget: the number of times per hour the engine may be called
+        :param min_probability: requests that follow less often are not prefetched
+        :param max_pending: the number of requests that can wait to be prefetched, more are dropped
+        """
+        self.prefetch = prefetch
+        self.count = count
+        self.budget = budget
+        self.min_probability = min_probability
+        self.model = TransitionModel()
+        self._requests = collections.OrderedDict()
+        self._pending = set()
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = None
+
+    def requested(self, kw, hints=None):
+        """Learn from a request that was answered and prefetch what probably comes after it.
+
+        :param kw: the fields of the request
+        :param hints: the requests named in its metadata, texts or dicts of fields that differ from kw
+        """
+        base_kw = dict((k, v) for k, v in kw.items() if k not in VOLATILE_FIELDS + ('template_values',))
+        next_kws = [dict(base_kw, **hint) if isinstance(hint, dict) else dict(base_kw, text=hint)
+                    for hint in hints or []]
+        with self._lock:
+            if self.count > 0:
+                key = request_key(kw)
+                self._remember(key, dict((k, v) for k, v in kw.items() if k not in VOLATILE_FIELDS))
+                self.model.observe(key)
+                next_kws.extend(self._requests[k] for k, _ in self.model.predict(key, self.count, self.min_probability)
+                                if k in self._requests)
+        for next_kw in next_kws:
+            self._submit(next_kw)
+
+    def flush(self):
+        """Block until everything queued so far has been prefetched."""
+        self._queue.join()
+
+    def _remember(self, key, kw):
+        self._requests.pop(key, None)
+        self._requests[key] = kw
+        while len(self._requests) > self.model.max_keys:
+            self._requests.popitem(last=False)
+
+    def _submit(self, kw):
+        key = request_key(kw)
+        with self._lock:
+            if key in self._pending:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='prefetch')
+                self._thread.daemon = True
+                self._thread.start()
+            try:
+                self._queue.put_nowait((key, kw))
+            except queue.Full:
+                return
+            self._pending.add(key)
+
+    def _within_budget(self):
+        now = time.time()
+        while self._calls and self._calls[0] < now - 3600:
+            self._calls.popleft()
+        return len(self._calls) < self.budget
+
+    def _run(self):
+        while True:
+            key, kw = self._queue.get()
+            try:
+                if self._within_budget():
+                    if self.prefetch(dict(kw)):
+                        self._calls.append(time.time())
+                else:
+                    rospy.logdebug('the prefetch budget is spent, not prefetching %s', kw.get('text'))
+            except Exception as e:
+                rospy.logwarn('failed to prefetch %s: %s', kw.get('text'), e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                self._queue.task_done()
@@ -0,0 +1,204 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Profiling the requests of a running node.
+
+The synthesizer and polly nodes advertise a ``<service>/profile`` service next to their own. A call profiles the
+requests the node handles for ``duration`` seconds or until ``num_requests`` requests were profiled, whichever is
+first, with cProfile and, if ``trace_malloc`` is set, tracemalloc. It then writes the profile to ``output_path``,
+which ``python -m pstats`` and snakeviz can read, and returns the hot spots as JSON::
+
+    $ rosservice call /synthesizer/profile "{duration: 30.0, num_requests: 0, trace_malloc: false, output_path: ''}"
+
+Only one request at a time is profiled in a process, the requests handled while another one is profiled run as
+usual and are counted as skipped.
+"""
+
+import cProfile
+import contextlib
+import json
+import pstats
+import threading
+import time
+
+import rospy
+
+# the longest a session lasts, also when it waits for num_requests requests
+MAX_DURATION = 600.0
+# the number of functions and allocation sites returned
+NUM_HOT_SPOTS = 20
+
+# held while a request is profiled, cProfile can't profile two threads of a process at once
+_profiling_lock = threading.Lock()
+
+
+class Session(object):
+    """A profiling session, collecting the profiles of requests until it is done."""
+
+    def __init__(self, num_requests):
+        self.num_requests = num_requests
+        self.stats = None
+        self.profiled = 0
+        self.skipped = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            if self.done.is_set():
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+            if self.num_requests and self.profiled >= self.num_requests:
+                self.done.set()
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+
+class RequestProfiler(object):
+    """Profiles the requests of a node on demand.
+
+    The request handler of the node runs every request in ``request()``, which profiles it if a session is running.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: what is profiled, for the default output path
+        """
+        self.name = name
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def request(self):
+        """Profile what runs in the context if a session is running."""
+        session = self._session
+        if session is None or session.done.is_set():
+            yield
+            return
+        if not _profiling_lock.acquire(False):
+            session.skip()
+            yield
+            return
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                session.add(profile)
+        finally:
+            _profiling_lock.release()
+
+    def profile(self, duration=0.0, num_requests=0, trace_malloc=False, output_path=''):
+        """Profile the requests handled during duration seconds or the next num_requests requests.
+
+        :param duration: seconds to profile, MAX_DURATION if 0
+        :param num_requests: the number of requests to profile, no limit if 0
+        :param trace_malloc: also trace where memory is allocated, needs Python 3
+        :param output_path: where the profile is written, a file in /tmp if empty
+        :return: a dict of the hot spots
+        """
+        duration = min(duration or MAX_DURATION, MAX_DURATION)
+        output_path = output_path or '/tmp/{}_{}.prof'.format(self.name.strip('/').replace('/', '_'),
+                                                              time.strftime('%Y%m%d_%H%M%S'))
+        if not self._session_lock.acquire(False):
+            raise RuntimeError('{} is profiled already'.format(self.name))
+        try:
+            tracemalloc = _start_tracemalloc() if trace_malloc else None
+            start_snapshot = tracemalloc.take_snapshot() if tracemalloc else None
+
+            session = Session(num_requests)
+            started = time.time()
+            self._session = session
+            try:
+                session.done.wait(duration)
+            finally:
+                session.done.set()
+                self._session = None
+            result = {
+                'Profile File': None,
+                'Duration': time.time() - started,
+                'Profiled Requests': session.profiled,
+                'Skipped Requests': session.skipped,
+                'Hot Spots': [],
+            }
+
+            if session.stats is not None:
+                session.stats.dump_stats(output_path)
+                result['Profile File'] = output_path
+                result['Hot Spots'] = hot_spots(session.stats)
+            if tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(output_path + '.tracemalloc')
+                result['Allocation File'] = output_path + '.tracemalloc'
+                result['Allocations'] = allocations(snapshot, start_snapshot)
+            return result
+        finally:
+            if tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self._session_lock.release()
+
+    def _profile_request_handler(self, request):
+        """The callback of the profile service, blocks until the session is done."""
+        from tts.srv import ProfileResponse
+        rospy.loginfo('profiling {}: {}'.format(self.name, request))
+        try:
+            result = self.profile(request.duration, request.num_requests, request.trace_malloc, request.output_path)
+            return ProfileResponse(json.dumps(result))
+        except Exception as e:
+            return ProfileResponse(json.dumps({'Exception': str(e)}))
+
+    def advertise(self, service_name):
+        """Advertise ``<service_name>/profile``.
+
+        :return: the rospy.Service
+        """
+        from tts.srv import Profile
+        return rospy.Service('{}/profile'.format(service_name), Profile, self._profile_request_handler)
+
+
+def _start_tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        raise RuntimeError('tracemalloc needs Python 3')
+    if tracemalloc.is_tracing():
+        raise RuntimeError('tracemalloc is in use already')
+    tracemalloc.start(25)
+    return tracemalloc
+
+
+def hot_spots(stats, limit=NUM_HOT_SPOTS):
+    """Return the functions that took the most time of their own, most first.
+
+    :param stats: a pstats.Stats
+    :return: a list of dicts with the function, number of calls, own time and cumulative time in seconds
+    """
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [{'function': '{}:{}({})'.format(*func), 'calls': nc, 'tottime': tt, 'cumtime': ct}
+            for func, (cc, nc, tt, ct, callers) in rows]
+
+
+def allocations(snapshot, start_snapshot, limit=NUM_HOT_SPOTS):
+    """Return the lines that allocated the most memory that is still allocated, most first."""
+    return [{'line': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+             'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+            for stat in snapshot.compare_to(start_snapshot, 'lineno')[:limit]]
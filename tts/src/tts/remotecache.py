@@ -0,0 +1,191 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Remote cache tiers shared by the synthesizers of a fleet.
+
+On a miss in its local cache, a synthesizer with a remote cache looks the utterance up in the remote cache before
+calling the engine. Whatever the engine synthesizes is written back to the remote cache in the background by a
+``RemoteWriteBack``, so an utterance is only synthesized once for the whole fleet.
+
+Two remote caches are available, chosen by ``make_remote_cache`` from a URL:
+
+* ``http://host/prefix`` or ``https://...``: ``HttpBlobCache``, any blob store that supports GET and PUT of
+  ``<prefix>/<key>`` and keeps the Content-Type
+* ``file:///some/dir`` or a plain path: ``SharedDirectoryCache``, a directory on a shared file system
+"""
+
+import os
+import shutil
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import rospy
+from tts.audio import publishing
+from tts.deadline import check, remaining, split_timeouts
+
+# file extensions of the audio types returned by the engines, files fetched from a remote cache get the same
+# extension as the file that was written back
+AUDIO_TYPE_EXTENSIONS = {
+    'audio/ogg': '.ogg',
+    'audio/mpeg': '.mp3',
+    'audio/pcm': '.wav',
+}
+
+
+class RemoteCache(object):
+    """The interface of a remote cache tier."""
+
+    def get(self, key, output_path, deadline=None):
+        """Fetch an utterance from the remote cache.
+
+        :param key: the cache key of the utterance
+        :param output_path: where to save the audio, the extension for the audio type is appended
+        :param deadline: when the fetch has to be done by, see ``tts.deadline``
+        :return: a tuple of the path of the audio file and the audio type, or None if the remote cache
+                 doesn't have the utterance
+        """
+        raise NotImplementedError()
+
+    def put(self, key, filename, audio_type):
+        """Store an utterance in the remote cache.
+
+        :param key: the cache key of the utterance
+        :param filename: the audio file
+        :param audio_type: the audio type reported by the engine
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def _output_file(output_path, audio_type):
+        ext = AUDIO_TYPE_EXTENSIONS.get(audio_type, '')
+        return output_path if output_path.endswith(ext) else output_path + ext
+
+
+class SharedDirectoryCache(RemoteCache):
+    """A remote cache in a directory, e.g. on NFS.
+
+    The audio of an utterance is stored as ``<key>`` and its audio type as ``<key>.type``. The type is published
+    after the audio, so an utterance with a type file is complete.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def get(self, key, output_path, deadline=None):
+        try:
+            with open(os.path.join(self.root, key + '.type')) as f:
+                audio_type = f.read()
+            output_file = self._output_file(output_path, audio_type)
+            with publishing(output_file) as tmp_file:
+                shutil.copyfile(os.path.join(self.root, key), tmp_file)
+        except (IOError, OSError):
+            return None
+        return output_file, audio_type
+
+    def put(self, key, filename, audio_type):
+        with publishing(os.path.join(self.root, key)) as tmp_file:
+            shutil.copyfile(filename, tmp_file)
+        with publishing(os.path.join(self.root, key + '.type')) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                f.write(audio_type)
+
+
+class HttpBlobCache(RemoteCache):
+    """A remote cache in an HTTP blob store.
+
+    An utterance is stored at ``<url>/<key>`` with its audio type as Content-Type. A fetch with a deadline splits
+    the time left between connecting and reading, and fails if the audio arrives after the deadline.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, url, timeout=(3.0, 10.0)):
+        import requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get(self, key, output_path, deadline=None):
+        check(deadline, 'fetch {} from the remote cache'.format(key))
+        left = remaining(deadline)
+        timeout = self.timeout if left is None else split_timeouts(left, *self.timeout)
+        response = self.session.get('{}/{}'.format(self.url, key), stream=True, timeout=timeout)
+        try:
+            if response.status_code != 200:
+                return None
+            audio_type = response.headers.get('Content-Type', '')
+            output_file = self._output_file(output_path, audio_type)
+            with publishing(output_file) as tmp_file:
+                with open(tmp_file, 'wb') as f:
+                    for chunk in response.iter_content(self.CHUNK_SIZE):
+                        f.write(chunk)
+                check(deadline, 'return {} from the remote cache'.format(key))
+            return output_file, audio_type
+        finally:
+            response.close()
+
+    def put(self, key, filename, audio_type):
+        with open(filename, 'rb') as f:
+            response = self.session.put('{}/{}'.format(self.url, key), data=f,
+                                        headers={'Content-Type': audio_type}, timeout=self.timeout)
+        response.raise_for_status()
+
+
+def make_remote_cache(url):
+    """Create the remote cache for a URL, see the module documentation."""
+    if url.startswith('http://') or url.startswith('https://'):
+        return HttpBlobCache(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return SharedDirectoryCache(url)
+
+
+class RemoteWriteBack(object):
+    """Writes utterances back to a remote cache from a background thread.
+
+    The queue is bounded: when the remote cache can't keep up, new utterances are dropped rather than delaying
+    requests. A file that is evicted from the local cache before it is written back is skipped.
+    """
+
+    def __init__(self, remote_cache, max_pending=100):
+        self.remote_cache = remote_cache
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='remote_write_back')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, key, filename, audio_type):
+        try:
+            self._queue.put_nowait((key, filename, audio_type))
+        except queue.Full:
+            rospy.logwarn('remote cache write back is behind, not writing back %s', key)
+
+    def flush(self):
+        """Block until everything queued so far has been written back."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            key, filename, audio_type = self._queue.get()
+            try:
+                self.remote_cache.put(key, filename, audio_type)
+            except Exception as e:
+                rospy.logwarn('failed to write %s back to the remote cache: %s', key, e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,129 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Counters and latency histograms of the synthesizer.
+
+The synthesizer counts requests, cache hits and misses, evictions and engine errors and records the latencies of
+requests and of synthesis in fixed bucket histograms. Recording is a few additions under a lock. A snapshot of all of
+it is returned by the ``get_stats`` service as JSON and published on ``/diagnostics``::
+
+    $ rosservice call /synthesizer/get_stats
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+# upper bounds in seconds of the buckets of the latency histograms, the last bucket has no bound
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Counts values in fixed buckets, enough to estimate percentiles to the precision of a bucket."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket of the p-th percentile, None if the last bucket or no values."""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['+inf'], self.counts)),
+        }
+
+
+class SynthesizerStats(object):
+    """What the synthesizer has done since it started."""
+
+    COUNTERS = ('requests', 'failed_requests', 'hits', 'remote_hits', 'misses', 'error_cache_hits',
+                'engine_errors', 'evictions', 'evicted_bytes', 'prefetches')
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.counters = collections.Counter()
+        self.engine_errors_by_code = collections.Counter()
+        self.request_latency = Histogram()
+        self.synthesis_latency = Histogram()
+        self._lock = threading.Lock()
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+
+    def request(self, latency, failed=False):
+        """Record a request the service answered."""
+        with self._lock:
+            self.counters['requests'] += 1
+            if failed:
+                self.counters['failed_requests'] += 1
+            self.request_latency.record(latency)
+
+    def miss(self, latency, error_code=None):
+        """Record a call of the engine after a cache miss.
+
+        :param latency: seconds the engine took
+        :param error_code: the code or name of the error if the engine failed
+        """
+        with self._lock:
+            self.counters['misses'] += 1
+            self.synthesis_latency.record(latency)
+            if error_code is not None:
+                self.counters['engine_errors'] += 1
+                self.engine_errors_by_code[error_code] += 1
+
+    def evicted(self, size):
+        with self._lock:
+            self.counters['evictions'] += 1
+            self.counters['evicted_bytes'] += size
+
+    def snapshot(self):
+        """Return all the statistics as a dict, with ratios and rates derived from the counters."""
+        with self._lock:
+            c = dict((name, self.counters[name]) for name in self.COUNTERS)
+            uptime = self.clock() - self.started
+            lookups = c['hits'] + c['remote_hits'] + c['misses']
+            return {
+                'uptime': uptime,
+                'counters': c,
+                'hit_ratio': float(c['hits'] + c['remote_hits']) / lookups if lookups else None,
+                'engine_error_ratio': float(c['engine_errors']) / c['misses'] if c['misses'] else None,
+                'evictions_per_hour': 3600.0 * c['evictions'] / uptime if uptime > 0 else None,
+                'engine_errors_by_code': dict(self.engine_errors_by_code),
+                'request_latency': self.request_latency.snapshot(),
+                'synthesis_latency': self.synthesis_latency.snapshot(),
+            }
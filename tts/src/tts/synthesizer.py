@@ -13,17 +13,47 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import io
 import os
 import time
 import json
 import rospy
+import contextlib
 import hashlib
 import sqlite3
+import string
+import threading
 import time
 from optparse import OptionParser
 from tts.srv import Synthesizer, SynthesizerResponse
 from tts.srv import PollyResponse
-from tts.db import DB
+from tts.db import DB, PackedDB, CacheReconciler, CacheWriter
+from tts.eviction import make_policy
+from tts.cachesim import TraceWriter
+from tts.remotecache import RemoteWriteBack, make_remote_cache
+from tts.errorcache import ErrorCache, client_error_code
+from tts.voices import VoiceCatalog, InvalidVoiceRequestError
+from tts.lexicons import INDEX_FILE_NAME, LexiconIndex
+from tts.tasks import TaskPoller
+from tts.stats import SynthesizerStats
+from tts.profiling import RequestProfiler
+from tts.prefetch import Prefetcher
+from tts import deadline as deadlines
+from tts import audio
+from tts import transcode
+
+
+@contextlib.contextmanager
+def _unlocked():
+    yield
+
+
+def _synthesis_task(result, action):
+    """Parse the result of a synthesis task action of the polly node, raise if the action failed."""
+    res = json.loads(result)
+    if 'SynthesisTask' not in res:
+        raise RuntimeError('{} failed: {}'.format(action, res.get('Exception')))
+    return res
 
 
 class SpeechSynthesizer:
@@ -64,6 +94,38 @@ class SpeechSynthesizer:
 
         $ rosservice call /synthesizer 'hello' ''
         $ rosservice call /synthesizer '<speak>hello</speak>' '"{\"text_type\":\"ssml\"}"'
+
+    Templated prompts can be composed from separately cached fragments. The text is treated as a
+    ``str.format`` template and ``template_values`` in the metadata fills in the fields. Every literal
+    part and every value is synthesized (and cached) on its own as pcm, then the pieces are
+    concatenated into one wav file, so a fixed phrase is only ever sent to the engine once::
+
+        $ rosservice call /synthesizer 'Battery at {N} percent' '"{\"template_values\":{\"N\":42}}"'
+
+    Texts that are too long to be synthesized while the caller waits can be synthesized by an Amazon Polly
+    synthesis task with ``long_form`` and an S3 bucket in the metadata. The service answers right away with the id
+    and status of the task and an empty audio file. A TaskPoller then polls the task in the background and
+    downloads the audio into the cache when it is done, so repeating the request returns the status of the task
+    until the audio is cached::
+
+        $ rosservice call /synthesizer 'Chapter 1...' '"{\"long_form\":true,\"output_s3_bucket_name\":\"my-bucket\"}"'
+
+    A ``deadline`` in the metadata, in seconds since the epoch, bounds how long a request may take. It is not part of
+    the cache key and does not stop a cached utterance from being returned, but an utterance is not synthesized once
+    the deadline has passed, the wait for the polly service ends at the deadline, and the polly node gets the
+    deadline to bound its call to Amazon Polly. See ``tts.deadline``.
+
+    With ``canonical_master``, an utterance is synthesized once as pcm at 16000 Hz, its master, and every other
+    format and sample rate is derived from the master locally and cached as well. This saves calls to Amazon Polly
+    when the same texts are requested in several formats, at the cost of the bandwidth above 8000 Hz. See
+    ``tts.transcode``.
+
+    With ``trim_silence``, the silence Amazon Polly puts before and after the speech is trimmed, keeping 50 ms, once
+    when a new file is cached, so playing it starts speaking right away.
+
+    With ``stream`` in the metadata, a pcm utterance that is not cached yet is published on the audio topic of the
+    polly node while it is synthesized, and the response has ``"Streamed": true``. A cached utterance is never
+    streamed, its file is returned as usual.
     """
 
     class PollyViaNode:
@@ -73,19 +135,72 @@ class SpeechSynthesizer:
         def __call__(self, **kwargs):
             rospy.loginfo('will call service {}'.format(self.service_name))
             from tts.srv import Polly
-            rospy.wait_for_service(self.service_name)
+            deadlines.wait_for_service(self.service_name, kwargs.get('deadline'))
             polly = rospy.ServiceProxy(self.service_name, Polly)
             return polly(polly_action='SynthesizeSpeech', **kwargs)
 
+        def _request(self, polly_action, **kwargs):
+            from tts.srv import Polly
+            deadlines.wait_for_service(self.service_name, kwargs.get('deadline'))
+            polly = rospy.ServiceProxy(self.service_name, Polly)
+            return polly(polly_action=polly_action, **kwargs).result
+
+        def describe_voices(self, deadline=None):
+            """Return all the voices known to the polly node, giving up at the deadline."""
+            res = json.loads(self._request('DescribeVoices', include_additional_language_codes=True,
+                                           deadline=deadline or 0))
+            if 'Voices' not in res:
+                raise RuntimeError('DescribeVoices failed: {}'.format(res.get('Exception')))
+            return res['Voices']
+
+        def start_task(self, **kwargs):
+            """Start a synthesis task and return it, see AmazonPolly._start_speech_synthesis_task."""
+            action = 'StartSpeechSynthesisTask'
+            return _synthesis_task(self._request(action, **kwargs), action)['SynthesisTask']
+
+        def get_task(self, task_id, output_path=''):
+            """Return the result of GetSpeechSynthesisTask, with the audio file once it is downloaded."""
+            action = 'GetSpeechSynthesisTask'
+            return _synthesis_task(self._request(action, task_id=task_id, output_path=output_path), action)
+
     class PollyDirect:
-        def __init__(self):
-            pass
+        def __init__(self, polly=None, cache_dir='/tmp'):
+            """
+            :param polly: the AmazonPolly to call, by default one is created for the first request
+            :param cache_dir: the cache directory of the AmazonPolly that is created
+            """
+            self.polly = polly
+            self.cache_dir = cache_dir
+            self._polly_lock = threading.Lock()
+
+        def _amazon_polly(self):
+            with self._polly_lock:
+                if self.polly is None:
+                    rospy.loginfo('will import amazonpolly.AmazonPolly')
+                    from tts.amazonpolly import AmazonPolly
+                    self.polly = AmazonPolly(cache_dir=self.cache_dir)
+                return self.polly
 
         def __call__(self, **kwargs):
-            rospy.loginfo('will import amazonpolly.AmazonPolly')
-            from tts.amazonpolly import AmazonPolly
-            node = AmazonPolly()
-            return node.synthesize(**kwargs)
+            return self._amazon_polly().synthesize(**kwargs)
+
+        def describe_voices(self, deadline=None):
+            """Return all the voices of Amazon Polly, giving up at the deadline."""
+            return self._amazon_polly().describe_voices(deadline=deadline)
+
+        def _request(self, polly_action, **kwargs):
+            from tts.srv import PollyRequest
+            return self._amazon_polly()._node_request_handler(PollyRequest(polly_action=polly_action, **kwargs)).result
+
+        def start_task(self, **kwargs):
+            """Start a synthesis task and return it, see AmazonPolly._start_speech_synthesis_task."""
+            action = 'StartSpeechSynthesisTask'
+            return _synthesis_task(self._request(action, **kwargs), action)['SynthesisTask']
+
+        def get_task(self, task_id, output_path=''):
+            """Return the result of GetSpeechSynthesisTask, with the audio file once it is downloaded."""
+            action = 'GetSpeechSynthesisTask'
+            return _synthesis_task(self._request(action, task_id=task_id, output_path=output_path), action)
 
     class DummyEngine:
         """A dummy engine which exists to facilitate testing. Can either
@@ -109,9 +224,14 @@ class SpeechSynthesizer:
                 and if succesful Amazon Polly Response Metadata
             """
             if self.connected:
-                with open(kwargs['output_path'], 'wb') as f:
-                    f.write(os.urandom(self.file_size))
-                output_format = kwargs['OutputFormat'] if 'OutputFormat' in kwargs else 'ogg_vorbis'
+                output_format = kwargs.get('output_format', 'ogg_vorbis')
+                with audio.publishing(kwargs['output_path']) as tmp_path:
+                    if output_format == 'pcm':
+                        # pcm results have to be real wav files so that they can be composed
+                        audio.write_wav(tmp_path, os.urandom(self.file_size), int(kwargs.get('sample_rate', 16000)))
+                    else:
+                        with open(tmp_path, 'wb') as f:
+                            f.write(os.urandom(self.file_size))
                 resp = json.dumps({
                     'Audio File': kwargs['output_path'],
                     'Audio Type': output_format,
@@ -158,16 +278,44 @@ class SpeechSynthesizer:
         'DUMMY': DummyEngine,
     }
 
+    CACHE_STORAGES = {
+        'file': DB,
+        'pack': PackedDB,
+    }
+
     class BadEngineError(NameError):
         pass
 
+    class BadCacheStorageError(NameError):
+        pass
+
+    # metadata that only matters to synthesis tasks and is not part of the cache key
+    TASK_FIELDS = ('output_s3_bucket_name', 'output_s3_key_prefix', 'sns_topic_arn')
+    # the seconds a request waits at most for the voice catalogue to be fetched
+    VOICE_CATALOG_TIMEOUT = 5.0
+
+    # the fields of a request that are passed on to the engine, or not, but are no part of the cache key
+    UNCACHED_FIELDS = TASK_FIELDS + ('deadline', 'stream', 'long_form', 'pin')
+
     #TODO: expose this max_cache_bytes value to the roslaunch system (why is rosparam not used in this file?)
-    def __init__(self, engine='POLLY_SERVICE', polly_service_name='polly', max_cache_bytes=100000000):
+    def __init__(self, engine='POLLY_SERVICE', polly_service_name='polly', max_cache_bytes=100000000,
+                 cache_storage='file', eviction_policy='lru', cache_dir='/tmp', trace_file=None, remote_cache=None,
+                 async_bookkeeping=False, error_cache_ttl=0.0, polly=None, canonical_master=False,
+                 trim_silence=False, prefetch=0, prefetch_budget=100, max_pinned_bytes=10000000, validate_voices=False):
         if engine not in self.ENGINES:
             msg = 'bad engine {} which is not one of {}'.format(engine, ', '.join(SpeechSynthesizer.ENGINES.keys()))
             raise SpeechSynthesizer.BadEngineError(msg)
+        if cache_storage not in self.CACHE_STORAGES:
+            msg = 'bad cache storage {} which is not one of {}'.format(
+                cache_storage, ', '.join(SpeechSynthesizer.CACHE_STORAGES.keys()))
+            raise SpeechSynthesizer.BadCacheStorageError(msg)
+        if (canonical_master or trim_silence) and not transcode.available():
+            raise ValueError('a canonical master and trimming silence need NumPy, which is not installed')
 
         engine_kwargs = {'polly_service_name': polly_service_name} if engine == 'POLLY_SERVICE' else {}
+        if engine == 'POLLY_LIBRARY':
+            # an AmazonPolly of the same process, e.g. in the combined node, is called directly
+            engine_kwargs = {'polly': polly, 'cache_dir': cache_dir}
         self.engine = self.ENGINES[engine](**engine_kwargs)
 
         self.default_text_type = 'text'
@@ -175,6 +323,86 @@ class SpeechSynthesizer:
         self.default_output_format = 'ogg_vorbis'
 
         self.max_cache_bytes = max_cache_bytes
+        # pinned utterances are never evicted and count against a budget of their own
+        self.max_pinned_bytes = max_pinned_bytes
+        self.cache_storage = cache_storage
+        self.cache_dir = cache_dir
+        self.eviction_policy = make_policy(eviction_policy)
+        self._eviction_policy_attached = False
+
+        # the source of request times and synthesis latencies, replaced by a virtual clock when replaying traces
+        self.clock = time.time
+        # every request to the cache is appended to the trace file if there is one, see tts.cachesim
+        self.trace = TraceWriter(trace_file) if trace_file else None
+
+        # a RemoteCache shared with other synthesizers, looked up after the local cache and before the engine
+        self.remote_cache = remote_cache
+        self.remote_write_back = RemoteWriteBack(remote_cache) if remote_cache else None
+
+        # a CacheReconciler started by advertise, its estimate of the cache size spares evictions a sum of the table
+        self.reconciler = None
+
+        # with asynchronous bookkeeping, inserts, touches and evictions are done by a CacheWriter after the response
+        self.cache_writer = CacheWriter(self._open_db) if async_bookkeeping else None
+
+        # requests the engine rejected for good are answered from here for a while, see tts.errorcache
+        self.error_cache = ErrorCache(ttl=error_cache_ttl) if error_cache_ttl > 0 else None
+
+        # with a canonical master, other formats and sample rates are derived from one pcm file, see tts.transcode
+        self.canonical_master = canonical_master
+        # new files have their leading and trailing silence trimmed before they are cached
+        self.trim_silence = trim_silence
+
+        # counters and latency histograms served by get_stats and published on /diagnostics
+        self.stats = SynthesizerStats()
+        # profiles requests while a session started by the profile service runs
+        self.profiler = RequestProfiler('synthesizer')
+
+        # the requests likely to come next, predicted or named in the metadata, are cached ahead, see tts.prefetch
+        self.prefetcher = Prefetcher(self._prefetch, count=prefetch, budget=prefetch_budget)
+
+        # with validate_voices, requests are checked against the voices of the engine before they are sent, if it
+        # can list them. The catalogue is fetched by the first request that is not cached.
+        self.voice_catalog = None
+        if validate_voices and hasattr(self.engine, 'describe_voices'):
+            self.voice_catalog = VoiceCatalog(self.engine.describe_voices,
+                                              cache_file=os.path.join(cache_dir, 'polly_voices.json'))
+
+        # the versions of the lexicons put through the polly node are part of the cache key, the polly node writes
+        # them to the same file in its cache directory
+        self.lexicon_index = LexiconIndex(os.path.join(cache_dir, INDEX_FILE_NAME))
+
+        # long form requests start synthesis tasks that are polled in the background, by cache key
+        self.task_poller = TaskPoller() if hasattr(self.engine, 'start_task') else None
+        self._tasks = {}
+        self._tasks_lock = threading.Lock()
+
+    def _open_db(self):
+        """Open the cache database with the configured storage.
+
+        A new connection is opened for every request because service requests are handled in different threads.
+        """
+        db_kwargs = {'db_location': os.path.join(self.cache_dir, 'polly.db')}
+        if self.cache_storage == 'pack':
+            db_kwargs['pack_location'] = os.path.join(self.cache_dir, 'polly.pack')
+        db = self.CACHE_STORAGES[self.cache_storage](**db_kwargs)
+        if not self._eviction_policy_attached:
+            self.eviction_policy.attach(db)
+            self._eviction_policy_attached = True
+        return db
+
+    def _bookkeep(self, db, task, tmp_filename=None, row=None):
+        """Run a task updating the cache DB, or queue it for the CacheWriter.
+
+        :param db: the cache DB of the request
+        :param task: a callable taking the DB
+        :param tmp_filename: the cache key of the utterance the task inserts, if any
+        :param row: the row the task inserts, served as a hit until the task has run
+        """
+        if self.cache_writer:
+            self.cache_writer.submit(task, tmp_filename, row)
+        else:
+            task(db)
 
     def _call_engine(self, **kw):
         """Call engine to do the job.
@@ -190,66 +418,491 @@ class SpeechSynthesizer:
         :param kw: what AmazonPolly needs to synthesize
         :return: response from AmazonPolly
         """
+        engine = self._compose_template if 'template_values' in kw else self.engine
+        if engine is self.engine and self._derivable(kw):
+            engine = self._derive_from_master
+        deadline = kw.pop('deadline', None)
+        # True pins the utterance, False unpins it, see _pin
+        pin = kw.pop('pin', None)
+        # only a request the engine synthesizes by itself is streamed, a composed template is played from its file
+        stream = kw.pop('stream', False) and engine is self.engine
+        long_form = kw.pop('long_form', False)
+        task_kw = dict((k, kw.pop(k)) for k in self.TASK_FIELDS if k in kw)
+        if long_form and (engine is not self.engine or 'output_path' in kw):
+            raise ValueError('long_form can not be combined with template_values or output_path')
+
         if 'output_path' not in kw:
-            tmp_filename = hashlib.md5(
-                json.dumps(kw, sort_keys=True)).hexdigest()
+            lexicon_versions = self.lexicon_index.versions(kw['lexicon_names']) if kw.get('lexicon_names') else None
+            tmp_filename = self._cache_key(kw, lexicon_versions)
             tmp_filepath = os.path.join(
-                os.sep, 'tmp', 'voice_{}'.format(tmp_filename))
+                self.cache_dir, 'voice_{}'.format(tmp_filename))
             kw['output_path'] = os.path.abspath(tmp_filepath)
             rospy.loginfo('managing file with name: {}'.format(tmp_filename))
+            # the deadline and streaming are passed on to the engine but are no part of the cache key
+            if deadline:
+                kw['deadline'] = deadline
+            if stream:
+                kw['stream'] = True
+
+            if self.error_cache:
+                error_result = self.error_cache.get(tmp_filename, self.clock())
+                if error_result is not None:
+                    rospy.loginfo('request was rejected before, returning the same error')
+                    self.stats.count('error_cache_hits')
+                    return error_result
 
             # because the hash will include information about any file ending choices, we only
             # need to look at the hash itself.
-            db = DB()
-            db_search_result = db.ex(
-                'SELECT file, audio_type FROM cache WHERE hash=?', tmp_filename).fetchone()
-            current_time = time.time()
-            file_found = False
-            if db_search_result:  # then there is data
-                # check if the file exists, if not, remove from db
-                # TODO: add a test that deletes a file without telling the db and tries to synthesize it
-                if os.path.exists(db_search_result['file']):
-                    file_found = True
-                    db.ex('update  cache set last_accessed=? where hash=?',
-                          current_time, tmp_filename)
-                    synth_result = PollyResponse(json.dumps({
-                        'Audio File': db_search_result['file'],
-                        'Audio Type': db_search_result['audio_type'],
-                        'Amazon Polly Response Metadata': ''
-                    }))
-                    rospy.loginfo('audio file was already cached at: %s',
-                                  db_search_result['file'])
-                else:
-                    rospy.logwarn(
-                        'A file in the database did not exist on the disk, removing from db')
-                    db.remove_file(db_search_result['file'])
-            if not file_found:  # havent cached this yet
-                rospy.loginfo('Caching file')
-                synth_result = self.engine(**kw)
-                res_dict = json.loads(synth_result.result)
-                if 'Exception' not in res_dict:
-                    file_name = res_dict['Audio File']
-                    if file_name:
-                        file_size = os.path.getsize(file_name)
-                        db.ex('''insert into cache(
-                            hash, file, audio_type, last_accessed,size)
-                            values (?,?,?,?,?)''', tmp_filename, file_name,
-                              res_dict['Audio Type'], current_time, file_size)
-                        rospy.loginfo(
-                            'generated new file, saved to %s and cached', file_name)
-                        # make sure the cache hasn't grown too big
-                        while db.get_size() > self.max_cache_bytes and db.get_num_files() > 1:
-                            remove_res = db.ex(
-                                'select file, min(last_accessed), size from cache'
-                            ).fetchone()
-                            db.remove_file(remove_res['file'])
-                            rospy.loginfo('removing %s to maintain cache size, new size: %i',
-                                          remove_res['file'], db.get_size())
+            db = self._open_db()
+            # only one process or thread looks up and synthesizes an utterance at a time. A composed
+            # template is not locked as a whole because each of its fragments is locked on its own.
+            lock = db.synthesis_lock(tmp_filename) if engine is self.engine else _unlocked()
+            with lock:
+                current_time = self.clock()
+                synth_result = self._lookup_cache(db, tmp_filename, current_time)
+                cached = False
+                if synth_result is None and self.remote_cache:
+                    synth_result = self._fetch_remote(db, tmp_filename, current_time, kw['output_path'], deadline)
+                    cached = synth_result is not None
+                if synth_result is None:  # havent cached this yet
+                    deadlines.check(deadline, 'synthesize')
+                    if engine is self.engine:
+                        self._validate_voice(kw, deadline)
+                    if long_form:
+                        return self._start_task(tmp_filename, dict(kw, **task_kw))
+                    rospy.loginfo('Caching file')
+                    synth_result, cached = self._synthesize_and_cache(db, engine, tmp_filename, current_time, **kw)
+            if pin is not None:
+                self._bookkeep(db, lambda db: self._pin(db, tmp_filename, pin))
+            if cached or pin is not None:
+                self._bookkeep(db, lambda db: self._evict(db, tmp_filename))
         else:
-            synth_result = self.engine(**kw)
+            deadlines.check(deadline, 'synthesize')
+            if deadline:
+                kw['deadline'] = deadline
+            if stream:
+                kw['stream'] = True
+            if engine is self.engine:
+                self._validate_voice(kw, deadline)
+            synth_result = engine(**kw)
 
         return synth_result
 
+    def _prefetch(self, kw):
+        """Synthesize and cache an utterance that is likely requested soon, unless it is cached already.
+
+        :param kw: the fields of the request
+        :return: whether the engine was called
+        """
+        tmp_filename = self._request_cache_key(kw)
+        if self.cache_writer and self.cache_writer.pending(tmp_filename):
+            return False
+        db = self._open_db()
+        if db.ex('SELECT hash FROM cache WHERE hash=?', tmp_filename).fetchone():
+            return False
+        if self.error_cache and self.error_cache.contains(tmp_filename, self.clock()):
+            return False
+        rospy.loginfo('prefetching {}'.format(tmp_filename))
+        self.stats.count('prefetches')
+        self._call_engine(**kw)
+        return True
+
+    def _validate_voice(self, kw, deadline=None):
+        """Raise an InvalidVoiceRequestError if the engine would reject the voice, language or sample rate.
+
+        Nothing is checked when the voice catalogue can't be fetched, the engine will tell then. Fetching it is
+        given up at the deadline of the request, and after ``VOICE_CATALOG_TIMEOUT`` seconds at the latest, because
+        it is done while the lock of the utterance is held.
+
+        :param kw: what the engine needs to synthesize
+        :param deadline: the deadline of the request, 0 or None if it has none
+        """
+        if self.voice_catalog is None:
+            return
+        fetch_deadline = time.time() + self.VOICE_CATALOG_TIMEOUT
+        if deadline:
+            fetch_deadline = min(deadline, fetch_deadline)
+        try:
+            self.voice_catalog.validate(kw.get('voice_id', self.default_voice_id), kw.get('language_code', ''),
+                                        kw.get('output_format', ''), kw.get('sample_rate', ''), fetch_deadline)
+        except InvalidVoiceRequestError:
+            raise
+        except Exception as e:
+            rospy.logwarn('not validating the voice, the voice catalogue is unavailable: %s', e)
+
+    def _lookup_cache(self, db, tmp_filename, current_time):
+        """Look an utterance up in the cache and record the hit.
+
+        :param db: the cache DB
+        :param tmp_filename: the cache key of the utterance
+        :param current_time: the time of the request
+        :return: a PollyResponse with the cached file, or None on a miss
+        """
+        db_search_result = self.cache_writer.pending(tmp_filename) if self.cache_writer else None
+        if db_search_result is None:
+            db_search_result = db.ex(
+                'SELECT * FROM cache WHERE hash=?', tmp_filename).fetchone()
+        if not db_search_result:
+            return None
+
+        # check if the file exists, if not, remove from db
+        if not db.ensure_file(tmp_filename, db_search_result['file']):
+            rospy.logwarn(
+                'A file in the database did not exist on the disk, removing from db')
+            # a pinned row is kept, so the audio is still pinned once it is synthesized again
+            if not db.ex('SELECT pinned FROM cache WHERE hash=? AND pinned=1', tmp_filename).fetchone():
+                db.remove_file(db_search_result['file'])
+            return None
+
+        priority = self.eviction_policy.priority(
+            current_time, db_search_result['access_count'] + 1, db_search_result['size'],
+            db_search_result['synth_latency'])
+        self._bookkeep(db, lambda db: db.touch(tmp_filename, current_time, priority))
+        rospy.loginfo('audio file was already cached at: %s',
+                      db_search_result['file'])
+        self.stats.count('hits')
+        if self.trace:
+            self.trace.record(current_time, tmp_filename, db_search_result['size'], True, 0.0)
+        return PollyResponse(json.dumps({
+            'Audio File': db_search_result['file'],
+            'Audio Type': db_search_result['audio_type'],
+            'Amazon Polly Response Metadata': ''
+        }))
+
+    def _fetch_remote(self, db, tmp_filename, current_time, output_path, deadline=None):
+        """Look an utterance up in the remote cache and add it to the local cache if it is there.
+
+        Errors of the remote cache are logged and treated as a miss.
+
+        :param db: the cache DB
+        :param tmp_filename: the cache key of the utterance
+        :param current_time: the time of the request
+        :param output_path: where to save the audio
+        :param deadline: the deadline of the request, 0 or None if it has none
+        :return: a PollyResponse with the fetched file, or None on a miss
+        """
+        try:
+            fetched = self.remote_cache.get(tmp_filename, output_path, deadline)
+        except Exception as e:
+            rospy.logwarn('remote cache lookup of %s failed: %s', tmp_filename, e)
+            return None
+        if fetched is None:
+            return None
+
+        file_name, audio_type = fetched
+        fetch_latency = self.clock() - current_time
+        file_size = os.path.getsize(file_name)
+        self._add_file(db, tmp_filename, file_name, audio_type, current_time, file_size, fetch_latency)
+        rospy.loginfo('fetched %s from the remote cache', file_name)
+        self.stats.count('remote_hits')
+        if self.trace:
+            self.trace.record(current_time, tmp_filename, file_size, True, 0.0)
+        return PollyResponse(json.dumps({
+            'Audio File': file_name,
+            'Audio Type': audio_type,
+            'Amazon Polly Response Metadata': ''
+        }))
+
+    def _synthesize_and_cache(self, db, engine, tmp_filename, current_time, **kw):
+        """Call the engine and add the new file to the cache.
+
+        :param db: the cache DB
+        :param engine: the engine to call
+        :param tmp_filename: the cache key of the utterance
+        :param current_time: the time of the request
+        :param kw: what the engine needs to synthesize, including ``output_path``
+        :return: the engine response and whether a file was added to the cache
+        """
+        synth_result = engine(**kw)
+        synth_latency = self.clock() - current_time
+        res_dict = json.loads(synth_result.result)
+        file_size = 0
+        cached = False
+        # a composed template or a derived format calls the engine through _call_engine for its fragments or its
+        # master, which record their own misses, so only a call of the engine itself is a miss
+        leaf = engine is self.engine
+        if 'Exception' in res_dict:
+            exception = res_dict['Exception']
+            if leaf and isinstance(exception, dict):
+                self.stats.miss(synth_latency, exception.get('Code') or exception.get('Name') or 'Exception')
+            elif leaf:
+                self.stats.miss(synth_latency, 'Exception')
+            error_code = client_error_code(res_dict)
+            if error_code and self.error_cache:
+                self.error_cache.put(tmp_filename, error_code, synth_result, current_time)
+        else:
+            if leaf:
+                self.stats.miss(synth_latency)
+            file_name = res_dict['Audio File']
+            if file_name:
+                if self.trim_silence:
+                    self._trim_silence(file_name, kw)
+                file_size = os.path.getsize(file_name)
+                self._add_file(db, tmp_filename, file_name, res_dict['Audio Type'], current_time, file_size,
+                               synth_latency)
+                rospy.loginfo(
+                    'generated new file, saved to %s and cached', file_name)
+                cached = True
+                if self.remote_write_back:
+                    self.remote_write_back.put(tmp_filename, file_name, res_dict['Audio Type'])
+        if self.trace:
+            self.trace.record(current_time, tmp_filename, file_size, False, synth_latency)
+        return synth_result, cached
+
+    def _trim_silence(self, file_name, kw):
+        """Trim the leading and trailing silence of a new file before it is cached, see ``tts.transcode``.
+
+        Formats that can't be decoded are left as they are, and so is a file that fails to be trimmed.
+
+        :param file_name: the new audio file
+        :param kw: what the engine was asked to synthesize
+        """
+        output_format = kw.get('output_format', '')
+        if not transcode.can_trim(output_format):
+            return
+        try:
+            trimmed = transcode.trim_file(file_name, output_format, kw.get('sample_rate') or 22050)
+            rospy.loginfo('trimmed %s samples of silence from %s', trimmed, file_name)
+        except Exception as e:
+            rospy.logwarn('failed to trim the silence of %s: %s', file_name, e)
+
+    def _start_task(self, tmp_filename, kw):
+        """Start a synthesis task for an utterance, unless one is already running, and return its status.
+
+        :param tmp_filename: the cache key of the utterance
+        :param kw: what the engine needs to synthesize, including ``output_path`` and the S3 bucket
+        :return: a PollyResponse with the id and the status of the task and an empty audio file
+        """
+        if self.task_poller is None:
+            raise ValueError('the engine can not run synthesis tasks')
+        with self._tasks_lock:
+            task = self._tasks.get(tmp_filename)
+            if task is None:
+                output_path = kw.pop('output_path')
+                task = self.engine.start_task(**kw)
+                self._tasks[tmp_filename] = task
+                started = self.clock()
+                rospy.loginfo('started synthesis task %s', task['TaskId'])
+                self.task_poller.watch(
+                    lambda: self._poll_task(tmp_filename, task['TaskId'], output_path, started),
+                    on_timeout=lambda: self._forget_task(tmp_filename))
+        return PollyResponse(json.dumps({
+            'Audio File': '',
+            'Audio Type': '',
+            'Task Id': task['TaskId'],
+            'Task Status': task['TaskStatus'],
+        }))
+
+    def _poll_task(self, tmp_filename, task_id, output_path, started):
+        """Check a synthesis task and add its audio to the cache once it is done.
+
+        :return: True if the task doesn't need to be polled any more
+        """
+        res = self.engine.get_task(task_id, output_path)
+        task = res['SynthesisTask']
+        with self._tasks_lock:
+            self._tasks[tmp_filename] = task
+        if 'Audio File' in res:
+            file_name = res['Audio File']
+            current_time = self.clock()
+            file_size = os.path.getsize(file_name)
+            db = self._open_db()
+            self._add_file(db, tmp_filename, file_name, res['Audio Type'], current_time, file_size,
+                           current_time - started)
+            self._bookkeep(db, lambda db: self._evict(db, tmp_filename))
+            if self.remote_write_back:
+                self.remote_write_back.put(tmp_filename, file_name, res['Audio Type'])
+            rospy.loginfo('synthesis task %s is done, cached %s', task_id, file_name)
+        elif task['TaskStatus'] == 'failed':
+            rospy.logwarn('synthesis task %s failed: %s', task_id, task.get('TaskStatusReason'))
+        else:
+            return False
+        self._forget_task(tmp_filename)
+        return True
+
+    def _forget_task(self, tmp_filename):
+        with self._tasks_lock:
+            self._tasks.pop(tmp_filename, None)
+
+    def _add_file(self, db, tmp_filename, file_name, audio_type, current_time, file_size, latency):
+        """Record a new file in the cache with the priority given by the eviction policy."""
+        priority = self.eviction_policy.priority(current_time, 1, file_size, latency)
+        row = {'file': file_name, 'audio_type': audio_type, 'size': file_size, 'access_count': 1,
+               'synth_latency': latency}
+        self._bookkeep(db, lambda db: db.add_file(tmp_filename, file_name, audio_type, current_time, file_size,
+                                                  latency, priority), tmp_filename, row)
+        if self.reconciler:
+            self.reconciler.added(file_size)
+
+    def _evict(self, db, keep):
+        """Evict utterances until the cache is within its size limit.
+
+        Evictions of different processes sharing the cache are serialized. Nothing is done while the estimate of
+        the reconciler, which counts pinned audio too, is within the limit.
+
+        :param db: the cache DB
+        :param keep: the cache key of an utterance that must not be evicted
+        """
+        estimated_bytes = self.reconciler.estimated_bytes() if self.reconciler else None
+        if estimated_bytes is not None and estimated_bytes <= self.max_cache_bytes:
+            return
+        with db.eviction_lock():
+            # the sizes are summed once and each victim is subtracted, files added by other processes in the
+            # meantime are left to their own evictions
+            cache_bytes = db.get_size(pinned=False)
+            num_files = db.get_num_files(pinned=False)
+            while cache_bytes > self.max_cache_bytes and num_files > 1:
+                remove_res = self.eviction_policy.victim(db, exclude=keep)
+                if remove_res is None:
+                    break
+                db.remove_file(remove_res['file'])
+                self.eviction_policy.evicted(remove_res)
+                self.stats.evicted(remove_res['size'])
+                cache_bytes -= remove_res['size']
+                num_files -= 1
+                rospy.loginfo('removing %s to maintain cache size, new size: %i',
+                              remove_res['file'], cache_bytes)
+
+    def _pin(self, db, tmp_filename, pinned):
+        """Pin a cached utterance so that it is never evicted, or unpin it.
+
+        An utterance is only pinned if the pinned utterances stay within ``max_pinned_bytes``.
+
+        :param db: the cache DB
+        :param tmp_filename: the cache key of the utterance
+        :param pinned: False to unpin
+        :return: whether the utterance is cached and was pinned or unpinned
+        """
+        with db.eviction_lock():
+            row = db.ex('SELECT size, pinned FROM cache WHERE hash=?', tmp_filename).fetchone()
+            if row is None:
+                rospy.logwarn('{} is not cached, not {}pinning it'.format(tmp_filename, '' if pinned else 'un'))
+                return False
+            if pinned and not row['pinned'] and db.get_size(pinned=True) + row['size'] > self.max_pinned_bytes:
+                rospy.logwarn('pinning {} would take more than the {} bytes for pinned audio, not pinning it'.format(
+                    tmp_filename, self.max_pinned_bytes))
+                return False
+            return db.pin(tmp_filename, pinned)
+
+    def _request_cache_key(self, kw):
+        """The cache key that ``_call_engine`` gives a request without ``output_path``."""
+        lexicon_versions = self.lexicon_index.versions(kw['lexicon_names']) if kw.get('lexicon_names') else None
+        return self._cache_key(dict((k, v) for k, v in kw.items() if k not in self.UNCACHED_FIELDS),
+                               lexicon_versions)
+
+    @staticmethod
+    def _cache_key(kw, lexicon_versions=None):
+        """The hash identifying an utterance in the cache.
+
+        :param kw: what the engine needs to synthesize, without ``output_path``
+        :param lexicon_versions: the versions of the lexicons in ``lexicon_names``, so that changing a lexicon
+                                 invalidates the utterances synthesized with it
+        :return: a hex string
+        """
+        if lexicon_versions:
+            kw = dict(kw, lexicon_versions=lexicon_versions)
+        return hashlib.md5(json.dumps(kw, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _split_template(text, template_values):
+        """Split a ``str.format`` template into the text fragments to be synthesized.
+
+        Surrounding whitespace is stripped from each fragment and empty fragments are dropped, so that
+        ``'Battery at {N} percent'`` with ``{'N': 42}`` gives ``['Battery at', '42', 'percent']``.
+
+        :param text: the template
+        :param template_values: a dict with the values of the template fields
+        :return: a list of strings
+        """
+        formatter = string.Formatter()
+        fragments = []
+        for literal_text, field_name, format_spec, conversion in formatter.parse(text):
+            fragments.append(literal_text)
+            if field_name is not None:
+                value, _ = formatter.get_field(field_name, (), template_values)
+                value = formatter.convert_field(value, conversion)
+                fragments.append(formatter.format_field(value, format_spec))
+        return [f.strip() for f in fragments if f.strip()]
+
+    def _derivable(self, kw):
+        """Return whether the audio of a request can be derived from its canonical master instead of synthesized.
+
+        :param kw: what the engine needs to synthesize
+        """
+        if not self.canonical_master or kw.get('long_form') or kw.get('speech_mark_types') or kw.get('stream'):
+            return False
+        output_format = kw.get('output_format', '').lower()
+        if output_format == 'pcm' and str(kw.get('sample_rate')) == str(transcode.MASTER_SAMPLE_RATE):
+            return False  # it is the master
+        return transcode.can_derive(output_format)
+
+    def _derive_from_master(self, **kw):
+        """An engine that derives the requested format and sample rate from the canonical master of the utterance.
+
+        The master, pcm at ``transcode.MASTER_SAMPLE_RATE``, goes through ``_call_engine`` by itself, so it is looked
+        up in and added to the cache like any other utterance and is synthesized once for all the variants.
+
+        :param kw: what the engine needs to synthesize
+        :return: a SynthesizerResponse with the derived file, or the failed response for the master
+        """
+        output_path = kw.pop('output_path')
+        output_format = kw['output_format'].lower()
+        master_kw = dict(kw, output_format='pcm', sample_rate=str(transcode.MASTER_SAMPLE_RATE))
+        synth_result = self._call_engine(**master_kw)
+        res_dict = json.loads(synth_result.result)
+        if 'Exception' in res_dict:
+            return synth_result
+
+        output_path = transcode.with_extension(output_path, output_format)
+        with audio.publishing(output_path) as tmp_path:
+            transcode.derive(res_dict['Audio File'], tmp_path, output_format, kw['sample_rate'])
+
+        return SynthesizerResponse(json.dumps({
+            'Audio File': output_path,
+            'Audio Type': transcode.AUDIO_TYPES[output_format],
+            'Amazon Polly Response Metadata': ''
+        }))
+
+    def _compose_template(self, **kw):
+        """An engine that synthesizes a template fragment by fragment and concatenates the results.
+
+        Each fragment goes through ``_call_engine`` by itself, so it is looked up in and added to the cache
+        like any other utterance. Only pcm output can be composed because the fragments are joined frame by frame.
+        Each fragment is read as soon as it is returned, because caching the next ones may evict it or, with the
+        pack storage, delete its loose copy.
+
+        :param kw: what the engine needs to synthesize, plus ``template_values``
+        :return: a SynthesizerResponse with the composed file, or the first failed fragment response
+        """
+        template_values = kw.pop('template_values')
+        output_path = kw.pop('output_path')
+
+        if kw['output_format'].lower() != 'pcm':
+            raise ValueError('template composition requires pcm output, got {}'.format(kw['output_format']))
+        if kw['text_type'] != 'text':
+            raise ValueError('template composition only supports plain text, got {}'.format(kw['text_type']))
+
+        fragment_audio = []
+        for fragment in self._split_template(kw['text'], template_values):
+            fragment_kw = dict(kw, text=fragment)
+            synth_result = self._call_engine(**fragment_kw)
+            res_dict = json.loads(synth_result.result)
+            if 'Exception' in res_dict:
+                return synth_result
+            with open(res_dict['Audio File'], 'rb') as f:
+                fragment_audio.append(io.BytesIO(f.read()))
+
+        if not output_path.endswith('.wav'):
+            output_path += '.wav'
+        with audio.publishing(output_path) as tmp_path:
+            audio.concatenate_wav(fragment_audio, tmp_path)
+
+        return SynthesizerResponse(json.dumps({
+            'Audio File': output_path,
+            'Audio Type': 'audio/pcm',
+            'Amazon Polly Response Metadata': ''
+        }))
+
     def _parse_request_or_raise(self, request):
         """It will raise if request is malformed.
 
@@ -258,7 +911,8 @@ class SpeechSynthesizer:
         """
         md = json.loads(request.metadata) if request.metadata else {}
 
-        md['output_format'] = md.get('output_format', self.default_output_format)
+        default_output_format = 'pcm' if 'template_values' in md else self.default_output_format
+        md['output_format'] = md.get('output_format', default_output_format)
         md['voice_id'] = md.get('voice_id', self.default_voice_id)
         md['sample_rate'] = md.get('sample_rate', '16000' if md['output_format'].lower() == 'pcm' else '22050')
         md['text_type'] = md.get('text_type', self.default_text_type)
@@ -275,13 +929,97 @@ class SpeechSynthesizer:
         :return: a SynthesizerResponse
         """
         rospy.loginfo(request)
+        started = time.time()
+        with self.profiler.request():
+            try:
+                kws = self._parse_request_or_raise(request)
+                prefetch_hints = kws.pop('prefetch', None)
+                res = self._call_engine(**kws).result
+
+                if 'output_path' not in kws and not kws.get('long_form'):
+                    self.prefetcher.requested(kws, prefetch_hints)
+                self.stats.request(time.time() - started)
+                return SynthesizerResponse(res)
+            except Exception as e:
+                self.stats.request(time.time() - started, failed=True)
+                return SynthesizerResponse('Exception: {}'.format(e))
+
+    def get_stats(self):
+        """Return the statistics of the synthesizer and of its cache, see ``tts.stats``."""
+        stats = self.stats.snapshot()
+        db = self._open_db()
+        cache_bytes = db.get_size(pinned=False)
+        stats['cache'] = {
+            'bytes': cache_bytes,
+            'max_bytes': self.max_cache_bytes,
+            'fill_ratio': float(cache_bytes) / self.max_cache_bytes if self.max_cache_bytes else None,
+            'files': db.get_num_files(),
+            'pinned_bytes': db.get_size(pinned=True),
+            'max_pinned_bytes': self.max_pinned_bytes,
+            'pinned_files': db.get_num_files(pinned=True),
+        }
+        if self.reconciler and self.reconciler.total_bytes is not None:
+            stats['cache']['disk_bytes'] = self.reconciler.total_bytes
+        if self.error_cache:
+            stats['error_cache'] = self.error_cache.stats()
+        if self.task_poller:
+            stats['pending_tasks'] = self.task_poller.pending()
+        return stats
+
+    def _pin_request_handler(self, request):
+        """The callback of the pin service.
+
+        An utterance that is pinned is synthesized first if it is not cached yet.
+
+        :param request: an instance of PinRequest, a SynthesizerRequest with ``pinned``
+        :return: a PinResponse with the result of the synthesis and whether the utterance is pinned now
+        """
+        from tts.srv import PinResponse
+        rospy.loginfo(request)
         try:
             kws = self._parse_request_or_raise(request)
-            res = self._call_engine(**kws).result
+            kws.pop('pin', None)
+            res = {}
+            if request.pinned:
+                res = json.loads(self._call_engine(**kws).result)
+                if 'Exception' in res:
+                    return PinResponse(json.dumps(res))
+                if self.cache_writer:
+                    self.cache_writer.flush()
+            db = self._open_db()
+            res['Pinned'] = self._pin(db, self._request_cache_key(kws), request.pinned) and request.pinned
+            self._evict(db, None)
+            return PinResponse(json.dumps(res))
+        except Exception as e:
+            return PinResponse('Exception: {}'.format(e))
 
-            return SynthesizerResponse(res)
+    def _stats_request_handler(self, request):
+        """The callback of the get_stats service, a std_srvs/Trigger answered with the statistics as JSON."""
+        from std_srvs.srv import TriggerResponse
+        try:
+            return TriggerResponse(success=True, message=json.dumps(self.get_stats()))
         except Exception as e:
-            return SynthesizerResponse('Exception: {}'.format(e))
+            return TriggerResponse(success=False, message='Exception: {}'.format(e))
+
+    def _publish_diagnostics(self, publisher):
+        """Publish the statistics as a diagnostic status, a warning if half of the engine calls failed."""
+        from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+        stats = self.get_stats()
+        values = [('uptime', stats['uptime']), ('hit_ratio', stats['hit_ratio']),
+                  ('engine_error_ratio', stats['engine_error_ratio']),
+                  ('evictions_per_hour', stats['evictions_per_hour']),
+                  ('request_latency_p50', stats['request_latency']['p50']),
+                  ('request_latency_p99', stats['request_latency']['p99']),
+                  ('synthesis_latency_p50', stats['synthesis_latency']['p50']),
+                  ('synthesis_latency_p99', stats['synthesis_latency']['p99'])]
+        values.extend(sorted(stats['counters'].items()))
+        values.extend(('cache_' + k, v) for k, v in sorted(stats['cache'].items()))
+
+        status = DiagnosticStatus(name='tts: synthesizer', hardware_id=rospy.get_name(), level=DiagnosticStatus.OK,
+                                  message='OK', values=[KeyValue(key=k, value=str(v)) for k, v in values])
+        if stats['engine_error_ratio'] is not None and stats['engine_error_ratio'] >= 0.5:
+            status.level, status.message = DiagnosticStatus.WARN, 'most engine calls failed'
+        publisher.publish(DiagnosticArray(header=rospy.Header(stamp=rospy.Time.now()), status=[status]))
 
     def start(self, node_name='synthesizer_node', service_name='synthesizer'):
         """The entry point of a ROS service node.
@@ -291,12 +1029,60 @@ class SpeechSynthesizer:
         :return: it doesn't return
         """
         rospy.init_node(node_name)
+        self.advertise(service_name)
+        rospy.spin()
+
+    def advertise(self, service_name='synthesizer'):
+        """Advertise the service in the node of this process and start the background work of the cache.
 
+        If the private parameter ``cache_reconcile_interval`` is set, a CacheReconciler checks a batch of the cache
+        every that many seconds in the background. The statistics are served by ``<service>/get_stats``
+        and published on ``/diagnostics`` every ``~stats_interval`` seconds, 10 by default, 0 to disable. Requests
+        are profiled on demand through ``<service>/profile``, see ``tts.profiling``.
+
+        :param service_name:  name of ROS service
+        :return: the rospy.Service
+        """
         service = rospy.Service(service_name, Synthesizer, self._node_request_handler)
 
-        rospy.loginfo('{} running: {}'.format(node_name, service.uri))
+        rospy.loginfo('{} running: {}'.format(service_name, service.uri))
+        self.profiler.advertise(service_name)
+        from tts.srv import Pin
+        self._pin_service = rospy.Service('{}/pin'.format(service_name), Pin, self._pin_request_handler)
 
-        rospy.spin()
+        try:
+            from std_srvs.srv import Trigger
+            self._stats_service = rospy.Service('{}/get_stats'.format(service_name), Trigger,
+                                                self._stats_request_handler)
+        except ImportError:
+            rospy.logwarn('std_srvs is not installed, not advertising {}/get_stats'.format(service_name))
+
+        stats_interval = rospy.get_param('~stats_interval', 10.0)
+        if stats_interval > 0:
+            try:
+                from diagnostic_msgs.msg import DiagnosticArray
+                publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+                self._stats_timer = rospy.Timer(rospy.Duration(stats_interval),
+                                                lambda event: self._publish_diagnostics(publisher))
+            except ImportError:
+                rospy.logwarn('diagnostic_msgs is not installed, not publishing diagnostics')
+
+        if self.trace:
+            rospy.on_shutdown(self.trace.close)
+        if self.remote_write_back:
+            rospy.on_shutdown(self.remote_write_back.flush)
+        if self.cache_writer:
+            rospy.on_shutdown(self.cache_writer.stop)
+        if self.task_poller:
+            rospy.on_shutdown(self.task_poller.stop)
+
+        reconcile_interval = rospy.get_param('~cache_reconcile_interval', 0.0)
+        if reconcile_interval > 0:
+            self.reconciler = CacheReconciler(self._open_db, cache_dir=self.cache_dir, interval=reconcile_interval)
+            self.reconciler.start()
+            rospy.on_shutdown(self.reconciler.stop)
+
+        return service
 
 
 def main():
@@ -317,6 +1103,41 @@ def main():
     parser.add_option("-p", "--polly-service-name", dest="polly_service_name", default='polly',
                       help="name of the polly service",
                       metavar="POLLY_SERVICE_NAME")
+    parser.add_option("-d", "--cache-dir", dest="cache_dir", default='/tmp',
+                      help="directory of the cache, the same as the polly node's",
+                      metavar="CACHE_DIR")
+    parser.add_option("-c", "--cache-storage", dest="cache_storage", default='file',
+                      help="how cached audio is stored, 'file' for one file per utterance or 'pack' for a pack file",
+                      metavar="CACHE_STORAGE")
+    parser.add_option("-v", "--eviction-policy", dest="eviction_policy", default='lru',
+                      help="how cached audio is evicted, one of lru, lfu, gds or gdsf",
+                      metavar="EVICTION_POLICY")
+    parser.add_option("-t", "--trace-file", dest="trace_file", default=None,
+                      help="append a record of every cache access to this file",
+                      metavar="TRACE_FILE")
+    parser.add_option("-r", "--remote-cache", dest="remote_cache", default=None,
+                      help="URL of a cache shared with other synthesizers, http(s):// or a directory",
+                      metavar="REMOTE_CACHE")
+    parser.add_option("--error-cache-ttl", dest="error_cache_ttl", type="float", default=0.0,
+                      help="seconds to answer a request rejected by the engine with the same error, 0 to disable",
+                      metavar="ERROR_CACHE_TTL")
+    parser.add_option("-a", "--async-bookkeeping", dest="async_bookkeeping", action="store_true", default=False,
+                      help="update the cache database and evict in the background, after responding")
+    parser.add_option("-m", "--canonical-master", dest="canonical_master", action="store_true", default=False,
+                      help="synthesize every utterance once as pcm and derive other formats and sample rates from it")
+    parser.add_option("--trim-silence", dest="trim_silence", action="store_true", default=False,
+                      help="trim the leading and trailing silence of new audio before caching it")
+    parser.add_option("--max-pinned-bytes", dest="max_pinned_bytes", type="int", default=10000000,
+                      help="bytes of pinned audio, which is never evicted",
+                      metavar="MAX_PINNED_BYTES")
+    parser.add_option("--validate-voices", dest="validate_voices", action="store_true", default=False,
+                      help="check the voice, language and sample rate of requests against the voices of the engine")
+    parser.add_option("--prefetch", dest="prefetch", type="int", default=0,
+                      help="number of likely next requests to synthesize ahead after every request, 0 to disable",
+                      metavar="PREFETCH")
+    parser.add_option("--prefetch-budget", dest="prefetch_budget", type="int", default=100,
+                      help="number of times per hour the engine may be called to prefetch",
+                      metavar="PREFETCH_BUDGET")
 
     (options, args) = parser.parse_args()
 
@@ -324,11 +1145,38 @@ def main():
     service_name = options.service_name
     engine = options.engine
     polly_service_name = options.polly_service_name
+    synthesizer_kwargs = {}
+    if options.cache_dir != '/tmp':
+        synthesizer_kwargs['cache_dir'] = options.cache_dir
+    if options.cache_storage != 'file':
+        synthesizer_kwargs['cache_storage'] = options.cache_storage
+    if options.eviction_policy != 'lru':
+        synthesizer_kwargs['eviction_policy'] = options.eviction_policy
+    if options.trace_file:
+        synthesizer_kwargs['trace_file'] = options.trace_file
+    if options.remote_cache:
+        synthesizer_kwargs['remote_cache'] = make_remote_cache(options.remote_cache)
+    if options.async_bookkeeping:
+        synthesizer_kwargs['async_bookkeeping'] = True
+    if options.error_cache_ttl:
+        synthesizer_kwargs['error_cache_ttl'] = options.error_cache_ttl
+    if options.canonical_master:
+        synthesizer_kwargs['canonical_master'] = True
+    if options.trim_silence:
+        synthesizer_kwargs['trim_silence'] = True
+    if options.max_pinned_bytes != 10000000:
+        synthesizer_kwargs['max_pinned_bytes'] = options.max_pinned_bytes
+    if options.validate_voices:
+        synthesizer_kwargs['validate_voices'] = True
+    if options.prefetch:
+        synthesizer_kwargs['prefetch'] = options.prefetch
+    if options.prefetch_budget != 100:
+        synthesizer_kwargs['prefetch_budget'] = options.prefetch_budget
 
     if engine == 'POLLY_SERVICE':
-        synthesizer = SpeechSynthesizer(engine=engine, polly_service_name=polly_service_name)
+        synthesizer = SpeechSynthesizer(engine=engine, polly_service_name=polly_service_name, **synthesizer_kwargs)
     else:
-        synthesizer = SpeechSynthesizer(engine=engine)
+        synthesizer = SpeechSynthesizer(engine=engine, **synthesizer_kwargs)
     synthesizer.start(node_name=node_name, service_name=service_name)
 
 
@@ -0,0 +1,101 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Polling of long running synthesis tasks.
+
+A text that is too long for SynthesizeSpeech is synthesized by a StartSpeechSynthesisTask that takes from seconds
+to minutes. The synthesizer hands the task to a ``TaskPoller`` and answers right away. The poller checks every task
+from a single background thread, first after ``initial_delay`` seconds and then less and less often up to every
+``max_delay`` seconds, until the task is finished or ``timeout`` seconds have passed.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+import rospy
+
+
+class TaskPoller(object):
+    """Calls the poll function of every watched task with exponential backoff."""
+
+    def __init__(self, initial_delay=1.0, max_delay=30.0, backoff=2.0, timeout=3600.0, clock=time.time):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.clock = clock
+        self._due = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def watch(self, poll, on_timeout=None):
+        """Start polling a task.
+
+        :param poll: a callable returning True once the task no longer needs polling. Exceptions are logged and
+                     the task is polled again later.
+        :param on_timeout: called if the task is still not finished after ``timeout`` seconds
+        """
+        now = self.clock()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='task_poller')
+                self._thread.daemon = True
+                self._thread.start()
+            heapq.heappush(self._due, (now + self.initial_delay, next(self._seq),
+                                       (poll, on_timeout, now + self.timeout, self.initial_delay)))
+            self._cond.notify()
+
+    def pending(self):
+        """Return the number of tasks being polled."""
+        with self._cond:
+            return len(self._due)
+
+    def stop(self):
+        """Stop polling, the tasks keep running in the service."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._due or self._due[0][0] > self.clock()):
+                    self._cond.wait(self._due[0][0] - self.clock() if self._due else None)
+                if self._stopped:
+                    return
+                _, _, (poll, on_timeout, give_up_at, delay) = heapq.heappop(self._due)
+
+            try:
+                finished = poll()
+            except Exception as e:
+                rospy.logwarn('failed to poll a synthesis task: %s', e)
+                finished = False
+            if finished:
+                continue
+
+            now = self.clock()
+            if now >= give_up_at:
+                rospy.logwarn('gave up on a synthesis task after %s seconds', self.timeout)
+                if on_timeout:
+                    on_timeout()
+                continue
+            delay = min(delay * self.backoff, self.max_delay)
+            with self._cond:
+                heapq.heappush(self._due, (min(now + delay, give_up_at), next(self._seq),
+                                           (poll, on_timeout, give_up_at, delay)))
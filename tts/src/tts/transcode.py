@@ -0,0 +1,194 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Deriving audio in other formats and sample rates from a canonical pcm master, and trimming silence.
+
+The synthesizer can ask Amazon Polly for every utterance once, as pcm at ``MASTER_SAMPLE_RATE``, the highest rate
+Amazon Polly has for pcm, and make the requested format and sample rate from it locally::
+
+    derive('/tmp/voice_master.wav', '/tmp/voice_derived.ogg', 'ogg_vorbis', 22050)
+
+Resampling is done with NumPy in the frequency domain. pcm is written as wav, ogg_vorbis and mp3 are encoded by
+``ffmpeg``, which is optional: without it only pcm can be derived. Audio derived at a rate above the master's has no
+more bandwidth than the master.
+
+Amazon Polly's audio starts and ends with a few hundred milliseconds of silence. ``trim_file`` cuts it off, keeping
+a little padding, so playback starts speaking right away::
+
+    trim_file('/tmp/voice_123.ogg', 'ogg_vorbis', 22050)
+"""
+
+import subprocess
+import wave
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from tts import audio
+
+MASTER_SAMPLE_RATE = 16000
+
+# what Amazon Polly answers as content type and the extension the polly node gives the file, by output format
+AUDIO_TYPES = {'pcm': 'audio/pcm', 'ogg_vorbis': 'audio/ogg', 'mp3': 'audio/mpeg'}
+FILE_EXTENSIONS = {'pcm': '.wav', 'ogg_vorbis': '.ogg', 'mp3': '.mp3'}
+
+# the ffmpeg encoder and container of the compressed output formats
+ENCODERS = {'ogg_vorbis': ('libvorbis', 'ogg'), 'mp3': ('libmp3lame', 'mp3')}
+
+
+def available():
+    """Return whether NumPy is installed, which deriving needs."""
+    return numpy is not None
+
+
+def can_derive(output_format):
+    """Return whether audio in output_format can be derived from a master."""
+    output_format = output_format.lower()
+    if numpy is None or output_format not in FILE_EXTENSIONS:
+        return False
+    return output_format == 'pcm' or which('ffmpeg') is not None
+
+
+def with_extension(output_path, output_format):
+    """Add the extension of output_format to output_path unless it has it already."""
+    ext = FILE_EXTENSIONS[output_format.lower()]
+    return output_path if output_path.endswith(ext) else output_path + ext
+
+
+def read_wav(wav_filename):
+    """Return the samples of a 16-bit mono wav file as an int16 array, and its sample rate."""
+    wavf = wave.open(wav_filename, 'rb')
+    try:
+        if wavf.getnchannels() != 1 or wavf.getsampwidth() != 2:
+            raise ValueError('{} is not 16-bit mono'.format(wav_filename))
+        frames = wavf.readframes(wavf.getnframes())
+        return numpy.frombuffer(frames, dtype='<i2'), wavf.getframerate()
+    finally:
+        wavf.close()
+
+
+def resample(samples, from_rate, to_rate):
+    """Resample int16 samples by truncating or zero padding their spectrum.
+
+    :param samples: an int16 array
+    :param from_rate: the sample rate of samples
+    :param to_rate: the sample rate to return
+    :return: an int16 array at to_rate
+    """
+    if from_rate == to_rate or len(samples) == 0:
+        return samples
+    n = len(samples)
+    m = int(round(n * float(to_rate) / from_rate))
+    spectrum = numpy.fft.rfft(samples.astype(numpy.float64))
+    resized = numpy.zeros(m // 2 + 1, dtype=spectrum.dtype)
+    k = min(len(spectrum), len(resized))
+    resized[:k] = spectrum[:k]
+    resampled = numpy.fft.irfft(resized, m) * (float(m) / n)
+    return numpy.clip(numpy.round(resampled), -32768, 32767).astype('<i2')
+
+
+def encode(samples, sample_rate, output_filename, output_format):
+    """Write int16 samples to output_filename in output_format."""
+    output_format = output_format.lower()
+    if output_format == 'pcm':
+        audio.write_wav(output_filename, samples.astype('<i2').tobytes(), sample_rate)
+        return
+    codec, container = ENCODERS[output_format]
+    ffmpeg = which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg is needed to encode {}'.format(output_format))
+    command = [ffmpeg, '-nostdin', '-loglevel', 'error', '-f', 's16le', '-ar', str(sample_rate), '-ac', '1',
+               '-i', 'pipe:0', '-c:a', codec, '-f', container, '-y', output_filename]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = process.communicate(samples.astype('<i2').tobytes())
+    if process.returncode != 0:
+        raise RuntimeError('ffmpeg failed to encode {}: {}'.format(output_format, err.decode('utf-8', 'replace')))
+
+
+def decode(filename, output_format, sample_rate):
+    """Return the samples of an audio file as an int16 array, and their sample rate.
+
+    pcm is read from wav at its own rate, ogg_vorbis and mp3 are decoded by ffmpeg at sample_rate.
+    """
+    output_format = output_format.lower()
+    if output_format == 'pcm':
+        return read_wav(filename)
+    ffmpeg = which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg is needed to decode {}'.format(output_format))
+    command = [ffmpeg, '-nostdin', '-loglevel', 'error', '-i', filename, '-f', 's16le', '-ar', str(sample_rate),
+               '-ac', '1', 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('ffmpeg failed to decode {}: {}'.format(filename, err.decode('utf-8', 'replace')))
+    return numpy.frombuffer(out, dtype='<i2'), int(sample_rate)
+
+
+def trim_silence(samples, sample_rate, threshold_db=-50.0, padding=0.05, frame_length=0.01):
+    """Return samples without their leading and trailing silence.
+
+    :param samples: an int16 array
+    :param sample_rate: the sample rate of samples
+    :param threshold_db: frames that are quieter than this, in dB relative to full scale, are silent
+    :param padding: seconds of silence to keep before the first and after the last sound
+    :param frame_length: seconds of every frame whose loudness is measured
+    :return: a slice of samples, or samples if they are all silent
+    """
+    frame = max(int(sample_rate * frame_length), 1)
+    num_frames = len(samples) // frame
+    if num_frames == 0:
+        return samples
+    frames = samples[:num_frames * frame].astype(numpy.float64).reshape(num_frames, frame)
+    rms = numpy.sqrt(numpy.mean(frames ** 2, axis=1))
+    loud = numpy.flatnonzero(rms > 32768 * 10 ** (threshold_db / 20.0))
+    if len(loud) == 0:
+        return samples
+    pad = int(sample_rate * padding)
+    return samples[max(loud[0] * frame - pad, 0):min((loud[-1] + 1) * frame + pad, len(samples))]
+
+
+def can_trim(output_format):
+    """Return whether silence can be trimmed from audio in output_format."""
+    return can_derive(output_format)
+
+
+def trim_file(filename, output_format, sample_rate, **kwargs):
+    """Trim the silence of an audio file in place.
+
+    :param filename: the audio file
+    :param output_format: pcm, ogg_vorbis or mp3
+    :param sample_rate: the sample rate of the file, pcm is trimmed at the rate of its wav header
+    :param kwargs: passed on to trim_silence
+    :return: the number of samples trimmed
+    """
+    samples, sample_rate = decode(filename, output_format, sample_rate)
+    trimmed = trim_silence(samples, sample_rate, **kwargs)
+    if len(trimmed) == len(samples):
+        return 0
+    with audio.publishing(filename) as tmp_filename:
+        encode(trimmed, sample_rate, tmp_filename, output_format)
+    return len(samples) - len(trimmed)
+
+
+def derive(master_filename, output_filename, output_format, sample_rate):
+    """Make output_filename in output_format at sample_rate from the wav file master_filename."""
+    samples, master_rate = read_wav(master_filename)
+    encode(resample(samples, master_rate, int(sample_rate)), int(sample_rate), output_filename, output_format)
@@ -0,0 +1,241 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""A very simple Action Server that does TTS.
+
+It is a combination of a synthesizer and a player. Being an action server, it can be used in two different manners.
+
+1. Play and wait for it to finish
+---------------------------------
+
+A user can choose to be blocked until the audio playing is done. This is especially useful in interactive scenarios.
+
+Example::
+
+    rospy.init_node('tts_action_client')
+    client = actionlib.SimpleActionClient('tts', SpeechAction)
+    client.wait_for_server()
+    goal = SpeechGoal()
+    goal.text = 'Let me ask you a question, please give me your answer.'
+    client.send_goal(goal)
+    client.wait_for_result()
+
+    # start listening to a response or waiting for some input to continue the interaction
+
+2. Play and forget
+------------------
+
+A user can also choose not to wait::
+
+    rospy.init_node('tts_action_client')
+    client = actionlib.SimpleActionClient('tts', SpeechAction)
+    client.wait_for_server()
+    goal = SpeechGoal()
+    goal.text = 'Let me talk, you can to something else in the meanwhile.'
+    client.send_goal(goal)
+
+This is useful when the robot wants to do stuff while the audio is being played. For example, a robot may start to
+read some instructions and immediately get ready for any input.
+
+3. Speak in time or not at all
+------------------------------
+
+A ``deadline`` in the metadata, in seconds since the epoch, bounds the whole request. The node waits for the
+synthesizer at most until the deadline, passes the deadline on to it, and stops playing when the deadline is reached.
+The result then tells which stage ran out of time::
+
+    goal.metadata = json.dumps({'deadline': time.time() + 5})
+
+4. All in one process
+---------------------
+
+``tts_combined_node.py`` runs the action server, the synthesizer and the polly node in a single process. The action
+server calls the synthesizer, and the synthesizer calls Amazon Polly, directly instead of through ROS services. The
+``synthesizer`` and ``polly`` services are still advertised for other clients::
+
+    $ rosrun tts tts_combined_node.py
+
+5. Streaming
+------------
+
+With ``"stream": true`` in the metadata, pcm that is not cached yet is published on the ``audio`` topic as it
+arrives from Amazon Polly instead of being played by sound_play once it is saved. A player of
+``audio_common_msgs/AudioData``, e.g. audio_common's audio_play configured for 16-bit mono pcm, has to subscribe to the
+topic. The goal then finishes when the audio is saved, which may be before it has been played::
+
+    goal.metadata = json.dumps({'output_format': 'pcm', 'stream': True})
+"""
+
+import json
+import threading
+from optparse import OptionParser
+
+import actionlib
+import rospy
+from tts.msg import SpeechAction, SpeechResult
+from tts.srv import Synthesizer, SynthesizerRequest
+from tts.deadline import DeadlineExceeded, remaining, wait_for_service
+
+from sound_play.libsoundplay import SoundClient
+
+
+def play(filename, deadline=None):
+    """plays the wav or ogg file using sound_play, returns False if it was stopped at the deadline"""
+    client = SoundClient(blocking=True)
+    left = remaining(deadline)
+    if left is None:
+        client.playWave(filename)
+        return True
+
+    player = threading.Thread(target=client.playWave, args=(filename,))
+    player.daemon = True
+    player.start()
+    player.join(max(left, 0))
+    if player.is_alive():
+        client.stopAll()
+        return False
+    return True
+
+
+def get_deadline(goal):
+    """returns the deadline in the metadata of the goal, None if there is none"""
+    try:
+        return float(json.loads(goal.metadata).get('deadline') or 0) or None
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def synthesize_via_service(text, metadata, deadline=None):
+    """calls synthesizer service to do the job"""
+    wait_for_service('synthesizer', deadline)
+    synthesize = rospy.ServiceProxy('synthesizer', Synthesizer)
+    return synthesize(text, metadata)
+
+
+class SpeechServer(object):
+    """The action server, a combination of a synthesizer and a player."""
+
+    def __init__(self, synthesize=synthesize_via_service):
+        """
+        :param synthesize: a callable taking the text, the metadata and the deadline of a goal and returning a
+                           SynthesizerResponse, by default the synthesizer service is called
+        """
+        self.synthesize = synthesize
+        self.server = None
+
+    def start(self, action_name='tts'):
+        """Start serving the action in the node of this process."""
+        self.server = actionlib.SimpleActionServer(action_name, SpeechAction, self.do_speak, False)
+        self.server.start()
+
+    def finish_with_result(self, s):
+        """responds the client"""
+        tts_server_result = SpeechResult(s)
+        self.server.set_succeeded(tts_server_result)
+        rospy.loginfo(tts_server_result)
+
+    def do_speak(self, goal):
+        """The action handler.
+
+        Note that although it responds to client after the audio play is finished, a client can choose
+        not to wait by not calling ``SimpleActionClient.waite_for_result()``.
+        """
+        rospy.loginfo('speech goal: {}'.format(goal))
+
+        deadline = get_deadline(goal)
+        try:
+            res = self.synthesize(goal.text, goal.metadata, deadline)
+        except DeadlineExceeded as e:
+            s = '[ERROR] {}'.format(e)
+            rospy.logerr(s)
+            self.finish_with_result(s)
+            return
+        rospy.loginfo('synthesizer returns: {}'.format(res))
+
+        try:
+            r = json.loads(res.result)
+        except Exception as e:
+            s = 'Expecting JSON from synthesizer but got {}'.format(res.result)
+            rospy.logerr('{}. Exception: {}'.format(s, e))
+            self.finish_with_result(s)
+            return
+
+        result = ''
+
+        if r.get('Streamed'):
+            # it was played from the audio topic while it was synthesized
+            result = r['Audio File']
+        elif 'Task Id' in r:
+            # a long form request, there is nothing to play until the synthesis task is done
+            result = 'synthesis task {} is {}'.format(r['Task Id'], r.get('Task Status'))
+            rospy.loginfo(result)
+        elif r.get('Audio File'):
+            audio_file = r['Audio File']
+            rospy.loginfo('Will play {}'.format(audio_file))
+            if play(audio_file, deadline):
+                result = audio_file
+            else:
+                result = '[ERROR] stopped playing {} at the deadline'.format(audio_file)
+                rospy.logerr(result)
+        elif 'Exception' not in r:
+            result = '[ERROR] the synthesizer returned no audio: {}'.format(r)
+            rospy.logerr(result)
+
+        if 'Exception' in r:
+            result = '[ERROR] {}'.format(r)
+            rospy.logerr(result)
+
+        self.finish_with_result(result)
+
+
+def main():
+    rospy.init_node('tts_node')
+    SpeechServer().start()
+    rospy.spin()
+
+
+def main_combined():
+    """The entry point of the combined node, see ``tts_combined_node.py``."""
+    from tts.amazonpolly import AmazonPolly
+    from tts.synthesizer import SpeechSynthesizer
+
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option("-n", "--node-name", dest="node_name", default='tts_node',
+                      help="name of the ROS node",
+                      metavar="NODE_NAME")
+    parser.add_option("-d", "--cache-dir", dest="cache_dir", default='/tmp',
+                      help="directory of the cache",
+                      metavar="CACHE_DIR")
+    parser.add_option("-c", "--cache-storage", dest="cache_storage", default='file',
+                      help="how cached audio is stored, 'file' for one file per utterance or 'pack' for a pack file",
+                      metavar="CACHE_STORAGE")
+    parser.add_option("-v", "--eviction-policy", dest="eviction_policy", default='lru',
+                      help="how cached audio is evicted, one of lru, lfu, gds or gdsf",
+                      metavar="EVICTION_POLICY")
+    (options, args) = parser.parse_args()
+
+    rospy.init_node(options.node_name)
+
+    polly = AmazonPolly(defer_client=True, cache_dir=options.cache_dir)
+    polly.advertise('polly')
+
+    synthesizer = SpeechSynthesizer(engine='POLLY_LIBRARY', polly=polly, cache_dir=options.cache_dir,
+                                    cache_storage=options.cache_storage, eviction_policy=options.eviction_policy)
+    synthesizer.advertise('synthesizer')
+
+    def synthesize(text, metadata, deadline=None):
+        # the synthesizer reads the deadline from the metadata itself
+        return synthesizer._node_request_handler(SynthesizerRequest(text=text, metadata=metadata))
+
+    SpeechServer(synthesize).start()
+    rospy.spin()
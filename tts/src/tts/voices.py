@@ -0,0 +1,146 @@
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""The catalogue of Amazon Polly voices, cached in memory and on disk.
+
+The voices hardly ever change, so the whole catalogue is fetched with DescribeVoices at most once every ``ttl``
+seconds and saved to a JSON file shared by the nodes of a robot. Requests for a language are answered from the
+catalogue, and so is checking that a voice, a language and a sample rate go together before asking Amazon Polly to
+synthesize anything::
+
+    catalog = VoiceCatalog(AmazonPolly()._fetch_voices, cache_file='/tmp/polly_voices.json')
+    catalog.validate('Joanna', 'en-US', 'pcm', '16000')
+"""
+
+import json
+import threading
+import time
+
+import rospy
+from tts.audio import publishing
+
+# the sample rates Amazon Polly accepts for each output format
+SAMPLE_RATES = {
+    'mp3': ('8000', '16000', '22050', '24000'),
+    'ogg_vorbis': ('8000', '16000', '22050', '24000'),
+    'pcm': ('8000', '16000'),
+}
+
+
+class InvalidVoiceRequestError(ValueError):
+    pass
+
+
+class VoiceCatalog(object):
+    """The voices of Amazon Polly, as returned by DescribeVoices with additional language codes."""
+
+    def __init__(self, fetch, cache_file=None, ttl=86400.0, retry_interval=60.0, clock=time.time):
+        """
+        :param fetch: a callable taking a deadline, which may be None, and returning the list of all voices
+        :param cache_file: where the catalogue is saved, None to only keep it in memory
+        :param ttl: seconds before the catalogue is fetched again
+        :param retry_interval: seconds to wait after a failed fetch before fetching again
+        :param clock: the source of the current time
+        """
+        self.fetch = fetch
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self._voices = None
+        self._fetched_at = None
+        self._failure = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                saved = json.load(f)
+            return saved['fetched_at'], saved['voices']
+        except (IOError, OSError, ValueError, KeyError):
+            return None, None
+
+    def _save(self):
+        try:
+            with publishing(self.cache_file) as tmp_file:
+                with open(tmp_file, 'w') as f:
+                    json.dump({'fetched_at': self._fetched_at, 'voices': self._voices}, f)
+        except (IOError, OSError) as e:
+            rospy.logwarn('failed to save the voice catalogue to %s: %s', self.cache_file, e)
+
+    def all_voices(self, deadline=None):
+        """Return all the voices, fetching them if the catalogue is missing or expired.
+
+        If fetching fails, an expired catalogue is still used. Without any catalogue, the error is raised again
+        until ``retry_interval`` has passed.
+
+        :param deadline: when fetching has to be done by, see ``tts.deadline``
+        """
+        with self._lock:
+            now = self.clock()
+            if self._voices is None and self.cache_file:
+                self._fetched_at, self._voices = self._load()
+            if self._voices is not None and now < self._fetched_at + self.ttl:
+                return self._voices
+            if self._failed_at is not None and now < self._failed_at + self.retry_interval:
+                if self._voices is None:
+                    raise self._failure
+                return self._voices
+            try:
+                voices = self.fetch(deadline)
+            except Exception as e:
+                self._failure, self._failed_at = e, now
+                if self._voices is None:
+                    raise
+                rospy.logwarn('failed to refresh the voice catalogue, using the one from %s: %s', self._fetched_at, e)
+                return self._voices
+            self._failure = self._failed_at = None
+            self._voices, self._fetched_at = voices, now
+            if self.cache_file:
+                self._save()
+            return voices
+
+    def voices(self, language_code='', include_additional_language_codes=False, deadline=None):
+        """Return the voices for a language, like DescribeVoices.
+
+        :param language_code: e.g. en-US, all voices if empty
+        :param include_additional_language_codes: also return the bilingual voices that speak language_code
+        :param deadline: when fetching the catalogue has to be done by
+        """
+        voices = self.all_voices(deadline)
+        if not language_code:
+            return voices
+        return [v for v in voices if v['LanguageCode'] == language_code or (
+            include_additional_language_codes and language_code in v.get('AdditionalLanguageCodes', []))]
+
+    def validate(self, voice_id, language_code='', output_format='', sample_rate='', deadline=None):
+        """Raise an InvalidVoiceRequestError if Amazon Polly would reject the combination.
+
+        :param voice_id: e.g. Joanna
+        :param language_code: the language of a bilingual voice, may be empty
+        :param output_format: mp3, ogg_vorbis or pcm
+        :param sample_rate: the sample rate as a string, may be empty
+        :param deadline: when fetching the catalogue has to be done by
+        """
+        rates = SAMPLE_RATES.get(output_format.lower()) if output_format else None
+        if sample_rate and rates and str(sample_rate) not in rates:
+            raise InvalidVoiceRequestError('sample rate {} is not supported for {}, use one of {}'.format(
+                sample_rate, output_format, ', '.join(rates)))
+
+        voice = next((v for v in self.all_voices(deadline) if v['Id'] == voice_id), None)
+        if voice is None:
+            raise InvalidVoiceRequestError('there is no voice {}'.format(voice_id))
+        if language_code and language_code != voice['LanguageCode'] and \
+                language_code not in voice.get('AdditionalLanguageCodes', []):
+            raise InvalidVoiceRequestError('voice {} does not speak {}'.format(voice_id, language_code))
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2018, Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#  http://aws.amazon.com/apache2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestDB(unittest.TestCase):
+
+    def setUp(self):
+        """important: import tts which is a relay package, see test_unit_synthesizer.py"""
+        import tts
+        self.assertIsNotNone(tts)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_file(self, name, data):
+        fn = os.path.join(self.tmp_dir, name)
+        with open(fn, 'wb') as f:
+            f.write(data)
+        return fn
+
+    def _packed_db(self, **kwargs):
+        from tts.db import PackedDB
+        return PackedDB(db_location=os.path.join(self.tmp_dir, 'polly.db'),
+                        pack_location=os.path.join(self.tmp_dir, 'polly.pack'), **kwargs)
+
+    def test_add_and_ensure_file(self):
+        from tts.db import DB
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        fn = self._make_file('voice_a', b'a' * 10)
+        db.add_file('a', fn, 'audio/ogg', 1, 10)
+
+        self.assertEqual(1, db.get_num_files())
+        self.assertEqual(10, db.get_size())
+        self.assertTrue(db.ensure_file('a', fn))
+        os.remove(fn)
+        self.assertFalse(db.ensure_file('a', fn))
+
+    def test_schema_is_made_once_per_process(self):
+        from mock import patch
+        from tts.db import DB
+        location = os.path.join(self.tmp_dir, 'polly.db')
+        DB(db_location=location)
+        with patch.object(DB, 'make_db') as make_db:
+            DB(db_location=location)
+            self.assertFalse(make_db.called)
+            os.remove(location)
+            DB(db_location=location)
+            self.assertTrue(make_db.called)
+
+    def test_packed_extraction(self):
+        db = self._packed_db(max_extracted_files=2)
+        files = {}
+        for i, name in enumerate('abc'):
+            files[name] = self._make_file('voice_' + name, name.encode('ascii') * (i + 1))
+            db.add_file(name, files[name], 'audio/ogg', i, i + 1)
+
+        # only the two most recently used utterances keep a loose copy
+        self.assertFalse(os.path.exists(files['a']))
+        self.assertTrue(os.path.exists(files['b']))
+        self.assertTrue(os.path.exists(files['c']))
+        self.assertEqual(6, db.get_pack_size())
+
+        self.assertTrue(db.ensure_file('a', files['a']))
+        with open(files['a'], 'rb') as f:
+            self.assertEqual(b'a', f.read())
+
+    def test_packed_extraction_of_a_deleted_copy(self):
+        db = self._packed_db(max_extracted_files=2)
+        fn = self._make_file('voice_a', b'a' * 10)
+        db.add_file('a', fn, 'audio/ogg', 1, 10)
+
+        # the loose copy is deleted behind the cache's back, the audio is still in the pack
+        os.remove(fn)
+        self.assertTrue(db.ensure_file('a', fn))
+        with open(fn, 'rb') as f:
+            self.assertEqual(b'a' * 10, f.read())
+
+    def test_packed_compaction(self):
+        db = self._packed_db(max_extracted_files=1, compact_ratio=0.5)
+        files = {}
+        for i, name in enumerate('abcd'):
+            files[name] = self._make_file('voice_' + name, name.encode('ascii') * 100)
+            db.add_file(name, files[name], 'audio/ogg', i, 100)
+
+        db.remove_file(files['a'])
+        self.assertEqual(400, db.get_pack_size())
+        db.remove_file(files['c'])
+        self.assertEqual(400, db.get_pack_size())
+        db.remove_file(files['d'])
+        self.assertEqual(100, db.get_pack_size())
+        self.assertEqual(1, db.get_num_files())
+
+        self.assertFalse(os.path.exists(files['b']))
+        self.assertTrue(db.ensure_file('b', files['b']))
+        with open(files['b'], 'rb') as f:
+            self.assertEqual(b'b' * 100, f.read())
+
+
+    def test_reconciler(self):
+        from tts.db import DB, CacheReconciler
+        import time
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        for name in 'abc':
+            db.add_file(name, self._make_file('voice_' + name, b'x' * 10), 'audio/ogg', 1, 10)
+        os.remove(os.path.join(self.tmp_dir, 'voice_a'))
+        self._make_file('voice_b', b'x' * 25)
+        orphan = self._make_file('voice_orphan', b'x' * 10)
+        fresh = self._make_file('voice_fresh', b'x' * 10)
+        old = time.time() - 120
+        os.utime(orphan, (old, old))
+
+        reconciler = CacheReconciler(lambda: db, cache_dir=self.tmp_dir, batch_size=2, grace_period=60)
+        for i in range(3):
+            reconciler.step(db)
+
+        self.assertEqual(2, db.get_num_files())
+        self.assertEqual(35, db.get_size())
+        self.assertEqual(35, reconciler.total_bytes)
+        reconciler.added(10)
+        self.assertEqual(45, reconciler.estimated_bytes())
+        reconciler.step(db)
+        self.assertEqual(35, reconciler.estimated_bytes())
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_reconciler_keeps_packed_rows(self):
+        from tts.db import CacheReconciler
+        db = self._packed_db(max_extracted_files=1)
+        files = {}
+        for i, name in enumerate('ab'):
+            files[name] = self._make_file('voice_' + name, b'x' * 10)
+            db.add_file(name, files[name], 'audio/ogg', i, 10)
+        os.remove(files['b'])
+
+        reconciler = CacheReconciler(lambda: db, cache_dir=self.tmp_dir)
+        self.assertEqual(1, reconciler.step(db))
+        # packed rows without a loose copy are not missing on the next passes
+        self.assertEqual(0, reconciler.step(db))
+        self.assertEqual(20, reconciler.total_bytes)
+
+        self.assertEqual(2, db.get_num_files())
+        self.assertTrue(db.ensure_file('b', files['b']))
+        self.assertTrue(os.path.exists(files['b']))
+
+
+    def test_gds_eviction_policy(self):
+        from tts.db import DB
+        from tts.eviction import make_policy
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        policy = make_policy('gds')
+        policy.attach(db)
+        # a big paragraph that was fast to synthesize and a small prompt that was slow
+        db.add_file('big', 'voice_big', 'audio/ogg', 1, 2000000, 0.5, policy.priority(1, 1, 2000000, 0.5))
+        db.add_file('small', 'voice_small', 'audio/ogg', 2, 5000, 0.3, policy.priority(2, 1, 5000, 0.3))
+
+        victim = policy.victim(db)
+        self.assertEqual('big', victim['hash'])
+        self.assertEqual('small', policy.victim(db, exclude='big')['hash'])
+        policy.evicted(victim)
+        self.assertEqual(victim['priority'], policy.inflation)
+
+    def test_eviction_policy_switch(self):
+        from tts.db import DB
+        from tts.eviction import make_policy
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        make_policy('lru').attach(db)
+        db.add_file('old', 'voice_old', 'audio/ogg', 1, 10)
+        db.add_file('new', 'voice_new', 'audio/ogg', 2, 10)
+        db.touch('old', 3, 3)
+        db.touch('old', 4, 4)
+        self.assertEqual('new', make_policy('lru').victim(db)['hash'])
+
+        make_policy('lfu').attach(db)
+        self.assertEqual('lfu', db.get_setting('eviction_policy'))
+        self.assertEqual(3, db.ex("SELECT priority FROM cache WHERE hash='old'").fetchone()[0])
+
+    def test_pinned_rows_are_not_evicted(self):
+        from tts.db import DB
+        from tts.eviction import make_policy
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        policy = make_policy('lru')
+        db.add_file('safety', 'voice_safety', 'audio/ogg', 1, 10)
+        db.add_file('other', 'voice_other', 'audio/ogg', 2, 20)
+        self.assertTrue(db.pin('safety'))
+        self.assertFalse(db.pin('missing'))
+
+        self.assertEqual('other', policy.victim(db)['hash'])
+        self.assertIsNone(policy.victim(db, exclude='other'))
+        self.assertEqual((10, 1), (db.get_size(pinned=True), db.get_num_files(pinned=True)))
+        self.assertEqual((20, 1), (db.get_size(pinned=False), db.get_num_files(pinned=False)))
+        plan = ' '.join(str(tuple(r)) for r in db.ex(
+            'EXPLAIN QUERY PLAN SELECT hash FROM cache WHERE pinned=0 AND hash IS NOT ? ORDER BY priority LIMIT 1',
+            'other').fetchall())
+        self.assertIn('cache_eviction', plan)
+
+        db.pin('safety', False)
+        self.assertEqual('safety', policy.victim(db)['hash'])
+
+    def test_pinned_rows_stay_pinned_when_added_again(self):
+        from tts.db import DB
+        db = DB(db_location=os.path.join(self.tmp_dir, 'polly.db'))
+        db.add_file('safety', 'voice_safety', 'audio/ogg', 1, 10)
+        db.pin('safety')
+        db.add_file('safety', 'voice_safety', 'audio/ogg', 2, 12)
+        db.add_files([{'hash': 'safety', 'file': 'voice_safety', 'audio_type': 'audio/ogg', 'last_accessed': 3,
+                       'size': 14, 'access_count': 1, 'synth_latency': 0.0, 'priority': 3}])
+        db.add_file('other', 'voice_other', 'audio/ogg', 2, 20)
+
+        self.assertEqual((14, 1), (db.get_size(pinned=True), db.get_num_files(pinned=True)))
+        self.assertEqual((20, 1), (db.get_size(pinned=False), db.get_num_files(pinned=False)))
+
+
+    def _export_cache(self, db_class, count=5, **kwargs):
+        from tts.cachebundle import export_bundle
+        src_dir = os.path.join(self.tmp_dir, 'src')
+        os.mkdir(src_dir)
+        kwargs['db_location'] = os.path.join(src_dir, 'polly.db')
+        if db_class.__name__ == 'PackedDB':
+            kwargs['pack_location'] = os.path.join(src_dir, 'polly.pack')
+        db = db_class(**kwargs)
+        for i in range(count):
+            fn = os.path.join(src_dir, 'voice_{}.ogg'.format(i))
+            with open(fn, 'wb') as f:
+                f.write(os.urandom(100 + i))
+            db.add_file(str(i), fn, 'audio/ogg', i, 100 + i, 0.1 * i)
+        bundle = os.path.join(self.tmp_dir, 'cache.tgz')
+        self.assertEqual(count, export_bundle(db, bundle))
+        return src_dir, bundle
+
+    def test_bundle_export_of_a_large_pack(self):
+        import tarfile
+        from tts.db import PackedDB
+        src_dir, bundle = self._export_cache(PackedDB, count=10, max_extracted_files=3)
+
+        # exporting reads from the pack and leaves the loose copies alone
+        self.assertEqual(['voice_7.ogg', 'voice_8.ogg', 'voice_9.ogg'],
+                         sorted(f for f in os.listdir(src_dir) if f.startswith('voice_')))
+        with tarfile.open(bundle) as tar:
+            sizes = dict((m.name, m.size) for m in tar.getmembers())
+        self.assertEqual(11, len(sizes))
+        self.assertEqual(100, sizes['audio/voice_0.ogg'])
+        self.assertEqual(109, sizes['audio/voice_9.ogg'])
+
+    def test_bundle_round_trip(self):
+        from tts.db import DB, PackedDB
+        from tts.cachebundle import import_bundle
+        src_dir, bundle = self._export_cache(PackedDB)
+
+        dst_dir = os.path.join(self.tmp_dir, 'dst')
+        os.mkdir(dst_dir)
+        db = DB(db_location=os.path.join(dst_dir, 'polly.db'))
+        db.add_file('0', os.path.join(dst_dir, 'voice_local'), 'audio/ogg', 1, 1)
+        self.assertEqual(4, import_bundle(db, bundle, dst_dir))
+        self.assertEqual(5, db.get_num_files())
+        for i in range(1, 5):
+            row = db.ex('SELECT * FROM cache WHERE hash=?', str(i)).fetchone()
+            self.assertEqual(os.path.join(dst_dir, 'voice_{}.ogg'.format(i)), row['file'])
+            self.assertEqual(100 + i, row['size'])
+            self.assertAlmostEqual(0.1 * i, row['synth_latency'])
+            with open(row['file'], 'rb') as f, open(os.path.join(src_dir, 'voice_{}.ogg'.format(i)), 'rb') as g:
+                self.assertEqual(g.read(), f.read())
+        self.assertEqual(0, import_bundle(db, bundle, dst_dir))
+
+    def test_bundle_import_into_pack(self):
+        from tts.db import DB
+        from tts.cachebundle import import_bundle
+        src_dir, bundle = self._export_cache(DB)
+        shutil.rmtree(src_dir)
+
+        db = self._packed_db(max_extracted_files=2)
+        self.assertEqual(5, import_bundle(db, bundle, self.tmp_dir))
+        self.assertEqual(5, db.ex('SELECT COUNT(*) FROM pack').fetchone()[0])
+        self.assertEqual(2, len([f for f in os.listdir(self.tmp_dir) if f.startswith('voice_')]))
+        self.assertTrue(db.ensure_file('0', os.path.join(self.tmp_dir, 'voice_0.ogg')))
+        self.assertEqual(100, os.path.getsize(os.path.join(self.tmp_dir, 'voice_0.ogg')))
+
+    def test_corrupt_bundle_imports_nothing(self):
+        import gzip
+        import tarfile
+        from tts.db import DB
+        from tts.cachebundle import import_bundle, BadBundleError
+        src_dir, bundle = self._export_cache(DB)
+        with tarfile.open(bundle) as tar:
+            last_audio = tar.getmembers()[-1].offset_data
+        with gzip.open(bundle, 'rb') as f:
+            data = bytearray(f.read())
+        data[last_audio] ^= 0xff
+        with gzip.open(bundle, 'wb') as f:
+            f.write(bytes(data))
+
+        dst_dir = os.path.join(self.tmp_dir, 'dst')
+        os.mkdir(dst_dir)
+        db = DB(db_location=os.path.join(dst_dir, 'polly.db'))
+        self.assertRaises(BadBundleError, import_bundle, db, bundle, dst_dir)
+        self.assertEqual(0, db.get_num_files())
+        self.assertEqual(['polly.db'], [f for f in os.listdir(dst_dir) if not f.startswith('polly.db-')
+                                        and not f.endswith('.lock')])
+
+
+if __name__ == '__main__':
+    import rosunit
+    rosunit.unitrun('tts', 'unittest-db', TestDB)
@@ -16,6 +16,9 @@
 from __future__ import print_function
 
 
+import os
+import shutil
+import tempfile
 from mock import patch, MagicMock # python2 uses backport of unittest.mock(docs.python.org/3/library/unittest.mock.html)
 import unittest
 
@@ -39,6 +42,14 @@ class TestPolly(unittest.TestCase):
         """
         import tts
         self.assertIsNotNone(tts)
+        # AmazonPolly saves audio without an output path in the current directory, which is a temporary one here
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
 
     @patch('tts.amazonpolly.Session')
     def test_init(self, boto3_session_class_mock):
@@ -162,6 +173,22 @@ class TestPolly(unittest.TestCase):
         j = json.loads(res.result)
         self.assertTrue('Exception' in j)
         self.assertTrue('Traceback' in j)
+        self.assertNotIn('Code', j['Exception'])
+
+    @patch('tts.amazonpolly.Session')
+    def test_polly_rejects(self, boto3_session_class_mock):
+        from botocore.exceptions import ClientError
+        boto3_polly_obj_mock = boto3_session_class_mock.return_value.client.return_value
+        boto3_polly_obj_mock.synthesize_speech.side_effect = ClientError(
+            {'Error': {'Code': 'InvalidSsmlException', 'Message': 'Invalid SSML request'}}, 'SynthesizeSpeech')
+
+        from tts.amazonpolly import AmazonPolly
+        res = AmazonPolly().synthesize(text='<speak>hello', text_type='ssml')
+
+        import json
+        j = json.loads(res.result)
+        self.assertEqual('InvalidSsmlException', j['Exception']['Code'])
+        self.assertTrue(j['Audio File'].endswith('error.ogg'))
 
     @patch('tts.amazonpolly.AmazonPolly')
     def test_cli(self, amazon_polly_class_mock):
@@ -173,6 +200,433 @@ class TestPolly(unittest.TestCase):
             amazon_polly_class_mock.return_value.start.assert_called_with(node_name='polly-node', service_name='polly')
 
 
+    @patch('tts.amazonpolly.Session')
+    def test_describe_voices(self, boto3_session_class_mock):
+        import json
+        import os
+        import shutil
+        import tempfile
+        boto3_polly_obj_mock = boto3_session_class_mock.return_value.client.return_value
+        boto3_polly_obj_mock.describe_voices.side_effect = [
+            {'Voices': [{'Id': 'Joanna', 'LanguageCode': 'en-US'}], 'NextToken': 'page2'},
+            {'Voices': [{'Id': 'Aditi', 'LanguageCode': 'hi-IN', 'AdditionalLanguageCodes': ['en-IN']},
+                        {'Id': 'Raveena', 'LanguageCode': 'en-IN'}]},
+        ]
+
+        from tts.amazonpolly import AmazonPolly
+        from tts.srv import PollyRequest
+        cache_dir = tempfile.mkdtemp()
+        try:
+            polly = AmazonPolly()
+            polly.voice_catalog.cache_file = os.path.join(cache_dir, 'polly_voices.json')
+
+            res = polly._node_request_handler(PollyRequest(polly_action='DescribeVoices', language_code='en-IN',
+                                                           include_additional_language_codes=True))
+            self.assertEqual(['Aditi', 'Raveena'], [v['Id'] for v in json.loads(res.result)['Voices']])
+            boto3_polly_obj_mock.describe_voices.assert_called_with(IncludeAdditionalLanguageCodes=True,
+                                                                   NextToken='page2')
+
+            res = polly._node_request_handler(PollyRequest(polly_action='DescribeVoices', language_code='en-IN'))
+            self.assertEqual(['Raveena'], [v['Id'] for v in json.loads(res.result)['Voices']])
+
+            # another instance reads the catalogue from disk
+            polly = AmazonPolly()
+            polly.voice_catalog.cache_file = os.path.join(cache_dir, 'polly_voices.json')
+            self.assertEqual(3, len(polly.describe_voices()))
+            self.assertEqual(2, boto3_polly_obj_mock.describe_voices.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    @patch('tts.amazonpolly.Session')
+    def test_lexicons(self, boto3_session_class_mock):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from botocore.exceptions import ClientError
+        boto3_polly_obj_mock = boto3_session_class_mock.return_value.client.return_value
+
+        from tts.amazonpolly import AmazonPolly
+        from tts.lexicons import LexiconIndex
+        from tts.srv import PollyRequest
+        cache_dir = tempfile.mkdtemp()
+        try:
+            polly = AmazonPolly()
+            polly.lexicon_index = LexiconIndex(os.path.join(cache_dir, 'polly_lexicons.json'))
+
+            def call(action, **kw):
+                return json.loads(polly._node_request_handler(PollyRequest(polly_action=action, **kw)).result)
+
+            # the time of the upload is recorded, so listing the lexicons doesn't download it again
+            boto3_polly_obj_mock.get_lexicon.return_value = {
+                'Lexicon': {'Name': 'robots', 'Content': '<lexicon>v1</lexicon>'},
+                'LexiconAttributes': {'LastModified': 1}}
+            res = call('PutLexicon', lexicon_name='robots', lexicon_content='<lexicon>v1</lexicon>')
+            self.assertTrue(res['Uploaded'])
+            self.assertEqual('1', polly.lexicon_index.get('robots')['last_modified'])
+            res = call('PutLexicon', lexicon_name='robots', lexicon_content='<lexicon>v1</lexicon>')
+            self.assertFalse(res['Uploaded'])
+            self.assertEqual(1, boto3_polly_obj_mock.put_lexicon.call_count)
+            boto3_polly_obj_mock.list_lexicons.return_value = {'Lexicons': [
+                {'Name': 'robots', 'Attributes': {'LastModified': 1}}]}
+            call('ListLexicons')
+            self.assertEqual('<lexicon>v1</lexicon>', call('GetLexicon', lexicon_name='robots')['Content'])
+            self.assertEqual(2, boto3_polly_obj_mock.get_lexicon.call_count)
+
+            # a lexicon deleted behind our back is uploaded again
+            boto3_polly_obj_mock.get_lexicon.side_effect = ClientError(
+                {'Error': {'Code': 'LexiconNotFoundException', 'Message': 'not found'}}, 'GetLexicon')
+            res = call('PutLexicon', lexicon_name='robots', lexicon_content='<lexicon>v1</lexicon>')
+            self.assertTrue(res['Uploaded'])
+            self.assertEqual(2, boto3_polly_obj_mock.put_lexicon.call_count)
+            boto3_polly_obj_mock.get_lexicon.reset_mock()
+
+            # another lexicon was added and robots was changed behind our back
+            boto3_polly_obj_mock.list_lexicons.return_value = {'Lexicons': [
+                {'Name': 'robots', 'Attributes': {'LastModified': 2}},
+                {'Name': 'names', 'Attributes': {'LastModified': 1}},
+            ]}
+            boto3_polly_obj_mock.get_lexicon.side_effect = lambda Name: {
+                'Lexicon': {'Name': Name, 'Content': '<lexicon>{} v2</lexicon>'.format(Name)}}
+            res = call('ListLexicons')
+            self.assertEqual(['robots', 'names'], [l['Name'] for l in res['Lexicons']])
+            self.assertEqual('<lexicon>robots v2</lexicon>', call('GetLexicon', lexicon_name='robots')['Content'])
+            call('ListLexicons')
+            self.assertEqual(2, boto3_polly_obj_mock.get_lexicon.call_count)
+
+            call('DeleteLexicon', lexicon_name='names')
+            boto3_polly_obj_mock.delete_lexicon.assert_called_with(Name='names')
+            self.assertEqual(['robots'], polly.lexicon_index.names())
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_synthesis_task_against_stub_endpoint(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        import threading
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        audio = b'long form audio' * 1000
+        requests = []
+
+        class StubEndpoint(BaseHTTPRequestHandler):
+            """Amazon Polly's synthesis task API and Amazon S3's GetObject for a single task"""
+
+            def _reply(self, body, content_type='application/json'):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _task(self, status):
+                return json.dumps({'SynthesisTask': {
+                    'TaskId': 'task1', 'TaskStatus': status, 'CreationTime': 1500000000.0,
+                    'OutputFormat': 'ogg_vorbis', 'OutputUri': 'https://s3.us-west-2.amazonaws.com/bucket/task1.ogg',
+                }}).encode('utf-8')
+
+            def do_POST(self):
+                requests.append(json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+                self._reply(self._task('scheduled'))
+
+            def do_GET(self):
+                if self.path == '/v1/synthesisTasks/task1':
+                    self._reply(self._task('completed'))
+                elif self.path == '/bucket/task1.ogg':
+                    self._reply(audio, 'audio/ogg')
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), StubEndpoint)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        output_dir = tempfile.mkdtemp()
+        try:
+            from tts.amazonpolly import AmazonPolly
+            from tts.srv import PollyRequest
+            polly = AmazonPolly(aws_access_key_id='key', aws_secret_access_key='secret', region_name='us-west-2',
+                                endpoint_url='http://127.0.0.1:{}'.format(server.server_port))
+
+            res = json.loads(polly._node_request_handler(PollyRequest(
+                polly_action='StartSpeechSynthesisTask', text='Chapter 1', output_s3_bucket_name='bucket')).result)
+            self.assertEqual('scheduled', res['SynthesisTask']['TaskStatus'])
+            self.assertEqual({'OutputFormat': 'ogg_vorbis', 'OutputS3BucketName': 'bucket', 'Text': 'Chapter 1',
+                              'TextType': 'text', 'VoiceId': 'Joanna', 'LexiconNames': []}, requests[0])
+
+            res = json.loads(polly._node_request_handler(PollyRequest(
+                polly_action='GetSpeechSynthesisTask', task_id='task1',
+                output_path=os.path.join(output_dir, 'chapter1'))).result)
+            self.assertEqual('completed', res['SynthesisTask']['TaskStatus'])
+            self.assertEqual(os.path.join(output_dir, 'chapter1.ogg'), res['Audio File'])
+            with open(res['Audio File'], 'rb') as f:
+                self.assertEqual(audio, f.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(output_dir)
+
+    @patch('tts.amazonpolly.Session')
+    def test_deadline(self, boto3_session_class_mock):
+        import json
+        import time
+        import tempfile
+        import shutil
+        import os
+        from botocore.exceptions import ClientError
+        boto3_session_obj_mock = boto3_session_class_mock.return_value
+        boto3_polly_obj_mock = boto3_session_obj_mock.client.return_value
+        boto3_polly_obj_mock.synthesize_speech.side_effect = ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'SynthesizeSpeech')
+
+        from tts.amazonpolly import AmazonPolly
+        polly = AmazonPolly()
+
+        # a passed deadline is refused without calling Amazon Polly
+        j = json.loads(polly.synthesize(text='hello', deadline=time.time() - 1).result)
+        self.assertEqual('DeadlineExceeded', j['Exception']['Name'])
+        self.assertFalse(boto3_polly_obj_mock.synthesize_speech.called)
+
+        # a close deadline is split between the connect and read timeouts of the client, which doesn't retry
+        polly.synthesize(text='hello', deadline=time.time() + 4.5)
+        config = boto3_session_obj_mock.client.call_args[1]['config']
+        self.assertAlmostEqual(4.0 / 3, config.connect_timeout)
+        self.assertAlmostEqual(8.0 / 3, config.read_timeout)
+        self.assertEqual({'max_attempts': 0}, config.retries)
+        self.assertEqual(1, boto3_polly_obj_mock.synthesize_speech.call_count)
+
+        # a fraction of a second is not rounded up
+        polly.synthesize(text='hello', deadline=time.time() + 0.25)
+        config = boto3_session_obj_mock.client.call_args[1]['config']
+        self.assertLessEqual(config.connect_timeout + config.read_timeout, 0.25)
+        self.assertEqual(2, boto3_polly_obj_mock.synthesize_speech.call_count)
+
+        # too little time left is given up without calling Amazon Polly
+        j = json.loads(polly.synthesize(text='hello', deadline=time.time() + 0.05).result)
+        self.assertEqual('DeadlineExceeded', j['Exception']['Name'])
+        self.assertEqual(2, boto3_polly_obj_mock.synthesize_speech.call_count)
+
+        # without a deadline, or a distant one, the default client is used
+        client_count = boto3_session_obj_mock.client.call_count
+        polly.synthesize(text='hello')
+        polly.synthesize(text='hello', deadline=time.time() + 3600)
+        self.assertEqual(client_count, boto3_session_obj_mock.client.call_count)
+
+        # audio that arrives after the deadline is not returned
+        output_dir = tempfile.mkdtemp()
+        try:
+            stream = MagicMock()
+            stream.read.side_effect = lambda *args: time.sleep(0.6) or b'audio'
+            boto3_polly_obj_mock.synthesize_speech.side_effect = None
+            boto3_polly_obj_mock.synthesize_speech.return_value = {
+                'AudioStream': stream, 'ContentType': 'audio/ogg', 'ResponseMetadata': {}}
+            j = json.loads(polly.synthesize(text='hello', deadline=time.time() + 0.5,
+                                            output_path=os.path.join(output_dir, 'late')).result)
+            self.assertEqual('DeadlineExceeded', j['Exception']['Name'])
+            self.assertEqual([], os.listdir(output_dir))
+        finally:
+            shutil.rmtree(output_dir)
+
+    @patch('tts.amazonpolly.Session')
+    def test_deferred_client(self, boto3_session_class_mock):
+        from tts.amazonpolly import AmazonPolly
+        polly = AmazonPolly(defer_client=True)
+        self.assertFalse(boto3_session_class_mock.return_value.client.called)
+
+        polly.warm_up_in_background().join()
+        boto3_session_class_mock.return_value.client.assert_called_once_with('polly')
+        self.assertIs(boto3_session_class_mock.return_value.client.return_value, polly.polly)
+        self.assertEqual(1, boto3_session_class_mock.return_value.client.call_count)
+
+    @patch('tts.amazonpolly.Session')
+    def test_streaming(self, boto3_session_class_mock):
+        import json
+        import os
+        import shutil
+        import sys
+        import tempfile
+        import wave
+        boto3_polly_obj_mock = boto3_session_class_mock.return_value.client.return_value
+        audio_stream_mock = MagicMock()
+        audio_stream_mock.read.side_effect = [b'\x01\x00' * 2000, b'\x02\x00' * 1000, b'']
+        boto3_polly_obj_mock.synthesize_speech.return_value = {
+            'AudioStream': audio_stream_mock,
+            'ContentType': 'audio/pcm',
+            'ResponseMetadata': {},
+        }
+        msg_module_mock = MagicMock()
+        modules = {'audio_common_msgs': MagicMock(), 'audio_common_msgs.msg': msg_module_mock}
+
+        from tts.amazonpolly import AmazonPolly
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with patch.dict(sys.modules, modules), patch('rospy.Publisher') as publisher_class_mock:
+                polly = AmazonPolly()
+                res = json.loads(polly.synthesize(text='hello', output_format='pcm', stream=True,
+                                                  output_path=os.path.join(tmp_dir, 'hello')).result)
+
+            self.assertTrue(res['Streamed'])
+            frames = [kw['data'] for _, kw in msg_module_mock.AudioData.call_args_list]
+            self.assertEqual([3200, 2800], [len(f) for f in frames])
+            publisher_class_mock.assert_called_with('audio', msg_module_mock.AudioData, queue_size=100)
+            self.assertEqual(2, publisher_class_mock.return_value.publish.call_count)
+            wavf = wave.open(res['Audio File'], 'rb')
+            self.assertEqual(b''.join(frames), wavf.readframes(wavf.getnframes()))
+            self.assertEqual(16000, wavf.getframerate())
+            wavf.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_endpoint_selection_against_stub_endpoints(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        import threading
+        import time
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        def stub_endpoint(delay, status=200):
+            """Amazon Polly's SynthesizeSpeech and DescribeVoices answering after delay seconds"""
+            calls = []
+
+            class StubEndpoint(BaseHTTPRequestHandler):
+                def _reply(self, body, content_type):
+                    time.sleep(delay)
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    if status != 200:
+                        self.send_header('x-amzn-ErrorType', 'ServiceFailureException')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def do_POST(self):
+                    self.rfile.read(int(self.headers['Content-Length']))
+                    calls.append('SynthesizeSpeech')
+                    self._reply(b'audio', 'audio/ogg')
+
+                def do_GET(self):
+                    calls.append('DescribeVoices')
+                    self._reply(b'{"Voices": []}', 'application/json')
+
+                def log_message(self, *args):
+                    pass
+
+            server = HTTPServer(('127.0.0.1', 0), StubEndpoint)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            return server, calls
+
+        broken, broken_calls = stub_endpoint(0.0, status=500)
+        slow, slow_calls = stub_endpoint(0.2)
+        fast, fast_calls = stub_endpoint(0.0)
+        output_dir = tempfile.mkdtemp()
+        try:
+            from tts.amazonpolly import AmazonPolly
+            from tts.srv import PollyRequest
+            endpoints = [{'region': region, 'endpoint_url': 'http://127.0.0.1:{}'.format(server.server_port)}
+                         for region, server in (('us-west-2', broken), ('us-east-1', slow), ('eu-west-1', fast))]
+            polly = AmazonPolly(aws_access_key_id='key', aws_secret_access_key='secret', region_name='us-west-2',
+                                endpoints=endpoints)
+
+            for i in range(6):
+                request = PollyRequest(polly_action='SynthesizeSpeech', text='hello',
+                                       output_path=os.path.join(output_dir, str(i)))
+                res = json.loads(polly._node_request_handler(request).result)
+                self.assertNotIn('Exception', res)
+
+            # the broken endpoint fails over to the slow one once, then everything goes to the fast one
+            self.assertEqual((1, 1, 5), (len(broken_calls), len(slow_calls), len(fast_calls)))
+            ranked = polly.endpoint_selector.snapshot()
+            self.assertEqual(['eu-west-1', 'us-east-1', 'us-west-2'], [e['region'] for e in ranked])
+            self.assertGreater(ranked[2]['error_rate'], 0)
+
+            # a deadline that passed is not held against the endpoints
+            from tts.deadline import DeadlineExceeded
+            self.assertRaises(DeadlineExceeded, polly._synthesize_speech, {'LexiconNames': []}, time.time() - 1)
+            self.assertEqual(ranked, polly.endpoint_selector.snapshot())
+
+            polly.endpoint_selector.probe_interval = 0
+            self.assertEqual(3, len(polly.endpoint_selector.probe_stale(polly._probe)))
+            self.assertEqual('DescribeVoices', slow_calls[-1])
+        finally:
+            for server in (broken, slow, fast):
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(output_dir)
+
+
+    def test_iot_credentials(self):
+        import os
+        import shutil
+        import stat
+        import tempfile
+        import time
+        from tts.iotcredentials import AwsIotCredentialProvider
+
+        tmp_dir = tempfile.mkdtemp()
+        credentials_file = os.path.join(tmp_dir, 'iot_credentials.json')
+        params = {'certfile': 'robot.cert.pem', 'keyfile': 'robot.private.key', 'endpoint': 'iot.example.com',
+                  'role': 'polly', 'thing_name': 'robot', 'credentials_file': credentials_file}
+        expiration = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600))
+        try:
+            with patch('tts.iotcredentials.get_ros_param',
+                       side_effect=lambda param, default=None: params.get(param[len('iot/'):], default)) as get_param, \
+                    patch('tts.iotcredentials.requests.Session') as session_class:
+                session = session_class.return_value
+                session.headers = {}
+                session.get.return_value.json.return_value = {'credentials': {
+                    'accessKeyId': 'key', 'secretAccessKey': 'secret', 'sessionToken': 'token',
+                    'expiration': expiration}}
+
+                provider = AwsIotCredentialProvider()
+                credentials = provider.load()
+                self.assertEqual('key', credentials.access_key)
+                session.get.assert_called_once_with('https://iot.example.com/role-aliases/polly/credentials',
+                                                    timeout=(5.0, 5.0))
+                self.assertEqual(('robot.cert.pem', 'robot.private.key'), session.cert)
+                self.assertEqual('robot', session.headers['x-amzn-iot-thingname'])
+                self.assertTrue(provider._refresher.daemon)
+
+                # botocore asking again gets the credentials without AWS IoT or the parameter server
+                num_params = get_param.call_count
+                self.assertEqual('token', provider.retrieve_credentials()['token'])
+                self.assertEqual(1, session.get.call_count)
+                self.assertEqual(num_params, get_param.call_count)
+
+                # the refresher renews them 20 minutes before they expire
+                self.assertAlmostEqual(2400, provider.refresh(), delta=5)
+                self.assertEqual(2, session.get.call_count)
+
+                # a restarted node uses the saved credentials, unless other users can read them
+                self.assertEqual(0o600, stat.S_IMODE(os.stat(credentials_file).st_mode))
+                self.assertEqual('secret', AwsIotCredentialProvider().retrieve_credentials()['secret_key'])
+                self.assertEqual(2, session.get.call_count)
+                os.chmod(credentials_file, 0o644)
+                AwsIotCredentialProvider().retrieve_credentials()
+                self.assertEqual(3, session.get.call_count)
+                self.assertEqual(0o600, stat.S_IMODE(os.stat(credentials_file).st_mode))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 if __name__ == '__main__':
     import rosunit
     rosunit.unitrun('tts', 'unittest-polly', TestPolly)
@@ -19,6 +19,25 @@ from mock import patch, MagicMock # python2 uses backport of unittest.mock(docs.
 import unittest
 
 
+def _stress_worker(cache_dir, log_file, max_cache_bytes, texts):
+    """Synthesize texts in a process of its own, logging every call to the engine."""
+    from tts.synthesizer import SpeechSynthesizer
+    from tts.srv import SynthesizerRequest
+
+    speech_synthesizer = SpeechSynthesizer(engine='DUMMY', max_cache_bytes=max_cache_bytes, cache_dir=cache_dir)
+    speech_synthesizer.engine.set_file_sizes(100)
+    dummy_engine = speech_synthesizer.engine
+
+    def logging_engine(**kwargs):
+        with open(log_file, 'a') as f:
+            f.write(kwargs['text'] + '\n')
+        return dummy_engine(**kwargs)
+    speech_synthesizer.engine = logging_engine
+
+    for text in texts:
+        speech_synthesizer._node_request_handler(SynthesizerRequest(text=text, metadata=''))
+
+
 class TestSynthesizer(unittest.TestCase):
 
     def setUp(self):
@@ -75,6 +94,11 @@ class TestSynthesizer(unittest.TestCase):
 
         self.assertEqual(response.result, polly_obj_mock.synthesize.return_value.result)
 
+        # the AmazonPolly is created once and reused, and voices are not validated unless asked for
+        speech_synthesizer._node_request_handler(request)
+        self.assertEqual(1, polly_class_mock.call_count)
+        self.assertFalse(polly_obj_mock.describe_voices.called)
+
     @patch('tts.amazonpolly.AmazonPolly')
     def test_synthesis_with_bad_metadata_using_polly_lib(self, polly_class_mock):
         polly_obj_mock = MagicMock()
@@ -298,6 +322,56 @@ class TestSynthesizer(unittest.TestCase):
 
         self.assertEqual(db.get_num_files(), 40)
 
+    def test_eviction_sums_the_sizes_once(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, max_cache_bytes=1000)
+            speech_synthesizer.engine.set_file_sizes(100)
+            for i in range(6):
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text=str(i), metadata=''))
+
+            # evicting four files at once sums the sizes once, not once per victim
+            speech_synthesizer.max_cache_bytes = 200
+            db = speech_synthesizer._open_db()
+            db.get_size = MagicMock(wraps=db.get_size)
+            speech_synthesizer._evict(db, None)
+            self.assertEqual(1, db.get_size.call_count)
+            self.assertEqual(2, db.get_num_files())
+            self.assertEqual(200, db.get_size())
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_eviction_with_reconciled_size(self):
+        from tts.db import CacheReconciler
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, max_cache_bytes=250)
+            speech_synthesizer.engine.set_file_sizes(100)
+            speech_synthesizer.reconciler = CacheReconciler(speech_synthesizer._open_db, cache_dir=cache_dir)
+            speech_synthesizer.reconciler.step(speech_synthesizer._open_db())
+
+            # within the estimate the table is not even looked at
+            db = MagicMock()
+            speech_synthesizer._evict(db, None)
+            self.assertFalse(db.eviction_lock.called)
+
+            for text in ('one', 'two', 'three'):
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text=text, metadata=''))
+            self.assertEqual(300, speech_synthesizer.reconciler.estimated_bytes())
+            self.assertEqual(2, speech_synthesizer._open_db().get_num_files())
+        finally:
+            shutil.rmtree(cache_dir)
+
     def test_file_cleanup_priority(self):
         from tts.db import DB
         from tts.synthesizer import SpeechSynthesizer
@@ -337,6 +411,894 @@ class TestSynthesizer(unittest.TestCase):
         self.assertTrue(os.path.exists(audio_file1))
 
 
+    def test_split_template(self):
+        from tts.synthesizer import SpeechSynthesizer
+        fragments = SpeechSynthesizer._split_template('Battery at {N} percent', {'N': 42})
+        self.assertEqual(['Battery at', '42', 'percent'], fragments)
+
+        fragments = SpeechSynthesizer._split_template('{greeting}, {name:>3}.', {'greeting': 'Hi', 'name': 'Al'})
+        self.assertEqual(['Hi', ',', 'Al', '.'], fragments)
+
+    def test_template_composition(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import uuid
+        import json
+        import wave
+
+        speech_synthesizer = SpeechSynthesizer(engine='DUMMY')
+        speech_synthesizer.engine.set_file_sizes(1000)
+        speech_synthesizer.engine = MagicMock(wraps=speech_synthesizer.engine)
+
+        template = 'Battery at {N} percent ' + uuid.uuid4().hex
+        request = SynthesizerRequest(text=template, metadata=json.dumps({'template_values': {'N': 42}}))
+        response = speech_synthesizer._node_request_handler(request)
+        res_dict = json.loads(response.result)
+        self.assertEqual(3, speech_synthesizer.engine.call_count)
+        wavf = wave.open(res_dict['Audio File'], 'rb')
+        self.assertEqual(1500, wavf.getnframes())
+        wavf.close()
+
+        # only the new value needs the engine, the fixed fragments come from the cache
+        request = SynthesizerRequest(text=template, metadata=json.dumps({'template_values': {'N': 7}}))
+        response = speech_synthesizer._node_request_handler(request)
+        res_dict = json.loads(response.result)
+        self.assertEqual(4, speech_synthesizer.engine.call_count)
+        self.assertEqual('audio/pcm', res_dict['Audio Type'])
+
+    def test_template_composition_with_few_extracted_files(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        from tts.db import PackedDB
+        import functools
+        import tempfile
+        import shutil
+        import json
+        import wave
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            # caching the later fragments deletes the loose copies of the earlier ones before they are joined
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, cache_storage='pack')
+            speech_synthesizer.CACHE_STORAGES = {'pack': functools.partial(PackedDB, max_extracted_files=2)}
+            speech_synthesizer.engine.set_file_sizes(1000)
+
+            request = SynthesizerRequest(text='{a} {b} {c} {d}', metadata=json.dumps({
+                'template_values': {'a': 'one', 'b': 'two', 'c': 'three', 'd': 'four'}}))
+            res_dict = json.loads(speech_synthesizer._node_request_handler(request).result)
+            wavf = wave.open(res_dict['Audio File'], 'rb')
+            self.assertEqual(4 * 500, wavf.getnframes())
+            wavf.close()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_template_composition_requires_pcm(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import json
+
+        speech_synthesizer = SpeechSynthesizer(engine='DUMMY')
+        request = SynthesizerRequest(text='Battery at {N} percent', metadata=json.dumps({
+            'template_values': {'N': 42}, 'output_format': 'mp3'}))
+        response = speech_synthesizer._node_request_handler(request)
+        self.assertTrue(response.result.startswith('Exception: '))
+
+
+    def test_replay_with_eviction_policy(self):
+        from tts.cachesim import TraceRecord, replay
+        # five prompts requested in a cycle through a cache that holds three, only 'a' is slow to synthesize
+        trace = []
+        for t in range(50):
+            key = 'abcde'[t % 5]
+            trace.append(TraceRecord(t, key, 100, False, 1.0 if key == 'a' else 0.01))
+
+        lru = replay(trace, 300, 'lru')
+        gds = replay(trace, 300, 'gds')
+        self.assertEqual(50, lru['requests'])
+        self.assertEqual(0, lru['hits'])
+        # 'a' is never evicted after its first synthesis
+        self.assertGreaterEqual(gds['hits'], 9)
+        self.assertGreaterEqual(gds['latency_saved'], 9.0)
+
+    def test_trace_replay_is_faithful(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        from tts.cachesim import read_trace, replay
+        import tempfile
+        import shutil
+        import os
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            trace_file = os.path.join(cache_dir, 'trace.csv')
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', max_cache_bytes=300, cache_dir=cache_dir,
+                                                   trace_file=trace_file)
+            speech_synthesizer.engine.set_file_sizes(100)
+            for t in range(30):
+                request = SynthesizerRequest(text='abcdaeabfa'[t % 10], metadata='')
+                speech_synthesizer._node_request_handler(request)
+            speech_synthesizer.trace.close()
+
+            trace = list(read_trace(trace_file))
+            self.assertEqual(30, len(trace))
+            self.assertTrue(all(r.size == 100 for r in trace))
+            recorded_hits = sum(1 for r in trace if r.hit)
+            self.assertGreater(recorded_hits, 0)
+            self.assertEqual(recorded_hits, replay(trace, 300, 'lru')['hits'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def _run_stress(self, cache_dir, max_cache_bytes):
+        import multiprocessing
+        import os
+        import random
+
+        texts = ['utterance {}'.format(i) for i in range(40)]
+        log_file = os.path.join(cache_dir, 'engine.log')
+        processes = []
+        for i in range(6):
+            shuffled = list(texts)
+            random.Random(i).shuffle(shuffled)
+            p = multiprocessing.Process(target=_stress_worker, args=(cache_dir, log_file, max_cache_bytes, shuffled))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
+            self.assertEqual(0, p.exitcode)
+        with open(log_file) as f:
+            return [line.strip() for line in f]
+
+    def test_multiprocess_no_duplicate_synthesis(self):
+        from tts.db import DB
+        import tempfile
+        import shutil
+        import os
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            calls = self._run_stress(cache_dir, 100000000)
+            self.assertEqual(40, len(calls))
+            self.assertEqual(40, len(set(calls)))
+            self.assertEqual(40, DB(db_location=os.path.join(cache_dir, 'polly.db')).get_num_files())
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_multiprocess_no_dangling_rows(self):
+        from tts.db import DB
+        import tempfile
+        import shutil
+        import os
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            self._run_stress(cache_dir, 1000)
+            db = DB(db_location=os.path.join(cache_dir, 'polly.db'))
+            rows = db.ex('SELECT file FROM cache').fetchall()
+            self.assertLessEqual(db.get_size(), 1000)
+            self.assertTrue(all(os.path.exists(r['file']) for r in rows))
+            cached_files = set(r['file'] for r in rows)
+            on_disk = set(os.path.join(cache_dir, fn) for fn in os.listdir(cache_dir) if fn.startswith('voice_'))
+            self.assertEqual(cached_files, on_disk)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def _check_remote_cache(self, remote_cache, make_remote_dir=None):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+        import json
+        import uuid
+
+        robot1_dir, robot2_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            robot1 = SpeechSynthesizer(engine='DUMMY', cache_dir=robot1_dir, remote_cache=remote_cache)
+            robot1.engine = MagicMock(wraps=robot1.engine)
+            robot2 = SpeechSynthesizer(engine='DUMMY', cache_dir=robot2_dir, remote_cache=remote_cache)
+            robot2.engine = MagicMock(wraps=robot2.engine)
+
+            text = uuid.uuid4().hex
+            request = SynthesizerRequest(text=text, metadata='{"output_format": "pcm"}')
+            expected = json.loads(robot1._node_request_handler(request).result)
+            self.assertEqual(1, robot1.engine.call_count)
+            robot1.remote_write_back.flush()
+
+            response = robot2._node_request_handler(request)
+            self.assertEqual(0, robot2.engine.call_count)
+            res_dict = json.loads(response.result)
+            self.assertTrue(res_dict['Audio File'].startswith(robot2_dir))
+            self.assertEqual(expected['Audio Type'], res_dict['Audio Type'])
+            with open(expected['Audio File'], 'rb') as f1, open(res_dict['Audio File'], 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(1, robot2._open_db().get_num_files())
+
+            robot2._node_request_handler(request)
+            self.assertEqual(0, robot2.engine.call_count)
+        finally:
+            shutil.rmtree(robot1_dir)
+            shutil.rmtree(robot2_dir)
+
+    def test_shared_directory_remote_cache(self):
+        from tts.remotecache import make_remote_cache
+        import tempfile
+        import shutil
+
+        remote_dir = tempfile.mkdtemp()
+        try:
+            self._check_remote_cache(make_remote_cache('file://' + remote_dir))
+        finally:
+            shutil.rmtree(remote_dir)
+
+    def test_http_remote_cache(self):
+        from tts.remotecache import make_remote_cache
+        from tts.deadline import DeadlineExceeded
+        import threading
+        import time
+        try:
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+
+        blobs = {}
+
+        class BlobStore(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in blobs:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                content_type, data = blobs[self.path]
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self):
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                blobs[self.path] = (self.headers['Content-Type'], data)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), BlobStore)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            remote_cache = make_remote_cache('http://127.0.0.1:{}/tts'.format(server.server_port))
+            self._check_remote_cache(remote_cache)
+            self.assertEqual(1, len(blobs))
+
+            # the time left before a deadline is split between connecting and reading
+            remote_cache.session.get = MagicMock(wraps=remote_cache.session.get)
+            self.assertIsNone(remote_cache.get('missing', '/nonexistent/voice_missing', time.time() + 3))
+            connect_timeout, read_timeout = remote_cache.session.get.call_args[1]['timeout']
+            self.assertLessEqual(connect_timeout + read_timeout, 3)
+            self.assertLess(connect_timeout, read_timeout)
+            with self.assertRaises(DeadlineExceeded):
+                remote_cache.get('missing', '/nonexistent/voice_missing', time.time() - 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def test_async_bookkeeping(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import os
+        import tempfile
+        import shutil
+        import threading
+        import json
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, max_cache_bytes=1,
+                                                   async_bookkeeping=True)
+            speech_synthesizer.engine = MagicMock(wraps=speech_synthesizer.engine)
+            db = speech_synthesizer._open_db()
+
+            # hold the writer back to show that requests don't wait for it
+            writer_released = threading.Event()
+            speech_synthesizer.cache_writer.submit(lambda db: writer_released.wait())
+
+            first = SynthesizerRequest(text='first', metadata='')
+            res = json.loads(speech_synthesizer._node_request_handler(first).result)
+            self.assertTrue(os.path.exists(res['Audio File']))
+            self.assertEqual(0, db.get_num_files())
+
+            # served from the pending insert
+            speech_synthesizer._node_request_handler(first)
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+
+            second = SynthesizerRequest(text='second', metadata='')
+            speech_synthesizer._node_request_handler(second)
+            self.assertEqual(2, speech_synthesizer.engine.call_count)
+
+            writer_released.set()
+            speech_synthesizer.cache_writer.flush()
+            self.assertIsNone(speech_synthesizer.cache_writer.pending(speech_synthesizer._cache_key(
+                speech_synthesizer._parse_request_or_raise(first))))
+            # the first utterance was hit once and then evicted to make room for the second
+            self.assertEqual(1, db.get_num_files())
+            self.assertFalse(os.path.exists(res['Audio File']))
+            speech_synthesizer.cache_writer.stop()
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_error_cache(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, SynthesizerResponse
+        from tts.cachesim import VirtualClock
+        import tempfile
+        import shutil
+        import json
+
+        def rejection(code):
+            return SynthesizerResponse(json.dumps({
+                'Audio File': 'error.ogg',
+                'Audio Type': 'ogg',
+                'Exception': {'Name': 'ClientError', 'Code': code, 'Value': 'rejected'},
+                'Traceback': 'some traceback'
+            }))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, error_cache_ttl=10.0)
+            speech_synthesizer.clock = clock = VirtualClock(100.0)
+            speech_synthesizer.engine = MagicMock(return_value=rejection('InvalidSsmlException'))
+
+            request = SynthesizerRequest(text='<speak>hello', metadata='{"text_type": "ssml"}')
+            first = speech_synthesizer._node_request_handler(request)
+            second = speech_synthesizer._node_request_handler(request)
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+            self.assertEqual(first.result, second.result)
+            self.assertEqual({'InvalidSsmlException': 1}, speech_synthesizer.error_cache.stats()['hits_by_code'])
+
+            clock.advance(10.0)
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(2, speech_synthesizer.engine.call_count)
+
+            # transient errors are never remembered
+            speech_synthesizer.engine = MagicMock(return_value=rejection('ThrottlingException'))
+            request = SynthesizerRequest(text='hello', metadata='')
+            speech_synthesizer._node_request_handler(request)
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(2, speech_synthesizer.engine.call_count)
+            self.assertEqual(1, speech_synthesizer.error_cache.stats()['hits'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_voice_validation(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        from tts.voices import VoiceCatalog
+        import os
+        import tempfile
+        import shutil
+        import json
+        import time
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, validate_voices=True)
+            # the dummy engine can't list voices
+            self.assertIsNone(speech_synthesizer.voice_catalog)
+
+            describe_voices = MagicMock(return_value=[
+                {'Id': 'Joanna', 'LanguageCode': 'en-US'},
+                {'Id': 'Aditi', 'LanguageCode': 'hi-IN', 'AdditionalLanguageCodes': ['en-IN']},
+            ])
+            speech_synthesizer.voice_catalog = VoiceCatalog(describe_voices,
+                                                            cache_file=os.path.join(cache_dir, 'polly_voices.json'))
+
+            def synthesize(text, **metadata):
+                request = SynthesizerRequest(text=text, metadata=json.dumps(metadata))
+                return speech_synthesizer._node_request_handler(request).result
+
+            self.assertIn('no voice Kendra', synthesize('hi', voice_id='Kendra'))
+            self.assertIn('does not speak en-IN', synthesize('hi', voice_id='Joanna', language_code='en-IN'))
+            self.assertIn('sample rate 22050', synthesize('hi', output_format='pcm', sample_rate='22050'))
+            self.assertIn('Audio File', synthesize('hi', voice_id='Aditi', language_code='en-IN'))
+            self.assertEqual(1, describe_voices.call_count)
+            # fetching the catalogue doesn't wait for the polly node forever, it holds the lock of the utterance
+            fetch_deadline = describe_voices.call_args[0][0]
+            self.assertLessEqual(fetch_deadline, time.time() + SpeechSynthesizer.VOICE_CATALOG_TIMEOUT)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_lexicon_versions_in_cache_key(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+            speech_synthesizer.engine = MagicMock(wraps=speech_synthesizer.engine)
+            lexicons = speech_synthesizer.lexicon_index
+            lexicons.record('robots', '<lexicon>v1</lexicon>')
+            lexicons.record('names', '<lexicon>v1</lexicon>')
+
+            with_robots = SynthesizerRequest(text='hello', metadata='{"lexicon_names": ["robots"]}')
+            with_names = SynthesizerRequest(text='hello', metadata='{"lexicon_names": ["names"]}')
+            plain = SynthesizerRequest(text='hello', metadata='')
+            for request in (with_robots, with_names, plain):
+                speech_synthesizer._node_request_handler(request)
+            self.assertEqual(3, speech_synthesizer.engine.call_count)
+
+            # only the audio synthesized with the changed lexicon is synthesized again
+            lexicons.record('robots', '<lexicon>v2</lexicon>')
+            for request in (with_robots, with_names, plain):
+                speech_synthesizer._node_request_handler(request)
+            self.assertEqual(4, speech_synthesizer.engine.call_count)
+            self.assertEqual(SpeechSynthesizer._cache_key({'text': 'hello'}),
+                             SpeechSynthesizer._cache_key({'text': 'hello'}, []))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_lexicon_put_through_the_polly_node_is_a_miss(self):
+        from tts.amazonpolly import AmazonPolly
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, PollyRequest
+        import tempfile
+        import shutil
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            polly = AmazonPolly(defer_client=True, cache_dir=cache_dir)
+            polly._polly = MagicMock()
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+            speech_synthesizer.engine = MagicMock(wraps=speech_synthesizer.engine)
+
+            def put_lexicon(content):
+                polly._node_request_handler(PollyRequest(polly_action='PutLexicon', lexicon_name='robots',
+                                                         lexicon_content=content))
+
+            request = SynthesizerRequest(text='hello', metadata='{"lexicon_names": ["robots"]}')
+            put_lexicon('<lexicon>v1</lexicon>')
+            speech_synthesizer._node_request_handler(request)
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+
+            put_lexicon('<lexicon>v2</lexicon>')
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(2, speech_synthesizer.engine.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_long_form_synthesis_task(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        from tts.tasks import TaskPoller
+        import os
+        import tempfile
+        import shutil
+        import json
+        import time
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+            self.assertIn('can not run synthesis tasks', speech_synthesizer._node_request_handler(
+                SynthesizerRequest(text='Chapter 1', metadata='{"long_form": true}')).result)
+
+            statuses = ['scheduled', 'inProgress', 'completed']
+
+            def get_task(task_id, output_path):
+                status = statuses.pop(0)
+                res = {'SynthesisTask': {'TaskId': task_id, 'TaskStatus': status}}
+                if status == 'completed':
+                    with open(output_path + '.ogg', 'wb') as f:
+                        f.write(b'audio' * 100)
+                    res.update({'Audio File': output_path + '.ogg', 'Audio Type': 'audio/ogg'})
+                return res
+
+            engine = MagicMock(start_task=MagicMock(return_value={'TaskId': 'task1', 'TaskStatus': 'scheduled'}),
+                               get_task=MagicMock(side_effect=get_task))
+            speech_synthesizer.engine = engine
+            speech_synthesizer.task_poller = TaskPoller(initial_delay=0.01, max_delay=0.02)
+
+            request = SynthesizerRequest(text='Chapter 1', metadata=json.dumps({
+                'long_form': True, 'output_s3_bucket_name': 'bucket'}))
+            res = json.loads(speech_synthesizer._node_request_handler(request).result)
+            self.assertEqual({'Audio File': '', 'Audio Type': '', 'Task Id': 'task1', 'Task Status': 'scheduled'}, res)
+            self.assertEqual('bucket', engine.start_task.call_args[1]['output_s3_bucket_name'])
+            self.assertNotIn('output_path', engine.start_task.call_args[1])
+
+            # a request while the task runs doesn't start another task
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(1, engine.start_task.call_count)
+
+            for _ in range(500):
+                if not speech_synthesizer._tasks:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(3, engine.get_task.call_count)
+
+            res = json.loads(speech_synthesizer._node_request_handler(request).result)
+            self.assertTrue(res['Audio File'].startswith(cache_dir))
+            self.assertEqual(500, os.path.getsize(res['Audio File']))
+            self.assertEqual(1, engine.start_task.call_count)
+            speech_synthesizer.task_poller.stop()
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_deadline(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+        import json
+        import time
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+            speech_synthesizer.engine = MagicMock(side_effect=speech_synthesizer.engine)
+
+            deadline = time.time() + 60
+            request = SynthesizerRequest(text='hello', metadata=json.dumps({'deadline': deadline}))
+            first = speech_synthesizer._node_request_handler(request)
+            self.assertEqual(deadline, speech_synthesizer.engine.call_args[1]['deadline'])
+
+            # the deadline is no part of the cache key, and a cached utterance is returned even when it passed
+            request = SynthesizerRequest(text='hello', metadata=json.dumps({'deadline': time.time() - 1}))
+            second = speech_synthesizer._node_request_handler(request)
+            self.assertEqual(json.loads(first.result)['Audio File'], json.loads(second.result)['Audio File'])
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+
+            # nothing is synthesized after the deadline
+            request = SynthesizerRequest(text='goodbye', metadata=json.dumps({'deadline': time.time() - 1}))
+            res = speech_synthesizer._node_request_handler(request)
+            self.assertTrue(res.result.startswith('Exception: the deadline passed'))
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @patch('tts.amazonpolly.AmazonPolly')
+    def test_polly_lib_in_the_same_process(self, polly_class_mock):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        polly = MagicMock()
+        speech_synthesizer = SpeechSynthesizer(engine='POLLY_LIBRARY', polly=polly)
+        request = SynthesizerRequest(text='hello', metadata='{"output_path": "/tmp/test"}')
+        response = speech_synthesizer._node_request_handler(request)
+        speech_synthesizer._node_request_handler(request)
+
+        self.assertEqual(0, polly_class_mock.call_count)
+        self.assertEqual(2, polly.synthesize.call_count)
+        self.assertEqual(response.result, polly.synthesize.return_value.result)
+
+    def test_canonical_master(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+        import json
+        import wave
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, canonical_master=True)
+            speech_synthesizer.engine = MagicMock(side_effect=speech_synthesizer.engine)
+
+            request = SynthesizerRequest(text='hello', metadata='{"output_format": "pcm", "sample_rate": "8000"}')
+            derived = json.loads(speech_synthesizer._node_request_handler(request).result)
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+            self.assertEqual('16000', speech_synthesizer.engine.call_args[1]['sample_rate'])
+            self.assertEqual('audio/pcm', derived['Audio Type'])
+            wavf = wave.open(derived['Audio File'], 'rb')
+            self.assertEqual(8000, wavf.getframerate())
+            self.assertEqual(speech_synthesizer.engine.side_effect.file_size // 2 // 2, wavf.getnframes())
+            wavf.close()
+
+            # the master and the derived audio are both cached
+            request = SynthesizerRequest(text='hello', metadata='{"output_format": "pcm", "sample_rate": "16000"}')
+            master = json.loads(speech_synthesizer._node_request_handler(request).result)
+            request = SynthesizerRequest(text='hello', metadata='{"output_format": "pcm", "sample_rate": "8000"}')
+            self.assertEqual(derived, json.loads(speech_synthesizer._node_request_handler(request).result))
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+            self.assertNotEqual(derived['Audio File'], master['Audio File'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_resample(self):
+        import numpy
+        from tts import transcode
+
+        # a 1 kHz tone keeps its frequency and amplitude when resampled
+        t = numpy.arange(16000) / 16000.0
+        tone = (10000 * numpy.sin(2 * numpy.pi * 1000 * t)).astype('<i2')
+        resampled = transcode.resample(tone, 16000, 22050)
+        self.assertEqual(22050, len(resampled))
+        expected = 10000 * numpy.sin(2 * numpy.pi * 1000 * numpy.arange(22050) / 22050.0)
+        self.assertLess(numpy.max(numpy.abs(resampled - expected)), 10)
+
+    def test_trim_silence(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, SynthesizerResponse
+        from tts import audio
+        import tempfile
+        import shutil
+        import json
+        import numpy
+        import wave
+        import os
+
+        def engine(**kw):
+            # 0.5 s of silence, 1 s of a tone and 0.3 s of silence
+            tone = 10000 * numpy.sin(2 * numpy.pi * 440 * numpy.arange(16000) / 16000.0)
+            samples = numpy.concatenate([numpy.zeros(8000), tone, numpy.zeros(4800)]).astype('<i2')
+            audio.write_wav(kw['output_path'] + '.wav', samples.tobytes(), 16000)
+            return SynthesizerResponse(json.dumps({'Audio File': kw['output_path'] + '.wav', 'Audio Type': 'pcm'}))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, trim_silence=True)
+            speech_synthesizer.engine = engine
+            request = SynthesizerRequest(text='hello', metadata='{"output_format": "pcm"}')
+            res = json.loads(speech_synthesizer._node_request_handler(request).result)
+
+            wavf = wave.open(res['Audio File'], 'rb')
+            self.assertEqual(16000 + 2 * 800, wavf.getnframes())  # 50 ms of padding on each side
+            wavf.close()
+            db = speech_synthesizer._open_db()
+            size = db.ex('SELECT size FROM cache').fetchone()['size']
+            self.assertEqual(os.path.getsize(res['Audio File']), size)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_stats(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, SynthesizerResponse
+        import tempfile
+        import shutil
+        import json
+        import sys
+
+        def engine(**kw):
+            if 'bad' in kw['text']:
+                return SynthesizerResponse(json.dumps({'Exception': {'Code': 'InvalidSsmlException'}}))
+            with open(kw['output_path'] + '.ogg', 'wb') as f:
+                f.write(b'x' * 100)
+            return SynthesizerResponse(json.dumps({'Audio File': kw['output_path'] + '.ogg',
+                                                   'Audio Type': 'ogg'}))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, max_cache_bytes=250,
+                                                   error_cache_ttl=60.0)
+            speech_synthesizer.engine = engine
+            for text in ('one', 'one', 'two', 'three', 'bad', 'bad'):
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text=text, metadata=''))
+
+            stats = speech_synthesizer.get_stats()
+            counters = stats['counters']
+            self.assertEqual(6, counters['requests'])
+            self.assertEqual(1, counters['hits'])
+            self.assertEqual(4, counters['misses'])
+            self.assertEqual(1, counters['error_cache_hits'])
+            self.assertEqual(1, counters['engine_errors'])
+            self.assertEqual(1, counters['evictions'])
+            self.assertEqual(100, counters['evicted_bytes'])
+            self.assertEqual({'InvalidSsmlException': 1}, stats['engine_errors_by_code'])
+            self.assertAlmostEqual(0.2, stats['hit_ratio'])
+            self.assertEqual(6, stats['request_latency']['count'])
+            self.assertEqual(2, stats['cache']['files'])
+            self.assertEqual(200, stats['cache']['bytes'])
+
+            class TriggerResponse(object):
+                def __init__(self, success, message):
+                    self.success, self.message = success, message
+
+            std_srvs = MagicMock()
+            std_srvs.srv.TriggerResponse = TriggerResponse
+            with patch.dict(sys.modules, {'std_srvs': std_srvs, 'std_srvs.srv': std_srvs.srv}):
+                res = speech_synthesizer._stats_request_handler(None)
+            self.assertTrue(res.success)
+            self.assertEqual(6, json.loads(res.message)['counters']['requests'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_stats_of_composed_and_derived_requests(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+        import json
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, canonical_master=True)
+            speech_synthesizer.engine.set_file_sizes(1000)
+
+            # each of the three fragments is one miss, the composed file is not another one
+            request = SynthesizerRequest(text='Hello {name}, bye', metadata=json.dumps({
+                'template_values': {'name': 'Ann'}}))
+            speech_synthesizer._node_request_handler(request)
+            stats = speech_synthesizer.get_stats()
+            self.assertEqual(1, stats['counters']['requests'])
+            self.assertEqual(0, stats['counters']['hits'])
+            self.assertEqual(3, stats['counters']['misses'])
+            self.assertEqual(3, stats['synthesis_latency']['count'])
+            speech_synthesizer._node_request_handler(request)
+            self.assertEqual(1, speech_synthesizer.get_stats()['counters']['hits'])
+
+            # a derived format is a miss for its master only, and a hit once the master is cached
+            speech_synthesizer.stats = type(speech_synthesizer.stats)()
+            for sample_rate in ('8000', '22050'):
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text='derived', metadata=json.dumps({
+                    'output_format': 'pcm', 'sample_rate': sample_rate})))
+            stats = speech_synthesizer.get_stats()
+            self.assertEqual(1, stats['counters']['misses'])
+            self.assertEqual(1, stats['counters']['hits'])
+            self.assertEqual(1, stats['synthesis_latency']['count'])
+            self.assertAlmostEqual(0.5, stats['hit_ratio'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_profiling(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import threading
+        import shutil
+        import pstats
+        import os
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir)
+            output_path = os.path.join(cache_dir, 'synthesizer.prof')
+            results = []
+            session = threading.Thread(target=lambda: results.append(
+                speech_synthesizer.profiler.profile(duration=10.0, num_requests=2, output_path=output_path)))
+            session.start()
+            i = 0
+            while session.is_alive():
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text='hello {}'.format(i), metadata=''))
+                i += 1
+            session.join()
+
+            result = results[0]
+            self.assertEqual(2, result['Profiled Requests'])
+            self.assertEqual(output_path, result['Profile File'])
+            self.assertTrue(result['Hot Spots'])
+            self.assertGreaterEqual(result['Hot Spots'][0]['tottime'], result['Hot Spots'][-1]['tottime'])
+            functions = pstats.Stats(output_path).stats
+            self.assertTrue(any(func[2] == '_call_engine' for func in functions))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_prefetch(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest
+        import tempfile
+        import shutil
+        import json
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, prefetch=1)
+            engine = MagicMock(wraps=speech_synthesizer.engine)
+            speech_synthesizer.engine = engine
+
+            def request(text, metadata=None):
+                speech_synthesizer._node_request_handler(SynthesizerRequest(text, json.dumps(metadata or {})))
+                speech_synthesizer.prefetcher.flush()
+
+            # "Great" followed the question once, so it is prefetched the next time the question is asked
+            request('Would you like to continue?')
+            request('Great')
+            self.assertEqual(2, engine.call_count)
+            db = speech_synthesizer._open_db()
+            db.ex('DELETE FROM cache')
+            request('Would you like to continue?')
+            self.assertEqual(4, engine.call_count)
+            self.assertEqual('Great', engine.call_args[1]['text'])
+            request('Great')
+            self.assertEqual(4, engine.call_count)
+
+            # hints are prefetched with the voice of the request unless they name another one
+            request('Are you sure?', {'voice_id': 'Amy', 'prefetch': ['Yes', {'text': 'No', 'voice_id': 'Brian'}]})
+            prefetched = [(c[1]['text'], c[1]['voice_id']) for c in engine.call_args_list[4:]]
+            self.assertEqual([('Are you sure?', 'Amy'), ('Yes', 'Amy'), ('No', 'Brian')], prefetched)
+            self.assertEqual(3, speech_synthesizer.stats.snapshot()['counters']['prefetches'])
+
+            # nothing is prefetched once the budget is spent
+            speech_synthesizer.prefetcher.budget = 3
+            request('Bye', {'prefetch': ['See you']})
+            self.assertEqual(8, engine.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+    def test_prefetch_of_a_rejected_request(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, SynthesizerResponse
+        import tempfile
+        import shutil
+        import json
+
+        def engine(**kw):
+            return SynthesizerResponse(json.dumps({'Exception': {'Code': 'InvalidSsmlException'}}))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, error_cache_ttl=60.0,
+                                                   prefetch=1)
+            speech_synthesizer.engine = MagicMock(side_effect=engine)
+            speech_synthesizer._node_request_handler(SynthesizerRequest('<speak>', ''))
+            self.assertEqual(1, speech_synthesizer.engine.call_count)
+
+            # a rejected request is not prefetched, and looking it up is not an error cache hit
+            speech_synthesizer._node_request_handler(SynthesizerRequest('hi', json.dumps({'prefetch': ['<speak>']})))
+            speech_synthesizer.prefetcher.flush()
+            self.assertEqual(2, speech_synthesizer.engine.call_count)
+            self.assertEqual(0, speech_synthesizer.error_cache.stats()['hits'])
+            self.assertEqual(0, speech_synthesizer.get_stats()['counters']['error_cache_hits'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_pinning(self):
+        from tts.synthesizer import SpeechSynthesizer
+        from tts.srv import SynthesizerRequest, PinRequest
+        import tempfile
+        import shutil
+        import os
+        import json
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            speech_synthesizer = SpeechSynthesizer(engine='DUMMY', cache_dir=cache_dir, max_cache_bytes=250,
+                                                   max_pinned_bytes=150)
+            speech_synthesizer.engine.set_file_sizes(100)
+
+            def request(text, metadata=None):
+                res = speech_synthesizer._node_request_handler(SynthesizerRequest(text, json.dumps(metadata or {})))
+                return json.loads(res.result)['Audio File']
+
+            def cached():
+                db = speech_synthesizer._open_db()
+                return set(r['file'] for r in db.ex('SELECT file FROM cache').fetchall())
+
+            safety = request('Stand clear, robot moving', {'pin': True})
+            others = [request('one-off {}'.format(i)) for i in range(5)]
+            self.assertEqual({safety, others[3], others[4]}, cached())
+
+            # a second pin would go over the budget of pinned bytes
+            res = json.loads(speech_synthesizer._pin_request_handler(PinRequest('Watch out', '', True)).result)
+            self.assertFalse(res['Pinned'])
+            self.assertEqual(100, speech_synthesizer.get_stats()['cache']['pinned_bytes'])
+
+            res = json.loads(speech_synthesizer._pin_request_handler(
+                PinRequest('Stand clear, robot moving', '', False)).result)
+            self.assertFalse(res['Pinned'])
+            self.assertNotIn(safety, cached())
+            res = json.loads(speech_synthesizer._pin_request_handler(PinRequest('Watch out', '', True)).result)
+            self.assertTrue(res['Pinned'])
+            self.assertIn(res['Audio File'], cached())
+
+            # pinned audio that is lost is synthesized again and stays pinned
+            os.remove(res['Audio File'])
+            self.assertEqual(res['Audio File'], request('Watch out'))
+            self.assertEqual(1, speech_synthesizer._open_db().get_num_files(pinned=True))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
 if __name__ == '__main__':
     import rosunit
     rosunit.unitrun('tts', 'unittest-synthesizer', TestSynthesizer)